@@ -0,0 +1,193 @@
+# Copyright (C) The Arvados Authors. All rights reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+"""Eviction policies for the Keep block cache
+
+`KeepBlockCache` splits its slots across shards, and each shard has its
+own policy object tracking the blocks in that shard.  All methods are
+called with the shard lock held.  When the cache is over budget, it
+asks each shard's policy for `evict_rank` and evicts from the shard
+with the lowest rank, so ranks from different instances of a policy
+must be comparable.  The `ticks` iterator is shared by every shard of
+a cache to make that possible.
+"""
+
+import collections
+import itertools
+
+import typing as t
+
+Key = t.Hashable
+Evictable = t.Callable[[Key], bool]
+
+class LRUPolicy:
+    """Evict the least recently used block"""
+    name = 'lru'
+
+    def __init__(self, ticks: t.Iterator[int]) -> None:
+        self._ticks = ticks
+        # key -> tick of last access, least recently used first
+        self._order: 'collections.OrderedDict[Key, int]' = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    def insert(self, key: Key) -> None:
+        self._order[key] = next(self._ticks)
+
+    def hit(self, key: Key) -> None:
+        self._order.move_to_end(key)
+        self._order[key] = next(self._ticks)
+
+    def remove(self, key: Key) -> None:
+        self._order.pop(key, None)
+
+    def _candidate(self, evictable: Evictable) -> t.Optional[Key]:
+        for key in self._order:
+            if evictable(key):
+                return key
+        return None
+
+    def evict_rank(self, evictable: Evictable) -> t.Optional[t.Tuple[int, ...]]:
+        key = self._candidate(evictable)
+        if key is None:
+            return None
+        return (self._order[key],)
+
+    def evict(self, evictable: Evictable) -> t.Optional[Key]:
+        key = self._candidate(evictable)
+        if key is not None:
+            del self._order[key]
+        return key
+
+
+class S3FIFOPolicy:
+    """Scan-resistant S3-FIFO eviction
+
+    New blocks go into a small FIFO queue.  Blocks that are read again
+    while in the small queue are promoted to the main queue when they
+    reach its head, and the rest are evicted, so a one-time sequential
+    scan only churns the small queue.  Blocks in the main queue are
+    kept as long as they keep getting read.  Keys recently evicted
+    from the small queue are remembered in a ghost queue, and go
+    straight to the main queue if they are inserted again.
+
+    See Yang et al., "FIFO queues are all you need for cache
+    eviction", SOSP 2023.
+    """
+    name = 's3fifo'
+
+    # The small queue should hold about this fraction of the blocks.
+    SMALL_RATIO = 0.1
+    # Access counts saturate at this value.
+    MAX_FREQ = 3
+
+    def __init__(self, ticks: t.Iterator[int]) -> None:
+        self._ticks = ticks
+        # key -> tick when the key entered its queue, oldest first
+        self._small: 'collections.OrderedDict[Key, int]' = collections.OrderedDict()
+        self._main: 'collections.OrderedDict[Key, int]' = collections.OrderedDict()
+        self._ghost: 'collections.OrderedDict[Key, None]' = collections.OrderedDict()
+        self._freq: t.Dict[Key, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._small) + len(self._main)
+
+    def insert(self, key: Key) -> None:
+        if key in self._ghost:
+            del self._ghost[key]
+            self._main[key] = next(self._ticks)
+        else:
+            self._small[key] = next(self._ticks)
+        self._freq[key] = 0
+
+    def hit(self, key: Key) -> None:
+        freq = self._freq.get(key)
+        if freq is not None and freq < self.MAX_FREQ:
+            self._freq[key] = freq + 1
+
+    def remove(self, key: Key) -> None:
+        self._small.pop(key, None)
+        self._main.pop(key, None)
+        self._freq.pop(key, None)
+
+    def _small_over_target(self) -> bool:
+        return len(self._small) > self.SMALL_RATIO * len(self)
+
+    def _first_evictable(
+            self,
+            queue: 'collections.OrderedDict[Key, int]',
+            evictable: Evictable,
+    ) -> t.Optional[Key]:
+        for key in queue:
+            if evictable(key):
+                return key
+        return None
+
+    def evict_rank(self, evictable: Evictable) -> t.Optional[t.Tuple[int, ...]]:
+        # Blocks that would be evicted from the small queue rank ahead
+        # of the main queue in every shard, then oldest first.
+        queues = [(0, self._small), (1, self._main)]
+        if not self._small_over_target():
+            queues.reverse()
+        for tier, queue in queues:
+            key = self._first_evictable(queue, evictable)
+            if key is not None:
+                return (tier, queue[key])
+        return None
+
+    def _evict_small(self, evictable: Evictable) -> t.Optional[Key]:
+        while True:
+            key = self._first_evictable(self._small, evictable)
+            if key is None:
+                return None
+            del self._small[key]
+            if self._freq[key] > 0:
+                self._main[key] = next(self._ticks)
+                self._freq[key] = 0
+                continue
+            del self._freq[key]
+            self._ghost[key] = None
+            while len(self._ghost) > max(len(self._main), 1):
+                self._ghost.popitem(last=False)
+            return key
+
+    def _evict_main(self, evictable: Evictable) -> t.Optional[Key]:
+        # Every pass over the queue lowers the access count of the
+        # blocks it keeps, so this finishes within MAX_FREQ+1 passes.
+        for _ in range(self.MAX_FREQ + 1):
+            for key in [k for k in self._main if evictable(k)]:
+                if self._freq[key] > 0:
+                    self._freq[key] -= 1
+                    self._main.move_to_end(key)
+                    self._main[key] = next(self._ticks)
+                    continue
+                del self._main[key]
+                del self._freq[key]
+                return key
+        return None
+
+    def evict(self, evictable: Evictable) -> t.Optional[Key]:
+        if self._small_over_target():
+            key = self._evict_small(evictable) or self._evict_main(evictable)
+        else:
+            key = self._evict_main(evictable) or self._evict_small(evictable)
+        return key
+
+
+POLICIES = {
+    policy.name: policy
+    for policy in [LRUPolicy, S3FIFOPolicy]
+}
+DEFAULT_POLICY = LRUPolicy.name
+
+def get_policy(name: str) -> t.Type[t.Union[LRUPolicy, S3FIFOPolicy]]:
+    """Return the eviction policy class with the given name
+
+    Raises `ValueError` if there is no policy with that name.
+    """
+    try:
+        return POLICIES[name]
+    except KeyError:
+        raise ValueError("unknown cache eviction policy {!r} (choose from {})".format(
+            name, ', '.join(sorted(POLICIES)))) from None
@@ -2,6 +2,7 @@
 #
 # SPDX-License-Identifier: Apache-2.0
 
+import atexit
 import threading
 import mmap
 import os
@@ -19,8 +20,78 @@ _logger = logging.getLogger('arvados.keep')
 
 cacheblock_suffix = ".keepcacheblock"
 
+class FetchLocks(object):
+    """Cross-process locks on blocks being fetched into a shared cache
+
+    A process that is about to fetch a block into the cache directory
+    holds the lock for that block until the block is written, so other
+    processes sharing the directory can wait for it instead of
+    downloading it again.  Each lock is an flock() on a lock file next
+    to where the block will be stored, opened separately for each
+    acquire().  The lock belongs to that open file rather than to the
+    process, so threads never release each other's locks, and waiting
+    processes can't be mistaken for a deadlock.  The lock file is
+    removed when the lock is released.
+    """
+
+    def __init__(self, cachedir):
+        os.makedirs(cachedir, mode=0o700, exist_ok=True)
+        self.cachedir = cachedir
+        self._lock = threading.Lock()
+        # locator -> file descriptor of the lock file we hold
+        self._held = {}
+
+    def _path(self, locator):
+        return os.path.join(self.cachedir, locator[0:3], locator + ".fetchlock")
+
+    @staticmethod
+    def _flock(fd):
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                return
+            except OSError as e:
+                if e.errno not in (errno.EINTR, errno.EDEADLK):
+                    raise
+
+    def acquire(self, locator):
+        path = self._path(locator)
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                self._flock(fd)
+                # The holder removes the lock file before unlocking
+                # it.  If that happened while we waited, we locked a
+                # file nobody else will see, so lock the new one.
+                if os.fstat(fd).st_nlink > 0:
+                    break
+            except BaseException:
+                os.close(fd)
+                raise
+            os.close(fd)
+        with self._lock:
+            self._held[locator] = fd
+
+    def release(self, locator):
+        with self._lock:
+            fd = self._held.pop(locator)
+        try:
+            os.unlink(self._path(locator))
+        except FileNotFoundError:
+            pass
+        finally:
+            os.close(fd)
+
+    def close(self):
+        with self._lock:
+            held = list(self._held)
+        for locator in held:
+            self.release(locator)
+
+
 class DiskCacheSlot(object):
-    __slots__ = ("locator", "ready", "content", "cachedir", "filehandle", "linger")
+    __slots__ = ("locator", "ready", "content", "cachedir", "filehandle", "linger", "released")
 
     def __init__(self, locator, cachedir):
         self.locator = locator
@@ -29,9 +100,13 @@ class DiskCacheSlot(object):
         self.cachedir = cachedir
         self.filehandle = None
         self.linger = None
+        # Size of the block if its file has been closed by release()
+        self.released = None
 
     def get(self):
         self.ready.wait()
+        if self.content is None and self.released is not None:
+            self.remap()
         # 'content' can None, an empty byte string, or a nonempty mmap
         # region.  If it is an mmap region, we want to advise the
         # kernel we're going to use it.  This nudges the kernel to
@@ -92,8 +167,41 @@ class DiskCacheSlot(object):
                 except:
                     pass
 
+    def release(self):
+        """Close the block's file and mapping, but keep it on disk
+
+        get() opens it again when it is next read.  Callers that
+        already have the mapped content can keep using it.  Since
+        this gives up the shared lock on the block, another process
+        using the same cache directory may delete it before then.
+        """
+        content = self.content
+        if not content:
+            return
+        self.released = len(content)
+        self.filehandle = None
+        self.content = None
+
+    def remap(self):
+        """Open and map a block closed by release()
+
+        If the block has been deleted in the meantime, the slot's
+        content stays None.
+        """
+        final = os.path.join(self.cachedir, self.locator[0:3], self.locator) + cacheblock_suffix
+        try:
+            filehandle = open(final, "rb")
+            fcntl.flock(filehandle, fcntl.LOCK_SH)
+            self.content = mmap.mmap(filehandle.fileno(), 0, access=mmap.ACCESS_READ)
+            self.filehandle = filehandle
+        except OSError:
+            pass
+        self.released = None
+
     def size(self):
         if self.content is None:
+            if self.released is not None:
+                return self.released
             if self.linger is not None:
                 # If it is still lingering (object is still accessible
                 # through the weak reference) it is still taking up
@@ -106,6 +214,9 @@ class DiskCacheSlot(object):
             return len(self.content)
 
     def evict(self):
+        if self.content is None and self.released is not None:
+            self.released = None
+            return DiskCacheSlot.remove_from_disk(self.locator, self.cachedir)
         if not self.content:
             return
 
@@ -188,23 +299,25 @@ class DiskCacheSlot(object):
         return None
 
     @staticmethod
-    def cache_usage(cachedir):
-        usage = 0
-        for root, dirs, files in os.walk(cachedir):
-            for name in files:
-                if not name.endswith(cacheblock_suffix):
-                    continue
-
-                blockpath = os.path.join(root, name)
-                res = os.stat(blockpath)
-                usage += res.st_size
-        return usage
+    def remove_from_disk(locator, cachedir):
+        """Delete a cache block that this process has not mapped
 
+        The block is only deleted if no other process holds it.
+        Returns True if the block was deleted.
+        """
+        final = os.path.join(cachedir, locator[0:3], locator) + cacheblock_suffix
+        try:
+            with open(final, "rb") as filehandle:
+                fcntl.flock(filehandle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                os.remove(final)
+                return True
+        except OSError:
+            return False
 
     @staticmethod
-    def init_cache(cachedir, maxslots):
+    def check_cache(cachedir):
         #
-        # First check the disk cache works at all by creating a 1 byte cache entry
+        # Check the disk cache works at all by creating a 1 byte cache entry
         #
         checkexists = DiskCacheSlot.get_from_disk('0cc175b9c0f1b6a831c399e269772661', cachedir)
         ds = DiskCacheSlot('0cc175b9c0f1b6a831c399e269772661', cachedir)
@@ -213,22 +326,130 @@ class DiskCacheSlot(object):
             # Don't keep the test entry around unless it existed beforehand.
             ds.evict()
 
-        # map in all the files in the cache directory, up to max slots.
-        # after max slots, try to delete the excess blocks.
-        #
-        # this gives the calling process ownership of all the blocks
 
+class DiskCacheIndex(object):
+    """Persistent index of the blocks in a disk cache directory
+
+    The index is a log file in the cache directory.  Each line records
+    that a block was added (or mapped again) with its size and access
+    time, or that it was removed.  Processes sharing the directory
+    append to it as they go, so starting a cache only needs to read
+    the index instead of walking and stat()ing every block.
+
+    The index is a hint: blocks may be added or removed by processes
+    that don't update it, and updates can be lost while another
+    process compacts it.  Callers must cope with blocks that are
+    missing on disk.  If the index is missing it is rebuilt by walking
+    the cache directory, so deleting it forces a rescan.
+
+    Blocks added and removed are recorded right away.  Accesses to
+    blocks already in the cache only update their place in the LRU
+    order, so they are held in memory and written along with the next
+    record, once there are ACCESS_BATCH of them, on flush(), or when
+    the process exits.
+
+    The log is compacted when it is loaded, and by the process
+    appending to it, once it grows past COMPACT_RATIO lines per block
+    it describes (plus COMPACT_SLACK).
+    """
+    FILENAME = "index"
+
+    # Compact the log when it has more than COMPACT_RATIO lines per
+    # block it describes, plus COMPACT_SLACK.
+    COMPACT_RATIO = 2
+    COMPACT_SLACK = 1024
+
+    # Write access records once this many are waiting.
+    ACCESS_BATCH = 256
+
+    def __init__(self, cachedir):
+        self.cachedir = cachedir
+        self.path = os.path.join(cachedir, self.FILENAME)
+        self._lock = threading.Lock()
+        self._pending = []
+        # Estimated number of lines in the log and blocks it
+        # describes.  Other processes append to the log too, so these
+        # are only corrected when it is read again.
+        self._lines = 0
+        self._live = 0
+        self._compacting = threading.Lock()
+        _open_indexes.add(self)
+
+    def load(self):
+        """Return the blocks in the cache
+
+        Returns an OrderedDict mapping locators to (size, atime),
+        least recently used first.
+        """
+        try:
+            entries, nlines = self._read()
+        except FileNotFoundError:
+            return self.rebuild()
+        if self._should_compact(nlines, len(entries)):
+            self._write(entries)
+            nlines = len(entries)
+        with self._lock:
+            self._lines = nlines
+            self._live = len(entries)
+        return entries
+
+    def _read(self):
+        with open(self.path, "r") as f:
+            lines = f.readlines()
+
+        entries = {}
+        for line in lines:
+            fields = line.split()
+            try:
+                if fields[0] == "+" and len(fields) == 4:
+                    entries[fields[1]] = (int(fields[2]), float(fields[3]))
+                elif fields[0] == "-" and len(fields) == 2:
+                    entries.pop(fields[1], None)
+            except (IndexError, ValueError):
+                # Ignore torn or corrupt lines
+                pass
+
+        entries = collections.OrderedDict(sorted(entries.items(), key=lambda e: e[1][1]))
+        return entries, len(lines)
+
+    def _should_compact(self, nlines, nentries):
+        return nlines > self.COMPACT_RATIO * nentries + self.COMPACT_SLACK
+
+    def compact(self):
+        """Rewrite the log with one line per block it describes"""
+        if not self._compacting.acquire(blocking=False):
+            # Another thread is already doing it.
+            return
+        try:
+            entries, _ = self._read()
+            self._write(entries)
+            with self._lock:
+                self._lines = self._live = len(entries)
+        except OSError as e:
+            _logger.debug("Unable to compact disk cache index %s: %s", self.path, e)
+        finally:
+            self._compacting.release()
+
+    def rebuild(self):
+        """Walk the cache directory and write a new index
+
+        Also cleans up temporary files left behind by processes that
+        failed while writing a block.
+        """
         blocks = []
-        for root, dirs, files in os.walk(cachedir):
+        for root, dirs, files in os.walk(self.cachedir):
             for name in files:
                 if not name.endswith(cacheblock_suffix):
                     continue
 
                 blockpath = os.path.join(root, name)
-                res = os.stat(blockpath)
+                try:
+                    res = os.stat(blockpath)
+                except FileNotFoundError:
+                    continue
 
                 if len(name) == (32+len(cacheblock_suffix)) and not name.startswith("tmp"):
-                    blocks.append((name[0:32], res.st_atime))
+                    blocks.append((name[0:32], (res.st_size, res.st_atime)))
                 elif name.startswith("tmp") and ((time.time() - res.st_mtime) > 60):
                     # found a temporary file more than 1 minute old,
                     # try to delete it.
@@ -237,23 +458,83 @@ class DiskCacheSlot(object):
                     except:
                         pass
 
-        # sort by access time (atime), going from most recently
-        # accessed (highest timestamp) to least recently accessed
-        # (lowest timestamp).
-        blocks.sort(key=lambda x: x[1], reverse=True)
-
-        # Map in all the files we found, up to maxslots, if we exceed
-        # maxslots, start throwing things out.
-        cachelist: collections.OrderedDict = collections.OrderedDict()
-        for b in blocks:
-            got = DiskCacheSlot.get_from_disk(b[0], cachedir)
-            if got is None:
-                continue
-            if len(cachelist) < maxslots:
-                cachelist[got.locator] = got
-            else:
-                # we found more blocks than maxslots, try to
-                # throw it out of the cache.
-                got.evict()
-
-        return cachelist
+        # sort by access time (atime), going from least recently
+        # accessed to most recently accessed.
+        blocks.sort(key=lambda b: b[1][1])
+        entries = collections.OrderedDict(blocks)
+        self._write(entries)
+        with self._lock:
+            self._lines = self._live = len(entries)
+        return entries
+
+    def _write(self, entries):
+        tmpname = None
+        try:
+            with tempfile.NamedTemporaryFile("w", dir=self.cachedir, prefix="tmpindex", delete=False) as f:
+                tmpname = f.name
+                for locator, (size, atime) in entries.items():
+                    f.write("+ %s %d %f\n" % (locator, size, atime))
+            os.rename(tmpname, self.path)
+        except OSError as e:
+            _logger.debug("Unable to write disk cache index %s: %s", self.path, e)
+            if tmpname is not None:
+                try:
+                    os.unlink(tmpname)
+                except OSError:
+                    pass
+
+    def _append(self, line=None, live_change=0):
+        # Write any waiting access records, then `line`.  Each batch is
+        # a single write to a file opened for appending, so records
+        # from different processes don't interleave.
+        with self._lock:
+            lines = self._pending
+            self._pending = []
+        if line is not None:
+            lines.append(line)
+        if not lines:
+            return
+        try:
+            with open(self.path, "a") as f:
+                f.write("".join(lines))
+        except OSError as e:
+            _logger.debug("Unable to update disk cache index %s: %s", self.path, e)
+            return
+        with self._lock:
+            self._lines += len(lines)
+            self._live = max(0, self._live + live_change)
+            compact = self._should_compact(self._lines, self._live)
+        if compact:
+            self.compact()
+
+    def record_add(self, locator, size):
+        """Record that a block was written to the cache"""
+        self._append("+ %s %d %f\n" % (locator, size, time.time()), 1)
+
+    def record_access(self, locator, size):
+        """Record that a block already in the cache was used
+
+        The record is written later, with the next batch.
+        """
+        with self._lock:
+            self._pending.append("+ %s %d %f\n" % (locator, size, time.time()))
+            full = len(self._pending) >= self.ACCESS_BATCH
+        if full:
+            self._append()
+
+    def record_remove(self, locator):
+        """Record that a block was removed from the cache"""
+        self._append("- %s\n" % (locator,), -1)
+
+    def flush(self):
+        """Write any access records still waiting"""
+        self._append()
+
+
+# Indexes that may have access records waiting, flushed at exit.
+_open_indexes = weakref.WeakSet()
+
+@atexit.register
+def _flush_indexes():
+    for index in list(_open_indexes):
+        index.flush()
@@ -2,6 +2,7 @@
 #
 # SPDX-License-Identifier: Apache-2.0
 
+import array
 import logging
 import re
 
@@ -31,6 +32,200 @@ class Range:
                 self.segment_offset == other.segment_offset)
 
 
+class _SegmentRef:
+    """A `Range`-like view of one row of a `SegmentTable`
+
+    Setting an attribute updates the table.  A reference is only valid
+    until the table is resized.
+    """
+    __slots__ = ("_table", "_row", "_i")
+
+    def __init__(self, table, row):
+        self._table = table
+        self._row = row
+        self._i = row * SegmentTable.FIELDS
+
+    def _field(n):
+        def get(self):
+            return self._table._ints[self._i + n]
+        def set(self, value):
+            self._table._ints[self._i + n] = value
+        return property(get, set)
+
+    range_start = _field(0)
+    range_size = _field(1)
+    segment_offset = _field(2)
+    del _field
+
+    @property
+    def locator(self):
+        return self._table._locators[self._row]
+
+    @locator.setter
+    def locator(self, value):
+        self._table._locators[self._row] = value
+
+    def __repr__(self):
+        return "Range(%r, %r, %r, %r)" % (self.locator, self.range_start, self.range_size, self.segment_offset)
+
+    __eq__ = Range.__eq__
+
+
+class SegmentTable:
+    """A compact list of file segments
+
+    This behaves like a list of `Range` objects, but keeps each
+    segment's offsets and size in one packed integer array, and its
+    locator in a parallel list.  Segments of the same block usually
+    share one locator string, so a segment takes 32 bytes instead of a
+    `Range` object and a list slot.
+
+    Indexing and iterating return `_SegmentRef` views, whose attributes
+    can be assigned like a `Range`'s.  Any object with `Range`
+    attributes can be stored.  `first_block` and `locators_and_ranges`
+    use the packed array directly when they are given a table.
+    """
+    __slots__ = ('_ints', '_locators')
+
+    FIELDS = 3
+
+    def __init__(self, segments=()):
+        self._ints = array.array('q')
+        self._locators = []
+        for r in segments:
+            self.append(r)
+
+    def _index(self, i):
+        n = len(self._locators)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError("segment index out of range")
+        return i
+
+    def __len__(self):
+        return len(self._locators)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            table = SegmentTable()
+            if step == 1:
+                table._ints = self._ints[start*self.FIELDS:max(start, stop)*self.FIELDS]
+            else:
+                for j in range(start, stop, step):
+                    table._ints.extend(self._ints[j*self.FIELDS:(j+1)*self.FIELDS])
+            table._locators = self._locators[i]
+            return table
+        return _SegmentRef(self, self._index(i))
+
+    def __setitem__(self, i, r):
+        i = self._index(i)
+        self._ints[i*self.FIELDS:(i+1)*self.FIELDS] = array.array('q', (r.range_start, r.range_size, r.segment_offset))
+        self._locators[i] = r.locator
+
+    def __delitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                raise ValueError("SegmentTable only supports contiguous slice deletion")
+            del self._ints[start*self.FIELDS:max(start, stop)*self.FIELDS]
+            del self._locators[i]
+            return
+        i = self._index(i)
+        del self._ints[i*self.FIELDS:(i+1)*self.FIELDS]
+        del self._locators[i]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield _SegmentRef(self, i)
+
+    def __bool__(self):
+        return len(self._locators) > 0
+
+    def __eq__(self, other):
+        try:
+            if len(self) != len(other):
+                return False
+        except TypeError:
+            return False
+        return all(a == b for a, b in zip(self, other))
+
+    def __copy__(self):
+        table = SegmentTable()
+        table._ints = array.array('q', self._ints)
+        table._locators = list(self._locators)
+        return table
+
+    def __repr__(self):
+        return "SegmentTable([%s])" % ", ".join(repr(r) for r in self)
+
+    def insert(self, i, r):
+        n = len(self)
+        if i < 0:
+            i = max(i + n, 0)
+        i = min(i, n)
+        self._ints[i*self.FIELDS:i*self.FIELDS] = array.array('q', (r.range_start, r.range_size, r.segment_offset))
+        self._locators.insert(i, r.locator)
+
+    def append(self, r):
+        self.append_segment(r.locator, r.range_start, r.range_size, r.segment_offset)
+
+    def extend(self, segments):
+        for r in segments:
+            self.append(r)
+
+    def append_segment(self, locator, range_start, range_size, segment_offset):
+        """Append a segment without making a `Range` for it."""
+        self._ints.extend((range_start, range_size, segment_offset))
+        self._locators.append(locator)
+
+    def get(self, i):
+        """Return segment `i` as a new `Range` object."""
+        i = self._index(i)
+        start, size, offset = self._ints[i*self.FIELDS:(i+1)*self.FIELDS]
+        return Range(self._locators[i], start, size, offset)
+
+    def first_block(self, range_start):
+        """Return the index of the segment containing `range_start`, or None."""
+        ints = self._ints
+        lo = 0
+        hi = len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = ints[mid*self.FIELDS]
+            if range_start < start:
+                hi = mid
+            elif range_start >= start + ints[mid*self.FIELDS+1]:
+                lo = mid + 1
+            else:
+                return mid
+        return None
+
+    def locators_and_ranges(self, range_start, range_size, limit=None):
+        """Same as the module-level `locators_and_ranges`, for this table."""
+        if range_size == 0:
+            return []
+        i = self.first_block(range_start)
+        if i is None:
+            return []
+        ints = self._ints
+        locators = self._locators
+        range_end = range_start + range_size
+        resp = []
+        n = len(self)
+        while i < n and len(resp) != limit:
+            block_start, block_size, segment_offset = ints[i*self.FIELDS:(i+1)*self.FIELDS]
+            if range_end <= block_start:
+                break
+            block_end = block_start + block_size
+            start = max(range_start, block_start)
+            end = min(range_end, block_end)
+            resp.append(LocatorAndRange(locators[i], block_size, segment_offset + (start - block_start), end - start))
+            i += 1
+        return resp
+
+
 class LocatorAndRange:
     __slots__ = ("locator", "block_size", "segment_offset", "segment_size")
 
@@ -51,6 +246,9 @@ class LocatorAndRange:
 
 
 def first_block(data_locators, range_start):
+    if isinstance(data_locators, SegmentTable):
+        return data_locators.first_block(range_start)
+
     block_start = 0
 
     # range_start/block_start is the inclusive lower bound
@@ -101,6 +299,8 @@ def locators_and_ranges(data_locators, range_start, range_size, limit=None):
       limit.
 
     """
+    if isinstance(data_locators, SegmentTable):
+        return data_locators.locators_and_ranges(range_start, range_size, limit)
     if range_size == 0:
         return []
     resp = []
@@ -187,8 +387,11 @@ def replace_range(data_locators, new_range_start, new_range_size, new_locator, n
 
     # We should always start at the first segment due to the binary
     # search.
+    # Segments below get overwritten while dl is still in use, so take
+    # a copy rather than a SegmentTable row reference.
+    get_segment = data_locators.get if isinstance(data_locators, SegmentTable) else data_locators.__getitem__
     while i < len(data_locators):
-        dl = data_locators[i]
+        dl = get_segment(i)
         old_segment_start = dl.range_start
         old_segment_end = old_segment_start + dl.range_size
         _logger.log(RANGES_SPAM,
@@ -14,6 +14,7 @@ import queue
 import re
 import sys
 import threading
+import time
 import uuid
 import zlib
 
@@ -261,6 +262,11 @@ class _BufferBlock(object):
         self.buffer_block = bytearray(starting_capacity)
         self.buffer_view = memoryview(self.buffer_block)
         self.write_pointer = 0
+        # Running MD5 of the first _hashed bytes of the buffer, kept
+        # up to date by append() so committing the block doesn't need
+        # another pass over it.
+        self._md5 = hashlib.md5()
+        self._hashed = 0
         self._state = _BufferBlock.WRITABLE
         self._locator = None
         self.owner = owner
@@ -285,6 +291,9 @@ class _BufferBlock(object):
                 self.buffer_block = new_buffer_block
                 self.buffer_view = memoryview(self.buffer_block)
             self.buffer_view[self.write_pointer:self.write_pointer+len(data)] = data
+            if self._hashed == self.write_pointer:
+                self._md5.update(data)
+                self._hashed += len(data)
             self.write_pointer += len(data)
             self._locator = None
         else:
@@ -323,11 +332,23 @@ class _BufferBlock(object):
         """The amount of data written to the buffer."""
         return self.write_pointer
 
+    def _md5sum(self):
+        if self._hashed < self.write_pointer:
+            # Catch up on bytes that were not added by append().
+            self._md5.update(self.buffer_view[self._hashed:self.write_pointer])
+            self._hashed = self.write_pointer
+        return self._md5.hexdigest()
+
+    @synchronized
+    def md5sum(self):
+        """The MD5 hex digest of this buffer's contents."""
+        return self._md5sum()
+
     @synchronized
     def locator(self):
         """The Keep locator for this buffer's contents."""
         if self._locator is None:
-            self._locator = "%s+%i" % (hashlib.md5(self.buffer_view[0:self.write_pointer]).hexdigest(), self.size())
+            self._locator = "%s+%i" % (self._md5sum(), self.size())
         return self._locator
 
     @synchronized
@@ -381,6 +402,8 @@ class _BufferBlock(object):
             self.buffer_block = new_bb.buffer_block
             self.buffer_view = new_bb.buffer_view
             self.write_pointer = new_bb.write_pointer
+            self._md5 = new_bb._md5
+            self._hashed = new_bb._hashed
             self._locator = None
             new_bb.clear()
             self.owner.set_segments(segs)
@@ -421,20 +444,54 @@ class _BlockManager(object):
     """
 
     DEFAULT_PUT_THREADS = 2
+    MAX_PUT_THREADS = 32
+    # Unless put_buffer_size is given, blocks queued or being uploaded
+    # may use enough memory for every upload thread to have a block,
+    # plus 2 waiting in the queue (like the old fixed queue, which
+    # allowed 2 queued + 2 uploading blocks), but no more than this.
+    MAX_DEFAULT_PUT_BUFFER_SIZE = 16 * config.KEEP_BLOCK_SIZE
+    # Stop adding upload threads once the average time per byte has
+    # grown by this factor since the last thread was added: the
+    # services are saturated and more threads won't add throughput.
+    PUT_SATURATION_FACTOR = 1.5
 
     def __init__(self, keep,
                  copies=None,
                  put_threads=None,
                  num_retries=None,
-                 storage_classes_func=None):
-        """keep: KeepClient object to use"""
+                 storage_classes_func=None,
+                 put_buffer_size=None):
+        """keep: KeepClient object to use
+
+        put_threads: number of upload threads.  If None, start with
+        DEFAULT_PUT_THREADS and add threads while uploads fall behind,
+        up to one per `copies` writable Keep services, as long as the
+        measured upload latency doesn't show the services saturating.
+
+        put_buffer_size: maximum total size of blocks waiting for or
+        in the middle of an upload.  Asynchronous commits wait while
+        it's used up.  If None, allow one block per upload thread we
+        may run, plus 2, up to MAX_DEFAULT_PUT_BUFFER_SIZE.
+        """
         self._keep = keep
         self._bufferblocks = collections.OrderedDict()
         self._put_queue = None
         self._put_threads = None
+        self._put_threads_stopping = False
         self.lock = threading.Lock()
         self.prefetch_lookahead = self._keep.num_prefetch_threads
+        self.max_range_read = getattr(self._keep, 'max_range_read', 0)
         self.num_put_threads = put_threads or _BlockManager.DEFAULT_PUT_THREADS
+        self.adaptive_put_threads = not put_threads
+        self.put_buffer_size = put_buffer_size
+        # Guards the upload accounting below.
+        self._put_cond = threading.Condition()
+        self._put_pending_size = 0
+        self._put_busy = 0
+        # Moving average of upload seconds per byte, and its value
+        # when the last thread was added.
+        self._put_latency = None
+        self._put_latency_at_grow = None
         self.copies = copies
         self.storage_classes = storage_classes_func or (lambda: [])
         self._pending_write_size = 0
@@ -489,56 +546,140 @@ class _BlockManager(object):
         """Background uploader thread."""
 
         while True:
+            bufferblock = None
+            size = 0
             try:
                 bufferblock = self._put_queue.get()
                 if bufferblock is None:
                     return
-
+                with self._put_cond:
+                    self._put_busy += 1
+                size = bufferblock.write_pointer
+                t0 = time.monotonic()
+
+                # The block is PENDING, so its buffer can't change
+                # until the upload is done.  Pass a view of it rather
+                # than a copy, along with the hash computed as it was
+                # written.
+                data = bufferblock.buffer_view[0:bufferblock.write_pointer]
                 if self.copies is None:
-                    loc = self._keep.put(bufferblock.buffer_view[0:bufferblock.write_pointer].tobytes(), num_retries=self.num_retries, classes=self.storage_classes())
+                    loc = self._keep.put(data, num_retries=self.num_retries, classes=self.storage_classes(), data_hash=bufferblock.md5sum())
                 else:
-                    loc = self._keep.put(bufferblock.buffer_view[0:bufferblock.write_pointer].tobytes(), num_retries=self.num_retries, copies=self.copies, classes=self.storage_classes())
+                    loc = self._keep.put(data, num_retries=self.num_retries, copies=self.copies, classes=self.storage_classes(), data_hash=bufferblock.md5sum())
                 bufferblock.set_state(_BufferBlock.COMMITTED, loc)
+                self._record_put_latency(time.monotonic() - t0, size)
             except Exception as e:
                 bufferblock.set_state(_BufferBlock.ERROR, e)
             finally:
+                if bufferblock is not None:
+                    with self._put_cond:
+                        self._put_busy -= 1
+                        self._put_pending_size -= size
+                        self._put_cond.notify_all()
                 if self._put_queue is not None:
                     self._put_queue.task_done()
 
+    def _record_put_latency(self, secs, size):
+        # Small blocks are dominated by per-request overhead, so don't
+        # let them make the per-byte latency look huge.
+        per_byte = secs / max(size, 2**20)
+        with self._put_cond:
+            if self._put_latency is None:
+                self._put_latency = per_byte
+            else:
+                self._put_latency = 0.7 * self._put_latency + 0.3 * per_byte
+
+    def _max_put_threads(self):
+        services = int(self._keep.writable_services_count()) if hasattr(self._keep, 'writable_services_count') else 0
+        copies = self.copies or 1
+        return max(self.DEFAULT_PUT_THREADS,
+                   min(self.MAX_PUT_THREADS, -(-services // copies)))
+
+    def _put_buffer_budget(self):
+        """Return the number of bytes pending uploads may use.
+
+        The default depends on the number of writable services, which
+        is only known once the KeepClient has loaded its services list,
+        so it is recomputed on each call.
+        """
+        if self.put_buffer_size:
+            return self.put_buffer_size
+        if self.adaptive_put_threads:
+            nthreads = self._max_put_threads()
+        else:
+            nthreads = self.num_put_threads
+        return min((nthreads + 2) * config.KEEP_BLOCK_SIZE,
+                   self.MAX_DEFAULT_PUT_BUFFER_SIZE)
+
+    def _start_put_thread(self):
+        thread = threading.Thread(target=self._commit_bufferblock_worker)
+        self._put_threads.append(thread)
+        thread.daemon = True
+        thread.start()
+
+    def _maybe_add_put_thread(self):
+        """Add an upload thread if uploads are falling behind.
+
+        Called with `_put_cond` held after queueing a block.
+        """
+        if not self.adaptive_put_threads:
+            return
+        with self.threads_lock:
+            if self._put_threads is None or self._put_threads_stopping:
+                return
+            nthreads = len(self._put_threads)
+            if (self._put_queue.qsize() == 0 or
+                self._put_busy < nthreads or
+                nthreads >= self._max_put_threads()):
+                return
+            if (self._put_latency is not None and
+                self._put_latency_at_grow is not None and
+                self._put_latency > self.PUT_SATURATION_FACTOR * self._put_latency_at_grow):
+                return
+            self._put_latency_at_grow = self._put_latency
+            self._start_put_thread()
+
     def start_put_threads(self):
         with self.threads_lock:
             if self._put_threads is None:
                 # Start uploader threads.
 
-                # If we don't limit the Queue size, the upload queue can quickly
-                # grow to take up gigabytes of RAM if the writing process is
-                # generating data more quickly than it can be sent to the Keep
-                # servers.
-                #
-                # With two upload threads and a queue size of 2, this means up to 4
-                # blocks pending.  If they are full 64 MiB blocks, that means up to
-                # 256 MiB of internal buffering, which is the same size as the
-                # default download block cache in KeepClient.
-                self._put_queue = queue.Queue(maxsize=2)
+                # If we didn't limit the memory used by queued blocks,
+                # the upload queue could quickly grow to take up
+                # gigabytes of RAM if the writing process is
+                # generating data more quickly than it can be sent to
+                # the Keep servers.  commit_bufferblock() waits for
+                # put_buffer_size before queueing, so the queue itself
+                # is unbounded.
+                self._put_queue = queue.Queue()
 
                 self._put_threads = []
                 for i in range(0, self.num_put_threads):
-                    thread = threading.Thread(target=self._commit_bufferblock_worker)
-                    self._put_threads.append(thread)
-                    thread.daemon = True
-                    thread.start()
+                    self._start_put_thread()
 
     @synchronized
     def stop_threads(self):
         """Shut down and wait for background upload and download threads to finish."""
 
-        if self._put_threads is not None:
-            for t in self._put_threads:
-                self._put_queue.put(None)
-            for t in self._put_threads:
+        with self.threads_lock:
+            put_threads = self._put_threads
+            if put_threads is not None:
+                # Once the pool is marked as stopping,
+                # _maybe_add_put_thread won't start a thread that
+                # would never get a sentinel.
+                self._put_threads_stopping = True
+                for t in put_threads:
+                    self._put_queue.put(None)
+        if put_threads is not None:
+            for t in put_threads:
                 t.join()
-        self._put_threads = None
-        self._put_queue = None
+        with self.threads_lock:
+            self._put_threads = None
+            self._put_queue = None
+            self._put_threads_stopping = False
+        with self._put_cond:
+            self._put_pending_size = 0
+            self._put_busy = 0
 
     def __enter__(self):
         return self
@@ -612,8 +753,9 @@ class _BlockManager(object):
         :sync:
           If `sync` is True, upload the block synchronously.
           If `sync` is False, upload the block asynchronously.  This will
-          return immediately unless the upload queue is at capacity, in
-          which case it will wait on an upload queue slot.
+          return immediately unless blocks waiting for upload already use
+          the upload buffer budget, in which case it will wait for some of them
+          to finish.
 
         """
         try:
@@ -634,17 +776,28 @@ class _BlockManager(object):
 
         if sync:
             try:
+                data = block.buffer_view[0:block.write_pointer]
                 if self.copies is None:
-                    loc = self._keep.put(block.buffer_view[0:block.write_pointer].tobytes(), num_retries=self.num_retries, classes=self.storage_classes())
+                    loc = self._keep.put(data, num_retries=self.num_retries, classes=self.storage_classes(), data_hash=block.md5sum())
                 else:
-                    loc = self._keep.put(block.buffer_view[0:block.write_pointer].tobytes(), num_retries=self.num_retries, copies=self.copies, classes=self.storage_classes())
+                    loc = self._keep.put(data, num_retries=self.num_retries, copies=self.copies, classes=self.storage_classes(), data_hash=block.md5sum())
                 block.set_state(_BufferBlock.COMMITTED, loc)
             except Exception as e:
                 block.set_state(_BufferBlock.ERROR, e)
                 raise
         else:
             self.start_put_threads()
-            self._put_queue.put(block)
+            size = block.write_pointer
+            budget = self._put_buffer_budget()
+            with self._put_cond:
+                # A block bigger than the whole budget still gets to
+                # go through on its own.
+                while (self._put_pending_size > 0 and
+                       self._put_pending_size + size > budget):
+                    self._put_cond.wait()
+                self._put_pending_size += size
+                self._put_queue.put(block)
+                self._maybe_add_put_thread()
 
     @synchronized
     def get_bufferblock(self, locator):
@@ -680,7 +833,9 @@ class _BlockManager(object):
         """Fetch a block.
 
         First checks to see if the locator is a BufferBlock and return that, if
-        not, passes the request through to KeepClient.get().
+        not, passes the request through to KeepClient.get().  Blocks from
+        the RAM cache are returned as read-only memoryviews of the cached
+        data, without copying it.
 
         """
         with self.lock:
@@ -691,9 +846,25 @@ class _BlockManager(object):
                 else:
                     locator = bufferblock._locator
         if cache_only:
-            return self._keep.get_from_cache(locator)
+            return self._keep.get_from_cache(locator, return_memoryview=True)
         else:
-            return self._keep.get(locator, num_retries=num_retries)
+            return self._keep.get(locator, num_retries=num_retries, return_memoryview=True)
+
+    def get_block_range(self, locator, offset, size, num_retries):
+        """Fetch part of a block.
+
+        Like get_block_contents(), but passes requests for committed
+        blocks through to KeepClient.get_range().
+
+        """
+        with self.lock:
+            if locator in self._bufferblocks:
+                bufferblock = self._bufferblocks[locator]
+                if bufferblock.state() != _BufferBlock.COMMITTED:
+                    return bufferblock.buffer_view[offset:min(offset+size, bufferblock.write_pointer)].tobytes()
+                else:
+                    locator = bufferblock._locator
+        return self._keep.get_range(locator, offset, size, num_retries=num_retries)
 
     def commit_all(self):
         """Commit all outstanding buffer blocks.
@@ -755,6 +926,126 @@ class _BlockManager(object):
         self._keep.block_prefetch(locator)
 
 
+class _Readahead(object):
+    """Detect the access pattern of a reader and decide what to prefetch.
+
+    Each read is classified as SEQUENTIAL (it is the first read, or it
+    starts where the last one ended or inside it after a short read),
+    STRIDED (it is the same nonzero distance from the last read as that
+    one was from the read before it) or RANDOM.  A sequential reader
+    stays SEQUENTIAL while its reads start within `REORDER_READS` read
+    sizes of the furthest point it has read to, since concurrent
+    requests (e.g., kernel readahead through FUSE) can arrive slightly
+    out of order.
+
+    Sequential readers get a prefetch window that starts at one block
+    past the current one and doubles each time the reader catches up
+    with it, up to the block manager's `prefetch_lookahead`.  Strided
+    readers get the blocks at their next few stride positions.  Random
+    readers get nothing, and the window starts over.
+
+    The window is only refilled once the reader gets halfway through
+    it, so most reads do nothing here beyond a few comparisons.  All
+    methods must be called with the ArvadosFile lock held.
+
+    """
+
+    SEQUENTIAL = 'sequential'
+    STRIDED = 'strided'
+    RANDOM = 'random'
+
+    REORDER_READS = 4
+
+    __slots__ = ('pattern', '_last', '_next', '_high', '_stride', '_window',
+                 '_ahead_to', '_refill_at', '_strides_ahead')
+
+    def __init__(self):
+        self.pattern = self.SEQUENTIAL
+        self._last = None
+        self._next = None
+        # Furthest offset read to in the current sequential run
+        self._high = None
+        self._stride = None
+        self._reset_window()
+
+    def _reset_window(self):
+        self._window = 0
+        # Sequential: end of the prefetched region, and the file
+        # offset at which to extend it.
+        self._ahead_to = 0
+        self._refill_at = 0
+        # Strided: number of stride positions ahead of the current
+        # read that have been prefetched.
+        self._strides_ahead = 0
+
+    def observe(self, offset, size):
+        """Record a read and return its access pattern."""
+        delta = None if self._last is None else offset - self._last
+        if delta is None or offset == self._next or 0 < delta and offset < self._next:
+            pattern = self.SEQUENTIAL
+        elif (self.pattern == self.SEQUENTIAL and
+              self._high - self.REORDER_READS * size <= offset < self._high + self.REORDER_READS * size):
+            pattern = self.SEQUENTIAL
+        elif delta and delta == self._stride:
+            pattern = self.STRIDED
+        else:
+            pattern = self.RANDOM
+        if pattern != self.pattern:
+            self._reset_window()
+            self.pattern = pattern
+        if pattern != self.SEQUENTIAL or self._high is None:
+            self._high = offset + size
+        else:
+            self._high = max(self._high, offset + size)
+        self._last = offset
+        self._next = offset + size
+        self._stride = delta
+        return pattern
+
+    def _grow(self, lookahead):
+        self._window = min(max(self._window * 2, 1), lookahead)
+
+    def prefetch(self, segments, offset, size, lookahead):
+        """Return the locators to prefetch after a read.
+
+        `segments` is the file's segment list, and the read must
+        already have been passed to `observe`.
+        """
+        if not lookahead or not segments:
+            return []
+        if self.pattern == self.SEQUENTIAL:
+            end = offset + size
+            if end <= self._refill_at:
+                return []
+            self._grow(lookahead)
+            i = streams.first_block(segments, end)
+            if i is None:
+                return []
+            # The block being read plus `window` blocks after it.
+            ahead = segments[i:i+1+self._window]
+            last = ahead[-1]
+            self._refill_at = ahead[len(ahead) // 2].range_start
+            locators = [s.locator for s in ahead
+                        if s.range_start + s.range_size > self._ahead_to]
+            self._ahead_to = last.range_start + last.range_size
+            return locators
+        elif self.pattern == self.STRIDED:
+            self._strides_ahead -= 1
+            if self._strides_ahead > self._window // 2:
+                return []
+            self._grow(lookahead)
+            file_size = segments[-1].range_start + segments[-1].range_size
+            locators = []
+            for n in range(max(self._strides_ahead, 0) + 1, self._window + 1):
+                pos = offset + self._stride * n
+                if pos < 0 or pos >= file_size:
+                    break
+                locators.extend(lr.locator for lr in streams.locators_and_ranges(segments, pos, size))
+            self._strides_ahead = self._window
+            return locators
+        return []
+
+
 class ArvadosFile(object):
     """Represent a file in a Collection.
 
@@ -767,7 +1058,7 @@ class ArvadosFile(object):
     """
 
     __slots__ = ('parent', 'name', '_writers', '_committed',
-                 '_segments', 'lock', '_current_bblock', 'fuse_entry', '_read_counter')
+                 '_segments', 'lock', '_current_bblock', 'fuse_entry', '_readahead')
 
     def __init__(self, parent, name, stream=[], segments=[]):
         """
@@ -783,16 +1074,31 @@ class ArvadosFile(object):
         self.name = name
         self._writers = set()
         self._committed = False
-        self._segments = []
-        self.lock = parent.root_collection().lock
+        root = parent.root_collection()
+        self._segments = self._new_segments(root)
+        self.lock = root.lock
         for s in segments:
             self._add_segment(stream, s.locator, s.range_size)
         self._current_bblock = None
-        self._read_counter = 0
+        self._readahead = _Readahead()
 
     def writable(self):
         return self.parent.writable()
 
+    @staticmethod
+    def _new_segments(root, segments=()):
+        """Return a segment list of the kind `root` uses, holding `segments`.
+
+        Collections created with `compact_segments` keep file segments in
+        a `streams.SegmentTable`; others use a list of `streams.Range`.
+        """
+        if getattr(root, '_compact_segments', False):
+            return streams.SegmentTable(segments)
+        elif isinstance(segments, streams.SegmentTable):
+            return [segments.get(i) for i in range(len(segments))]
+        else:
+            return list(segments)
+
     @synchronized
     def permission_expired(self, as_of_dt=None):
         """Returns True if any of the segment's locators is expired"""
@@ -831,6 +1137,7 @@ class ArvadosFile(object):
                     remote_blocks[s.locator] = loc
                 s.locator = loc
                 self.parent.set_committed(False)
+                self.parent._stream_changed()
         return remote_blocks
 
     @synchronized
@@ -852,7 +1159,7 @@ class ArvadosFile(object):
         eventtype = TOK if self == other else MOD
 
         map_loc = {}
-        self._segments = []
+        self._segments = self._new_segments(self.parent.root_collection())
         for other_segment in other.segments():
             new_loc = other_segment.locator
             if other.parent._my_block_manager().is_bufferblock(other_segment.locator):
@@ -904,7 +1211,11 @@ class ArvadosFile(object):
 
     @synchronized
     def set_segments(self, segs):
+        root = self.parent.root_collection()
+        if getattr(root, '_compact_segments', False) != isinstance(segs, streams.SegmentTable):
+            segs = self._new_segments(root, segs)
         self._segments = segs
+        self.parent._stream_changed()
 
     @synchronized
     def set_committed(self, value=True):
@@ -964,7 +1275,7 @@ class ArvadosFile(object):
 
         """
         if size < self.size():
-            new_segs = []
+            new_segs = self._new_segments(self.parent.root_collection())
             for r in self._segments:
                 range_end = r.range_start+r.range_size
                 if r.range_start >= size:
@@ -980,6 +1291,7 @@ class ArvadosFile(object):
 
             self._segments = new_segs
             self.set_committed(False)
+            self.parent._stream_changed()
         elif size > self.size():
             padding = self.parent._my_block_manager().get_padding_block()
             diff = size - self.size()
@@ -989,11 +1301,12 @@ class ArvadosFile(object):
             if diff > 0:
                 self._segments.append(streams.Range(padding.blockid, self.size(), diff, 0))
             self.set_committed(False)
+            self.parent._stream_changed()
         else:
             # size == self.size()
             pass
 
-    def readfrom(self, offset, size, num_retries, exact=False, return_memoryview=False):
+    def readfrom(self, offset, size, num_retries, exact=False, return_memoryview=False, readahead=None):
         """Read up to `size` bytes from the file starting at `offset`.
 
         Arguments:
@@ -1009,6 +1322,10 @@ class ArvadosFile(object):
           avoid making a copy, but may be incompatible with code
           expecting a `bytes` object.
 
+        * readahead: _Readahead | None --- The access pattern detector
+          for this reader.  If None (default), use the one shared by
+          all readers of this file that don't have their own.
+
         """
 
         with self.lock:
@@ -1016,31 +1333,39 @@ class ArvadosFile(object):
                 return memoryview(b'') if return_memoryview else b''
             readsegs = streams.locators_and_ranges(self._segments, offset, size)
 
-            prefetch = None
-            prefetch_lookahead = self.parent._my_block_manager().prefetch_lookahead
-            if prefetch_lookahead:
-                # Doing prefetch on every read() call is surprisingly expensive
-                # when we're trying to deliver data at 600+ MiBps and want
-                # the read() fast path to be as lightweight as possible.
-                #
-                # Only prefetching every 128 read operations
-                # dramatically reduces the overhead while still
-                # getting the benefit of prefetching (e.g. when
-                # reading 128 KiB at a time, it checks for prefetch
-                # every 16 MiB).
-                self._read_counter = (self._read_counter+1) % 128
-                if self._read_counter == 1:
-                    prefetch = streams.locators_and_ranges(
-                        self._segments,
-                        offset + size,
-                        config.KEEP_BLOCK_SIZE * prefetch_lookahead,
-                        limit=(1+prefetch_lookahead),
-                    )
+            if readahead is None:
+                readahead = self._readahead
+            first_read = readahead.pattern == _Readahead.SEQUENTIAL and readahead._last is None
+            pattern = readahead.observe(offset, size)
+
+            # Small reads that don't continue the previous read may
+            # fetch just the bytes they need from uncached blocks.  So
+            # may a small first read that doesn't start at the
+            # beginning of the file, like a one-off lookup of an index
+            # or footer; it starts a sequential run only if the next
+            # read continues it.
+            max_range_read = getattr(self.parent._my_block_manager(), 'max_range_read', 0)
+            range_read = max_range_read and (
+                pattern != _Readahead.SEQUENTIAL or
+                (first_read and offset > 0 and size <= max_range_read))
+
+            if range_read and pattern == _Readahead.SEQUENTIAL:
+                prefetch = []
+            else:
+                prefetch = readahead.prefetch(
+                    self._segments, offset, size,
+                    self.parent._my_block_manager().prefetch_lookahead)
 
         locs = set()
         data = []
         for lr in readsegs:
-            block = self.parent._my_block_manager().get_block_contents(lr.locator, num_retries=num_retries, cache_only=(bool(data) and not exact))
+            cache_only = bool(data) and not exact
+            if range_read and not cache_only and lr.segment_size <= max_range_read:
+                block = self.parent._my_block_manager().get_block_range(lr.locator, lr.segment_offset, lr.segment_size, num_retries=num_retries)
+                data.append(memoryview(block))
+                locs.add(lr.locator)
+                continue
+            block = self.parent._my_block_manager().get_block_contents(lr.locator, num_retries=num_retries, cache_only=cache_only)
             if block:
                 blockview = memoryview(block)
                 data.append(blockview[lr.segment_offset:lr.segment_offset+lr.segment_size])
@@ -1048,11 +1373,10 @@ class ArvadosFile(object):
             else:
                 break
 
-        if prefetch:
-            for lr in prefetch:
-                if lr.locator not in locs:
-                    self.parent._my_block_manager().block_prefetch(lr.locator)
-                    locs.add(lr.locator)
+        for locator in prefetch:
+            if locator not in locs:
+                self.parent._my_block_manager().block_prefetch(locator)
+                locs.add(locator)
 
         if len(data) == 1:
             return data[0] if return_memoryview else data[0].tobytes()
@@ -1153,6 +1477,7 @@ class ArvadosFile(object):
 
         """
         self._add_segment(blocks, pos, size)
+        self.parent._stream_changed()
 
     def _add_segment(self, blocks, pos, size):
         """Internal implementation of add_segment."""
@@ -1202,7 +1527,9 @@ class ArvadosFile(object):
         self.parent.remove(self.name)
         self.parent = newparent
         self.name = newname
-        self.lock = self.parent.root_collection().lock
+        root = self.parent.root_collection()
+        self.lock = root.lock
+        self._segments = self._new_segments(root, self._segments)
 
 
 class ArvadosFileReader(ArvadosFileReaderBase):
@@ -1216,6 +1543,7 @@ class ArvadosFileReader(ArvadosFileReaderBase):
     def __init__(self, arvadosfile, mode="r", num_retries=None):
         super(ArvadosFileReader, self).__init__(arvadosfile.name, mode=mode, num_retries=num_retries)
         self.arvadosfile = arvadosfile
+        self._readahead = _Readahead()
 
     def size(self):
         return self.arvadosfile.size()
@@ -1249,14 +1577,14 @@ class ArvadosFileReader(ArvadosFileReaderBase):
             # specify exact=False, return_memoryview=True here so that we
             # only copy data once into the final buffer.
             #
-            rd = self.arvadosfile.readfrom(self._filepos, config.KEEP_BLOCK_SIZE, num_retries, exact=False, return_memoryview=True)
+            rd = self.arvadosfile.readfrom(self._filepos, config.KEEP_BLOCK_SIZE, num_retries, exact=False, return_memoryview=True, readahead=self._readahead)
             while rd:
                 data.append(rd)
                 self._filepos += len(rd)
-                rd = self.arvadosfile.readfrom(self._filepos, config.KEEP_BLOCK_SIZE, num_retries, exact=False, return_memoryview=True)
+                rd = self.arvadosfile.readfrom(self._filepos, config.KEEP_BLOCK_SIZE, num_retries, exact=False, return_memoryview=True, readahead=self._readahead)
             return memoryview(b''.join(data)) if return_memoryview else b''.join(data)
         else:
-            data = self.arvadosfile.readfrom(self._filepos, size, num_retries, exact=True, return_memoryview=return_memoryview)
+            data = self.arvadosfile.readfrom(self._filepos, size, num_retries, exact=True, return_memoryview=return_memoryview, readahead=self._readahead)
             self._filepos += len(data)
             return data
 
@@ -1272,7 +1600,7 @@ class ArvadosFileReader(ArvadosFileReaderBase):
         unnecessary data copy in some situations.
 
         """
-        return self.arvadosfile.readfrom(offset, size, num_retries, exact=True, return_memoryview=return_memoryview)
+        return self.arvadosfile.readfrom(offset, size, num_retries, exact=True, return_memoryview=return_memoryview, readahead=self._readahead)
 
     def flush(self):
         pass
@@ -12,6 +12,7 @@ cookbook for [an introduction to using the Collection class][cookbook].
 [cookbook]: https://doc.arvados.org/sdk/python/cookbook.html#working-with-collections
 """
 
+import bisect
 import ciso8601
 import datetime
 import errno
@@ -30,7 +31,7 @@ from stat import *
 
 from ._internal import streams
 from .api import ThreadSafeAPIClient
-from .arvfile import split, _FileLikeObjectBase, ArvadosFile, ArvadosFileWriter, ArvadosFileReader, WrappableFile, _BlockManager, synchronized, must_be_writable, NoopLock, ADD, DEL, MOD, TOK, WRITE
+from .arvfile import split, _FileLikeObjectBase, ArvadosFile, ArvadosFileWriter, ArvadosFileReader, WrappableFile, _BlockManager, _BufferBlock, synchronized, must_be_writable, NoopLock, ADD, DEL, MOD, TOK, WRITE
 from .keep import KeepLocator, KeepClient
 import arvados.config as config
 import arvados.errors as errors
@@ -157,7 +158,88 @@ class RichCollectionBase(CollectionBase):
         self._committed = False
         self._has_remote_blocks = False
         self._callback = None
-        self._items = {}
+        self._loaded_items = {}
+        # Manifest lines for this stream that haven't been parsed yet, as
+        # (start, end) offsets into _pending_text.  See Collection(lazy=True).
+        self._pending = None
+        self._pending_text = None
+        # Rendered manifest text for this collection's own stream, as
+        # (stream_name, strip, only_committed, text, subdirectory names).
+        # only_committed is None if the text doesn't depend on it.  Cleared
+        # whenever a file or the set of items here changes.
+        self._stream_text = None
+
+    @property
+    def _items(self):
+        if self._pending is not None:
+            self._load_pending()
+        return self._loaded_items
+
+    def _load_pending(self):
+        """Parse the manifest lines deferred for this stream.
+
+        Files created here are not reported to subscribers and are marked
+        committed, since they were part of the manifest all along.
+        """
+        root = self.root_collection()
+        with root._pending_lock:
+            if self._pending is None:
+                return
+            try:
+                text = self._pending_text
+                for start, end in self._pending:
+                    tokens = text[start:end].split()
+                    stream_name = root._unescape_manifest_path(tokens[0])
+                    root._import_stream(tokens, stream_name,
+                                        functools.partial(self._pending_file, stream_name))
+                for item in self._loaded_items.values():
+                    if isinstance(item, ArvadosFile):
+                        item._committed = True
+            finally:
+                self._pending = None
+                self._pending_text = None
+
+    def _pending_file(self, stream_name, name):
+        if name == '.':
+            # placeholder for persisting an empty directory, not a real file
+            return None
+        item = self._loaded_items.get(name)
+        if item is None:
+            item = ArvadosFile(self, name)
+            self._loaded_items[name] = item
+        elif not isinstance(item, ArvadosFile):
+            raise errors.SyntaxError("File %s conflicts with stream of the same name.", os.path.join(stream_name, name))
+        return item
+
+    def _pending_manifest_text(self, stream_name, only_committed):
+        """Get the manifest text for a stream whose lines haven't been parsed.
+
+        The stream's own lines are copied back as they were, followed by its
+        subdirectories.
+        """
+        pending = self._pending
+        text = self._pending_text
+        buf = []
+        stream_token = streams.escape(stream_name)
+        for start, end in pending:
+            fields = text[start:end].split(None, 1)
+            buf.append("%s %s\n" % (stream_token, fields[1].rstrip()))
+        for name in sorted(self._loaded_items):
+            buf.append(self._loaded_items[name].manifest_text(
+                stream_name=os.path.join(stream_name, name),
+                strip=False, normalize=False, only_committed=only_committed))
+        return "".join(buf)
+
+    def _get_item(self, name):
+        """Get a child item for a path lookup.
+
+        Deferred manifest lines only hold files, so this doesn't parse them
+        to find a subdirectory.
+        """
+        item = self._loaded_items.get(name)
+        if item is None and self._pending is not None:
+            item = self._items.get(name)
+        return item
 
     def _my_api(self):
         raise NotImplementedError()
@@ -201,8 +283,11 @@ class RichCollectionBase(CollectionBase):
         """
         if self._has_remote_blocks:
             return True
-        for item in self:
-            if self[item].has_remote_blocks():
+        pending = self._pending
+        if pending and any('+R' in self._pending_text[start:end] for start, end in pending):
+            return True
+        for item in list(self._loaded_items.values()):
+            if item.has_remote_blocks():
                 return True
         return False
 
@@ -249,7 +334,7 @@ class RichCollectionBase(CollectionBase):
         """
         pathcomponents = path.split("/", 1)
         if pathcomponents[0]:
-            item = self._items.get(pathcomponents[0])
+            item = self._get_item(pathcomponents[0])
             if len(pathcomponents) == 1:
                 if item is None:
                     # create new file
@@ -307,7 +392,7 @@ class RichCollectionBase(CollectionBase):
         if pathcomponents[0] == '':
             raise IOError(errno.ENOTDIR, "Not a directory", pathcomponents[0])
 
-        item = self._items.get(pathcomponents[0])
+        item = self._get_item(pathcomponents[0])
         if item is None:
             return None
         elif len(pathcomponents) == 1:
@@ -419,7 +504,7 @@ class RichCollectionBase(CollectionBase):
         if value == self._committed:
             return
         if value:
-            for k,v in self._items.items():
+            for k,v in self._loaded_items.items():
                 v.set_committed(True)
             self._committed = True
         else:
@@ -788,34 +873,24 @@ class RichCollectionBase(CollectionBase):
         """
 
         if not self.committed() or self._manifest_text is None or normalize:
-            stream = {}
-            buf = []
-            sorted_keys = sorted(self.keys())
-            for filename in [s for s in sorted_keys if isinstance(self[s], ArvadosFile)]:
-                # Create a stream per file `k`
-                arvfile = self[filename]
-                filestream = []
-                for segment in arvfile.segments():
-                    loc = segment.locator
-                    if arvfile.parent._my_block_manager().is_bufferblock(loc):
-                        if only_committed:
-                            continue
-                        loc = arvfile.parent._my_block_manager().get_bufferblock(loc).locator()
-                    if strip:
-                        loc = KeepLocator(loc).stripped()
-                    filestream.append(streams.LocatorAndRange(
-                        loc,
-                        KeepLocator(loc).size,
-                        segment.segment_offset,
-                        segment.range_size,
-                    ))
-                stream[filename] = filestream
-            if stream:
-                buf.append(" ".join(streams.normalize_stream(stream_name, stream)) + "\n")
-            for dirname in [s for s in sorted_keys if isinstance(self[s], RichCollectionBase)]:
-                buf.append(self[dirname].manifest_text(
-                    stream_name=os.path.join(stream_name, dirname),
-                    strip=strip, normalize=True, only_committed=only_committed))
+            if self._pending is not None and not (strip or normalize):
+                return self._pending_manifest_text(stream_name, only_committed)
+            cached = self._stream_text
+            if (cached is not None and cached[:2] == (stream_name, strip) and
+                cached[2] in (None, only_committed)):
+                stream_text, dirnames = cached[3:]
+            else:
+                stream_text, dirnames, cacheable, uses_bufferblocks = self._render_stream(
+                    stream_name, strip, only_committed)
+                if cacheable:
+                    self._stream_text = (stream_name, strip,
+                                         only_committed if uses_bufferblocks else None,
+                                         stream_text, dirnames)
+            buf = [stream_text]
+            for dirname in dirnames:
+                buf.append(self._items[dirname]._get_manifest_text(
+                    os.path.join(stream_name, dirname),
+                    strip, normalize, only_committed))
             return "".join(buf)
         else:
             if strip:
@@ -823,6 +898,62 @@ class RichCollectionBase(CollectionBase):
             else:
                 return self._manifest_text
 
+    def _render_stream(self, stream_name, strip, only_committed):
+        """Render the normalized manifest line for this collection's files.
+
+        Returns the line (empty if there are no files), the sorted names of
+        the subdirectories, whether the line may be cached, and whether it
+        refers to any buffer blocks.  It may not be cached if it refers to
+        buffer blocks that are still being written or uploaded, since their
+        locators can still change.
+        """
+        block_manager = None
+        # locator -> (locator to write, block size)
+        blocks = {}
+        stream = {}
+        dirnames = []
+        cacheable = True
+        uses_bufferblocks = False
+        for name in sorted(self._items):
+            item = self._items[name]
+            if not isinstance(item, ArvadosFile):
+                if isinstance(item, RichCollectionBase):
+                    dirnames.append(name)
+                continue
+            filestream = []
+            for segment in item.segments():
+                loc = segment.locator
+                if block_manager is None:
+                    block_manager = self._my_block_manager()
+                bufferblock = block_manager.get_bufferblock(loc)
+                if bufferblock is not None:
+                    uses_bufferblocks = True
+                    if bufferblock.state() != _BufferBlock.COMMITTED:
+                        cacheable = False
+                    if only_committed:
+                        continue
+                    loc = bufferblock.locator()
+                block = blocks.get(loc)
+                if block is None:
+                    locator = KeepLocator(loc)
+                    block = blocks[loc] = (locator.stripped() if strip else loc, locator.size)
+                filestream.append(streams.LocatorAndRange(
+                    block[0],
+                    block[1],
+                    segment.segment_offset,
+                    segment.range_size,
+                ))
+            stream[name] = filestream
+        if stream:
+            stream_text = " ".join(streams.normalize_stream(stream_name, stream)) + "\n"
+        else:
+            stream_text = ""
+        return stream_text, dirnames, cacheable, uses_bufferblocks
+
+    def _stream_changed(self):
+        """Discard the cached manifest text for this collection's own stream."""
+        self._stream_text = None
+
     @synchronized
     def _copy_remote_blocks(self, remote_blocks={}):
         """Scan through the entire collection and ask Keep to copy remote blocks.
@@ -1009,6 +1140,7 @@ class RichCollectionBase(CollectionBase):
           being modified in place or replaced).
 
         """
+        collection._stream_changed()
         if self._callback:
             self._callback(event, collection, name, item)
         self.root_collection().notify(event, collection, name, item)
@@ -1036,7 +1168,7 @@ class RichCollectionBase(CollectionBase):
     @synchronized
     def flush(self) -> None:
         """Upload any pending data to Keep"""
-        for e in self.values():
+        for e in list(self._loaded_items.values()):
             e.flush()
 
 
@@ -1059,7 +1191,10 @@ class Collection(RichCollectionBase):
                  block_manager: Optional['arvados.arvfile._BlockManager']=None,
                  replication_desired: Optional[int]=None,
                  storage_classes_desired: Optional[List[str]]=None,
-                 put_threads: Optional[int]=None):
+                 put_threads: Optional[int]=None,
+                 put_buffer_size: Optional[int]=None,
+                 lazy: bool=False,
+                 compact_segments: bool=False):
         """Initialize a Collection object
 
         Arguments:
@@ -1119,7 +1254,28 @@ class Collection(RichCollectionBase):
         * put_threads: int | None --- The number of threads to run
           simultaneously to upload data blocks to Keep. This value is used when
           building a new `block_manager`. It is unused when a `block_manager`
-          is provided.
+          is provided. If none is given, the number of threads adapts to
+          upload latency and the number of writable Keep services.
+
+        * put_buffer_size: int | None --- The maximum number of bytes of
+          data blocks waiting to be uploaded to Keep at once. This value is
+          used when building a new `block_manager`. It is unused when a
+          `block_manager` is provided. If none is given, there is room for
+          one block per upload thread plus two, up to 1 GiB.
+
+        * lazy: bool --- If `True`, each stream of the manifest is only
+          parsed into file objects when something first looks inside it,
+          and `manifest_text` copies streams that were never looked at back
+          as they were. This makes opening a few files in a very large
+          collection much cheaper. Errors in a stream's file segments are
+          raised when that stream is first read rather than here. Default
+          `False`.
+
+        * compact_segments: bool --- If `True`, each file keeps its segments
+          in a packed `streams.SegmentTable` instead of a list of `Range`
+          objects. This takes less than half the memory for files with many
+          segments, at the cost of slower access to individual segments.
+          Default `False`.
         """
 
         if storage_classes_desired and type(storage_classes_desired) is not list:
@@ -1137,6 +1293,9 @@ class Collection(RichCollectionBase):
         self.replication_desired = replication_desired
         self._storage_classes_desired = storage_classes_desired
         self.put_threads = put_threads
+        self.put_buffer_size = put_buffer_size
+        self._lazy = lazy
+        self._compact_segments = compact_segments
 
         if apiconfig:
             self._config = apiconfig
@@ -1152,6 +1311,8 @@ class Collection(RichCollectionBase):
 
         self.lock = threading.RLock()
         self.events = None
+        # Serializes parsing deferred manifest lines (see `lazy`).
+        self._pending_lock = threading.Lock()
 
         if manifest_locator_or_text:
             if re.match(arvados.util.keep_locator_pattern, manifest_locator_or_text):
@@ -1327,6 +1488,7 @@ class Collection(RichCollectionBase):
             self._block_manager = _BlockManager(self._my_keep(),
                                                 copies=copies,
                                                 put_threads=self.put_threads,
+                                                put_buffer_size=self.put_buffer_size,
                                                 num_retries=self.num_retries,
                                                 storage_classes_func=self.storage_classes_desired)
         return self._block_manager
@@ -1703,8 +1865,151 @@ class Collection(RichCollectionBase):
     _segment_re = re.compile(r'(\d+):(\d+):(\S+)')
 
     def _unescape_manifest_path(self, path):
+        if '\\' not in path:
+            return path
         return re.sub(r'\\([0-3][0-7][0-7])', lambda m: chr(int(m.group(1), 8)), path)
 
+    def _manifest_file(self, stream, stream_name, name):
+        """Find or create the file named by a manifest file segment.
+
+        `stream` is the stream's collection, if it is one.  Names in a
+        subcollection are looked up there rather than from the root.
+        Returns None for the placeholder files that record empty
+        directories.
+        """
+        if stream is None or stream is self or name.startswith('/'):
+            stream, prefix = self, stream_name
+        else:
+            prefix = ''
+        if name.split('/')[-1] == '.':
+            # placeholder for persisting an empty directory, not a real file
+            if len(name) > 2:
+                stream.find_or_create(os.path.join(prefix, name[:-2]), COLLECTION)
+            return None
+        try:
+            afile = stream.find_or_create(os.path.join(prefix, name), FILE)
+        except IOError as e:
+            if e.errno == errno.ENOTDIR:
+                raise errors.SyntaxError("Dir part of %s conflicts with file of the same name.", os.path.join(stream_name, name)) from None
+            else:
+                raise e from None
+        if not isinstance(afile, ArvadosFile):
+            raise errors.SyntaxError("File %s conflicts with stream of the same name.", os.path.join(stream_name, name))
+        return afile
+
+    def _pending_stream(self, stream_name):
+        """Get the collection to defer a manifest line for `stream_name` to.
+
+        Missing directories on the way are created without parsing any
+        other deferred lines.  Returns None if the line has to be imported
+        now: the stream's collection is already loaded, or the name is one
+        that `find_or_create` would not resolve one directory at a time.
+        """
+        if stream_name == '.':
+            stream = self
+        elif stream_name.startswith('./'):
+            stream = self
+            for name in stream_name[2:].split('/'):
+                if not name:
+                    return None
+                item = stream._loaded_items.get(name)
+                if item is None:
+                    item = Subcollection(stream, name)
+                    item._pending = []
+                    stream._loaded_items[name] = item
+                elif not isinstance(item, RichCollectionBase):
+                    return None
+                stream = item
+        else:
+            return None
+        if stream._pending is None:
+            return None
+        return stream
+
+    def _import_stream(self, tokens, stream_name, get_file):
+        """Add the file segments of one manifest line to their files.
+
+        `tokens` is the line split on whitespace.  `get_file` is called once
+        with each unescaped file name, and returns its `ArvadosFile`, or
+        None for an empty directory placeholder.
+
+        A segment's first block is found by bisecting the stream's block
+        offsets, and each file is looked up once per line rather than once
+        per segment.
+        """
+        Range = streams.Range
+        SegmentTable = streams.SegmentTable
+        block_match = self._block_re.match
+        segment_match = self._segment_re.match
+        bisect_right = bisect.bisect_right
+
+        starts = []
+        sizes = []
+        locators = []
+        streamoffset = 0
+        ntokens = len(tokens)
+        i = 1
+        while i < ntokens:
+            tok = tokens[i]
+            block_locator = block_match(tok)
+            if not block_locator:
+                break
+            blocksize = int(block_locator.group(1))
+            starts.append(streamoffset)
+            sizes.append(blocksize)
+            locators.append(tok)
+            streamoffset += blocksize
+            i += 1
+        nblocks = len(starts)
+
+        # name -> (ArvadosFile, its segments, file size so far)
+        files = {}
+        while i < ntokens:
+            tok = tokens[i]
+            i += 1
+            file_segment = segment_match(tok)
+            if not file_segment:
+                # error!
+                raise errors.SyntaxError("Invalid manifest format, expected file segment but did not match format: '%s'" % tok)
+            pos = int(file_segment.group(1))
+            size = int(file_segment.group(2))
+            name = file_segment.group(3)
+            entry = files.get(name)
+            if entry is None:
+                afile = get_file(self._unescape_manifest_path(name))
+                if afile is None:
+                    entry = (None, None, 0)
+                else:
+                    segs = afile._segments
+                    filesize = 0
+                    if segs:
+                        last = segs[-1]
+                        filesize = last.range_start + last.range_size
+                    entry = (afile, segs, filesize)
+                files[name] = entry
+            afile, segs, filesize = entry
+            if afile is None or size == 0:
+                continue
+
+            # Take each block that overlaps [pos, pos+size), starting
+            # from the one that contains pos.
+            end = pos + size
+            b = bisect_right(starts, pos) - 1
+            if b < 0 or pos >= starts[b] + sizes[b]:
+                continue
+            while b < nblocks and starts[b] < end:
+                blockstart = starts[b]
+                segstart = pos if pos > blockstart else blockstart
+                segend = min(end, blockstart + sizes[b])
+                segsize = segend - segstart
+                if isinstance(segs, SegmentTable):
+                    segs.append_segment(locators[b], filesize, segsize, segstart - blockstart)
+                else:
+                    segs.append(Range(locators[b], filesize, segsize, segstart - blockstart))
+                filesize += segsize
+                b += 1
+            files[name] = (afile, segs, filesize)
+
     @synchronized
     def _import_manifest(self, manifest_text):
         """Import a manifest into a `Collection`.
@@ -1712,70 +2017,51 @@ class Collection(RichCollectionBase):
         :manifest_text:
           The manifest text to import from.
 
+        The manifest is parsed in one pass, a line at a time.  If this
+        collection is lazy, a line whose file names are all directly in its
+        stream is not parsed here: its offsets are saved on the stream's
+        collection, which parses it the first time its contents are needed.
+
         """
         if len(self) > 0:
             raise ArgumentError("Can only import manifest into an empty collection")
 
-        STREAM_NAME = 0
-        BLOCKS = 1
-        SEGMENTS = 2
-
-        stream_name = None
-        state = STREAM_NAME
-
-        for token_and_separator in self._token_re.finditer(manifest_text):
-            tok = token_and_separator.group(1)
-            sep = token_and_separator.group(2)
-
-            if state == STREAM_NAME:
-                # starting a new stream
-                stream_name = self._unescape_manifest_path(tok)
-                blocks = []
-                segments = []
-                streamoffset = 0
-                state = BLOCKS
-                self.find_or_create(stream_name, COLLECTION)
+        lazy = self._lazy
+        if lazy:
+            self._pending = []
+        unescape = self._unescape_manifest_path
+
+        linestart = 0
+        textlen = len(manifest_text)
+        while linestart < textlen:
+            lineend = manifest_text.find("\n", linestart)
+            if lineend < 0:
+                lineend = textlen
+            start = linestart
+            linestart = lineend + 1
+
+            if lazy:
+                fields = manifest_text[start:lineend].split(None, 1)
+                if not fields:
+                    continue
+                if len(fields) == 2 and '/' not in fields[1]:
+                    stream = self._pending_stream(unescape(fields[0]))
+                    if stream is not None:
+                        stream._pending.append((start, lineend))
+                        stream._pending_text = manifest_text
+                        continue
+
+            tokens = manifest_text[start:lineend].split()
+            if not tokens:
                 continue
 
-            if state == BLOCKS:
-                block_locator = self._block_re.match(tok)
-                if block_locator:
-                    blocksize = int(block_locator.group(1))
-                    blocks.append(streams.Range(tok, streamoffset, blocksize, 0))
-                    streamoffset += blocksize
-                else:
-                    state = SEGMENTS
-
-            if state == SEGMENTS:
-                file_segment = self._segment_re.match(tok)
-                if file_segment:
-                    pos = int(file_segment.group(1))
-                    size = int(file_segment.group(2))
-                    name = self._unescape_manifest_path(file_segment.group(3))
-                    if name.split('/')[-1] == '.':
-                        # placeholder for persisting an empty directory, not a real file
-                        if len(name) > 2:
-                            self.find_or_create(os.path.join(stream_name, name[:-2]), COLLECTION)
-                    else:
-                        filepath = os.path.join(stream_name, name)
-                        try:
-                            afile = self.find_or_create(filepath, FILE)
-                        except IOError as e:
-                            if e.errno == errno.ENOTDIR:
-                                raise errors.SyntaxError("Dir part of %s conflicts with file of the same name.", filepath) from None
-                            else:
-                                raise e from None
-                        if isinstance(afile, ArvadosFile):
-                            afile.add_segment(blocks, pos, size)
-                        else:
-                            raise errors.SyntaxError("File %s conflicts with stream of the same name.", filepath)
-                else:
-                    # error!
-                    raise errors.SyntaxError("Invalid manifest format, expected file segment but did not match format: '%s'" % tok)
-
-            if sep == "\n":
-                stream_name = None
-                state = STREAM_NAME
+            # starting a new stream
+            stream_name = unescape(tokens[0])
+            stream = self.find_or_create(stream_name, COLLECTION)
+            if not isinstance(stream, RichCollectionBase):
+                stream = None
+            self._import_stream(tokens, stream_name,
+                                functools.partial(self._manifest_file, stream, stream_name))
 
         self._update_token_timestamp()
         self.set_committed(True)
@@ -1788,6 +2074,7 @@ class Collection(RichCollectionBase):
             name: str,
             item: CollectionItem,
     ) -> None:
+        collection._stream_changed()
         if self._callback:
             self._callback(event, collection, name, item)
 
@@ -1849,6 +2136,8 @@ class Subcollection(RichCollectionBase):
     @synchronized
     def _get_manifest_text(self, stream_name, strip, normalize, only_committed=False):
         """Encode empty directories by using an \056-named (".") empty file"""
+        if self._pending is not None and not (strip or normalize):
+            return self._pending_manifest_text(stream_name, only_committed)
         if len(self._items) == 0:
             return "%s %s 0:0:\\056\n" % (
                 streams.escape(stream_name), config.EMPTY_BLOCK_LOCATOR)
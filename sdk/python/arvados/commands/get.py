@@ -4,12 +4,14 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import argparse
+import collections
 import hashlib
 import os
 import pathlib
 import re
 import string
 import sys
+import threading
 import logging
 
 import arvados
@@ -107,6 +109,13 @@ def get_argument_parser():
     On high latency installations, using a greater number will improve
     overall throughput.
     """)
+    parser.add_argument('--file-threads', type=int, metavar='N', default=4,
+                        help="""
+    Set the number of files to read from Keep at once. Files are still
+    written, hashed and reported one at a time in collection order, while
+    the next ones are read ahead into a buffer of at most two Keep blocks
+    shared by all of them. Default is 4 files.
+    """)
     return parser
 
 
@@ -128,6 +137,9 @@ def parse_arguments(arguments, stdout, stderr):
         logger.debug("Appended source file name to destination directory: %s",
                      args.destination)
 
+    if args.file_threads < 1:
+        parser.error('--file-threads must be at least 1.')
+
     if args.destination == '/dev/stdout':
         args.destination = "-"
 
@@ -248,35 +260,47 @@ def main(arguments=None, stdout=sys.stdout, stderr=sys.stderr):
         logger.error(e)
         sys.exit(1)
 
-    out_bytes = 0
-    for s, f, outfilename in todo:
-        outfile = None
-        digestor = None
-        if not args.n:
-            if outfilename == "-":
-                outfile = stdout
+    if args.skip_existing and not args.n:
+        # Don't read files from Keep only to skip them.
+        remaining = []
+        for s, f, outfilename in todo:
+            if outfilename != "-" and os.path.exists(outfilename):
+                logger.debug('Local file %s exists. Skipping.', outfilename)
             else:
-                if args.skip_existing and os.path.exists(outfilename):
-                    logger.debug('Local file %s exists. Skipping.', outfilename)
-                    continue
-                elif not args.f and (os.path.isfile(outfilename) or
-                                   os.path.isdir(outfilename)):
-                    # Good thing we looked again: apparently this file wasn't
-                    # here yet when we checked earlier.
-                    logger.error('Local file %s already exists.' % (outfilename,))
-                    sys.exit(1)
-                if args.r:
-                    pathlib.Path(outfilename).parent.mkdir(parents=True, exist_ok=True)
-                try:
-                    outfile = open(outfilename, 'wb')
-                except Exception as error:
-                    logger.error('Open(%s) failed: %s' % (outfilename, error))
-                    sys.exit(1)
-        if args.hash:
-            digestor = hashlib.new(args.hash)
-        try:
-            with s.open(f.name, 'rb') as file_reader:
-                for data in file_reader.readall():
+                remaining.append((s, f, outfilename))
+        todo = remaining
+
+    read_ahead = ReadAhead(todo, args.file_threads, num_retries=args.retries)
+    out_bytes = 0
+    try:
+        for index, (s, f, outfilename) in enumerate(todo):
+            outfile = None
+            digestor = None
+            if not args.n:
+                if outfilename == "-":
+                    outfile = stdout
+                else:
+                    if args.skip_existing and os.path.exists(outfilename):
+                        logger.debug('Local file %s exists. Skipping.', outfilename)
+                        read_ahead.skip(index)
+                        continue
+                    elif not args.f and (os.path.isfile(outfilename) or
+                                       os.path.isdir(outfilename)):
+                        # Good thing we looked again: apparently this file wasn't
+                        # here yet when we checked earlier.
+                        logger.error('Local file %s already exists.' % (outfilename,))
+                        sys.exit(1)
+                    if args.r:
+                        pathlib.Path(outfilename).parent.mkdir(parents=True, exist_ok=True)
+                    try:
+                        outfile = open(outfilename, 'wb')
+                    except Exception as error:
+                        logger.error('Open(%s) failed: %s' % (outfilename, error))
+                        sys.exit(1)
+            if args.hash:
+                digestor = hashlib.new(args.hash)
+            try:
+                for data in read_ahead.chunks(index):
                     if outfile:
                         outfile.write(data)
                     if digestor:
@@ -293,21 +317,144 @@ def main(arguments=None, stdout=sys.stdout, stderr=sys.stderr):
                         stderr.write('%s %d read %d total %d\n' %
                                      (sys.argv[0], os.getpid(),
                                       out_bytes, todo_bytes))
-            if digestor:
-                stderr.write("%s  %s/%s\n"
-                             % (digestor.hexdigest(), s.stream_name(), f.name))
-        except KeyboardInterrupt:
-            if outfile and (outfile.fileno() > 2) and not outfile.closed:
-                os.unlink(outfile.name)
-            break
-        finally:
-            if outfile != None and outfile != stdout:
-                outfile.close()
+                if digestor:
+                    stderr.write("%s  %s/%s\n"
+                                 % (digestor.hexdigest(), s.stream_name(), f.name))
+            except KeyboardInterrupt:
+                if outfile and (outfile.fileno() > 2) and not outfile.closed:
+                    os.unlink(outfile.name)
+                break
+            finally:
+                if outfile != None and outfile != stdout:
+                    outfile.close()
+    finally:
+        read_ahead.close()
 
     if args.progress:
         stderr.write('\n')
     sys.exit(0)
 
+class ReadAhead(object):
+    """Read files from Keep ahead of writing them out.
+
+    Up to `threads` files from `todo`, a list of (stream, file, local
+    destination filename) tuples, are read at once, each by its own
+    thread. The data read and not yet written out is limited to `budget`
+    bytes in total, except that the reader of the file being written out
+    may always read one more chunk, so it can't be held up by files
+    further ahead.
+
+    The caller takes each file's data from `chunks()`, or passes it over
+    with `skip()`, in `todo` order, then calls `close()`.
+    """
+    CHUNK_SIZE = 2**20
+
+    def __init__(self, todo, threads, budget=None, num_retries=None):
+        self._todo = todo
+        self._budget = budget or 2 * arvados.config.KEEP_BLOCK_SIZE
+        self._num_retries = num_retries
+        self._cond = threading.Condition()
+        self._held = 0
+        # Chunks read from each file being read and not yet taken: each
+        # one data, an exception raised by the reader, or b'' at the end.
+        self._chunks = {}
+        self._next = 0 # Next file to start reading
+        self._head = 0 # File being written out, or next to be
+        self._stop = False
+        for _ in range(min(threads, len(todo))):
+            reader = threading.Thread(target=self._reader)
+            reader.daemon = True
+            reader.start()
+
+    def _reader(self):
+        while True:
+            with self._cond:
+                # Files already passed over don't need to be read.
+                self._next = max(self._next, self._head)
+                if self._stop or self._next >= len(self._todo):
+                    return
+                index = self._next
+                self._next += 1
+                self._chunks[index] = collections.deque()
+            s, f, _ = self._todo[index]
+            size = 0
+            try:
+                with s.open(f.name, 'rb') as file_reader:
+                    remaining = f.size()
+                    while True:
+                        size = min(self.CHUNK_SIZE, remaining)
+                        if not self._reserve(index, size):
+                            break
+                        data = file_reader.read(size, num_retries=self._num_retries)
+                        self._put(index, data, size)
+                        size = 0
+                        if not data:
+                            break
+                        remaining -= len(data)
+            except Exception as error:
+                self._put(index, error, size)
+
+    def _reserve(self, index, size):
+        """Wait for room in the budget for `size` more bytes of file `index`.
+
+        Returns False if the file doesn't need to be read any more.
+        """
+        with self._cond:
+            while not (self._stop or index < self._head or
+                       self._held + size <= self._budget or
+                       (index == self._head and not self._chunks[index])):
+                self._cond.wait()
+            if self._stop or index < self._head:
+                return False
+            self._held += size
+            return True
+
+    def _put(self, index, data, reserved):
+        with self._cond:
+            self._held -= reserved
+            if index in self._chunks:
+                if isinstance(data, bytes):
+                    self._held += len(data)
+                self._chunks[index].append(data)
+            self._cond.notify_all()
+
+    def chunks(self, index):
+        """Yield the data of file `index` as it is read."""
+        try:
+            with self._cond:
+                self._head = index
+                self._cond.notify_all()
+            while True:
+                with self._cond:
+                    while not self._chunks.get(index):
+                        self._cond.wait()
+                    data = self._chunks[index].popleft()
+                    if isinstance(data, Exception):
+                        raise data
+                    self._held -= len(data)
+                    self._cond.notify_all()
+                if not data:
+                    return
+                yield data
+        finally:
+            self.skip(index)
+
+    def skip(self, index):
+        """Drop what's left of file `index` and move on to the next one."""
+        with self._cond:
+            for data in self._chunks.pop(index, ()):
+                if isinstance(data, bytes):
+                    self._held -= len(data)
+            self._head = index + 1
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._stop = True
+            self._chunks.clear()
+            self._cond.notify_all()
+
+
 def files_in_collection(c):
     # Sort first by file type, then alphabetically by file path.
     for i in sorted(list(c.keys()),
@@ -7,6 +7,7 @@ import arvados
 import arvados.collection
 import base64
 import ciso8601
+import collections
 import copy
 import datetime
 import errno
@@ -17,9 +18,11 @@ import json
 import logging
 import os
 import pwd
+import queue
 import re
 import signal
 import socket
+import stat
 import sys
 import tempfile
 import threading
@@ -32,7 +35,7 @@ import arvados.util
 import arvados.commands._util as arv_cmd
 
 from apiclient import errors as apiclient_errors
-from arvados._internal import basedirs
+from arvados._internal import basedirs, streams
 from arvados._version import __version__
 
 api_client = None
@@ -228,11 +231,45 @@ def get_argument_parser():
                              help="""
     Set the number of upload threads to be used. Take into account that
     using lots of threads will increase the RAM requirements. Default is
-    to use 2 threads.
+    to start with 2 threads and add more while uploads fall behind, up to
+    the number the cluster's Keep services can usefully take.
     On high latency installations, using a greater number will improve
     overall throughput.
     """)
 
+    upload_opts.add_argument('--put-buffer-size', type=int, metavar='MiB', default=None,
+                             help="""
+    Set the amount of memory, in MiB, that blocks waiting to be uploaded
+    may use. Default is enough for one block per upload thread plus two,
+    up to 1024 MiB.
+    """)
+
+    upload_opts.add_argument('--read-threads', type=int, metavar='N', default=1,
+                             help="""
+    Set the number of files to read at the same time. Files are still added
+    to the collection one at a time and in the same order, so the result is
+    the same as reading them one by one, but reading ahead helps when
+    uploading many files from a high latency filesystem like NFS or Lustre.
+    Each extra thread may hold up to two data blocks in memory.
+    Default 1.
+    """)
+
+    upload_opts.add_argument('--scan-threads', type=int, metavar='N', default=1,
+                             help="""
+    Set the number of threads used to list directories and stat files
+    before uploading. Files are still uploaded in the same order. Using
+    more threads speeds up scanning large directory trees on a high
+    latency filesystem like NFS or Lustre. Default 1.
+    """)
+
+    upload_opts.add_argument('--dedup-cache', action='store_true', default=False,
+                             help="""
+    Keep a local index of uploaded files, by device, inode, size and
+    modification time, shared by all arv-put invocations. Files found
+    unchanged in it are added to the collection by reference to the
+    blocks already stored in Keep, without reading or uploading them.
+    """)
+
     upload_opts.add_argument('--exclude', metavar='PATTERN', default=[],
                           action='append', help="""
     Exclude files and directories whose names match the given glob pattern. When
@@ -308,6 +345,21 @@ def parse_arguments(arguments):
         if not args.filename:
             args.filename = 'stdin'
 
+    if args.read_threads < 1:
+        arg_parser.error("""
+    --read-threads must be at least 1.
+    """)
+
+    if args.scan_threads < 1:
+        arg_parser.error("""
+    --scan-threads must be at least 1.
+    """)
+
+    if args.put_buffer_size is not None and args.put_buffer_size < 1:
+        arg_parser.error("""
+    --put-buffer-size must be at least 1.
+    """)
+
     # Remove possible duplicated patterns
     if len(args.exclude) > 0:
         args.exclude = list(set(args.exclude))
@@ -404,9 +456,44 @@ class ResumeCache(object):
         except IOError:
             raise ResumeCacheConflict(u"{} locked".format(fileobj.name))
 
+    @staticmethod
+    def replay(cache_file):
+        """Load resume state from a cache file, replaying its journal.
+
+        The file starts with a JSON snapshot of the state on one line.  Each
+        following line is a JSON journal record of one checkpoint: its
+        `files` entries replace the snapshot's, and its `manifest` lines
+        are appended to the snapshot's manifest, extending the files they
+        name.
+
+        Returns the state, the size of the snapshot and the size of the
+        journal after it.  The journal size is None if the file ends with a
+        record that was cut short, since records can't be appended after it.
+        """
+        cache_file.seek(0)
+        line = cache_file.readline()
+        state = json.loads(line)
+        snapshot_size = len(line)
+        journal_size = 0 if line.endswith('\n') else None
+        while journal_size is not None:
+            line = cache_file.readline()
+            if not line:
+                break
+            try:
+                if not line.endswith('\n'):
+                    raise ValueError("incomplete journal record")
+                record = json.loads(line)
+            except ValueError:
+                journal_size = None
+                break
+            state['files'].update(record.get('files', {}))
+            if record.get('manifest'):
+                state['manifest'] = (state['manifest'] or '') + record['manifest']
+            journal_size += len(line)
+        return state, snapshot_size, journal_size
+
     def load(self):
-        self.cache_file.seek(0)
-        return json.load(self.cache_file)
+        return self.replay(self.cache_file)[0]
 
     def check_cache(self, api_client=None, num_retries=0):
         try:
@@ -432,6 +519,7 @@ class ResumeCache(object):
             self._lock_file(new_cache_fd)
             new_cache = os.fdopen(new_cache_fd, 'r+')
             json.dump(data, new_cache)
+            new_cache.write('\n')
             os.rename(new_cache_name, self.filename)
         except (IOError, OSError, ResumeCacheConflict):
             try:
@@ -458,6 +546,112 @@ class ResumeCache(object):
         self.__init__(self.filename)
 
 
+class DedupCache(object):
+    """Local index of files already stored in Keep
+
+    Maps each file's device, inode, size and modification time to the
+    signed segments it was stored as, each a `[locator, segment offset,
+    size]` list. The index is a file of JSON `[key, segments]` lines that
+    is only ever appended to, except to compact it; a later line replaces
+    an earlier one with the same key. Compacting also drops entries whose
+    signatures have expired.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}
+        self._lines = 0
+        try:
+            with open(path) as index:
+                self._read(index)
+        except IOError as error:
+            if error.errno != errno.ENOENT:
+                raise
+
+    def _read(self, index):
+        for line in index:
+            try:
+                key, segments = json.loads(line)
+            except ValueError:
+                # Cut short by a crash.
+                continue
+            self._entries[key] = segments
+            self._lines += 1
+
+    @staticmethod
+    def key(st):
+        return '{}:{}:{}:{}'.format(st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def get(self, st):
+        """Return the segments of the file with stat result `st`, or None."""
+        return self._entries.get(self.key(st))
+
+    def _open_locked(self):
+        """Open the index file and take its lock.
+
+        Another process may compact the index, replacing the file, while
+        this one waits for the lock on the old file.  In that case, open
+        the new file and lock it instead.
+        """
+        while True:
+            index = open(self.path, 'a+')
+            fcntl.flock(index, fcntl.LOCK_EX)
+            try:
+                if os.fstat(index.fileno()).st_ino == os.stat(self.path).st_ino:
+                    return index
+            except OSError as error:
+                if error.errno != errno.ENOENT:
+                    index.close()
+                    raise
+            index.close()
+
+    def update(self, entries):
+        """Index files given as (stat result, segments) pairs."""
+        changed = {}
+        for st, segments in entries:
+            key = self.key(st)
+            if self._entries.get(key) != segments:
+                changed[key] = segments
+        if not changed:
+            return
+        self._entries.update(changed)
+        self._lines += len(changed)
+        with self._open_locked() as index:
+            if self._lines > 2 * len(self._entries):
+                self._compact(index, changed)
+            else:
+                index.write(''.join(json.dumps([key, segments]) + '\n'
+                                    for key, segments in changed.items()))
+                index.flush()
+                os.fsync(index.fileno())
+
+    def _compact(self, index, changed):
+        # Called holding the index file lock.  Start from what's in the
+        # file, which includes lines other processes appended since this
+        # one read it, and drop entries whose signatures have expired.
+        index.seek(0)
+        self._entries = {}
+        self._read(index)
+        self._entries.update(changed)
+        self._entries = {
+            key: segments for key, segments in self._entries.items()
+            if not any(arvados.keep.KeepLocator(loc).permission_expired()
+                       for loc, _, _ in segments)}
+        new_index = tempfile.NamedTemporaryFile(
+            mode='w', dir=os.path.dirname(self.path), delete=False)
+        try:
+            for key, segments in self._entries.items():
+                new_index.write(json.dumps([key, segments]) + '\n')
+            new_index.flush()
+            os.fsync(new_index.fileno())
+            new_index.close()
+            os.rename(new_index.name, self.path)
+        except:
+            os.unlink(new_index.name)
+            raise
+        self._lines = len(self._entries)
+
+
 class ArvPutUploadJob(object):
     CACHE_DIR = 'arv-put'
     EMPTY_STATE = {
@@ -472,7 +666,8 @@ class ArvPutUploadJob(object):
                  update_time=60.0, update_collection=None, storage_classes=None,
                  logger=logging.getLogger('arvados.arv_put'), dry_run=False,
                  follow_links=True, exclude_paths=[], exclude_names=None,
-                 trash_at=None):
+                 trash_at=None, read_threads=1, scan_threads=1,
+                 dedup_cache=False, put_buffer_size=None):
         self.paths = paths
         self.resume = resume
         self.use_cache = use_cache
@@ -490,6 +685,12 @@ class ArvPutUploadJob(object):
         self.num_retries = num_retries
         self.replication_desired = replication_desired
         self.put_threads = put_threads
+        self.put_buffer_size = put_buffer_size
+        self.read_threads = read_threads
+        self.scan_threads = scan_threads
+        self._dedup_cache = None # Index of files stored in Keep by earlier runs
+        self._dedup_checked = False # Whether the index signatures were checked
+        self._dedup_files = {} # Files to index after upload: {filename : stat result}
         self.filename = filename
         self.storage_classes = storage_classes
         self._api_client = api_client
@@ -497,6 +698,13 @@ class ArvPutUploadJob(object):
         self._state = None # Previous run state (file list & manifest)
         self._current_files = [] # Current run file list
         self._cache_file = None
+        self._compact_cache = True # Next checkpoint rewrites the whole cache file
+        self._snapshot_size = 0 # Cache file snapshot size
+        self._journal_size = 0 # Size of the journal records after the snapshot
+        self._journal_lock = threading.Lock()
+        self._journal_files = {} # Files written this run: {(stream, name) : [ArvadosFile, segments journaled]}
+        self._journal_dirty = set() # Files changed since the last checkpoint
+        self._journal_sources = set() # Sources whose file list entry changed since the last checkpoint
         self._collection_lock = threading.Lock()
         self._remote_collection = None # Collection being updated (if asked)
         self._local_collection = None # Collection from previous run manifest
@@ -531,6 +739,9 @@ class ArvPutUploadJob(object):
         # Load cached data if any and if needed
         self._setup_state(update_collection)
 
+        if dedup_cache and not self.dry_run:
+            self._dedup_cache = DedupCache(self._get_dedup_filepath())
+
         # Build the upload file list, excluding requested files and counting the
         # bytes expected to be uploaded.
         self._build_upload_list()
@@ -572,49 +783,30 @@ class ArvPutUploadJob(object):
                     # upload the directory to the collection's root.
                     prefixdir = os.path.dirname(path)
                 prefixdir += os.sep
-                for root, dirs, files in os.walk(path,
-                                                 followlinks=self.follow_links):
-                    root_relpath = os.path.relpath(root, path)
-                    if root_relpath == '.':
-                        root_relpath = ''
-                    # Exclude files/dirs by full path matching pattern
-                    if self.exclude_paths:
-                        dirs[:] = [d for d in dirs
-                                   if not any(pathname_match(
-                                           os.path.join(root_relpath, d), pat)
-                                              for pat in self.exclude_paths)]
-                        files = [f for f in files
-                                 if not any(pathname_match(
-                                         os.path.join(root_relpath, f), pat)
-                                            for pat in self.exclude_paths)]
-                    # Exclude files/dirs by name matching pattern
-                    if self.exclude_names is not None:
-                        dirs[:] = [d for d in dirs
-                                   if not self.exclude_names.match(d)]
-                        files = [f for f in files
-                                 if not self.exclude_names.match(f)]
-                    # Make os.walk()'s dir traversing order deterministic
-                    dirs.sort()
-                    files.sort()
-                    for f in files:
+                for root, files in self._walk(path):
+                    for f, st, is_link in files:
                         filepath = os.path.join(root, f)
-                        if not os.path.isfile(filepath):
+                        if st is None:
                             self.logger.warning("Skipping non-regular file '{}'".format(filepath))
                             continue
+                        # Ignore symlinks when requested
+                        if is_link and not self.follow_links:
+                            continue
                         # Add its size to the total bytes count (if applicable)
-                        if self.follow_links or (not os.path.islink(filepath)):
-                            if self.bytes_expected is not None:
-                                self.bytes_expected += os.path.getsize(filepath)
+                        if self.bytes_expected is not None:
+                            self.bytes_expected += st.st_size
                         self._check_file(filepath,
-                                         os.path.join(root[len(prefixdir):], f))
+                                         os.path.join(root[len(prefixdir):], f),
+                                         st)
             else:
                 filepath = os.path.abspath(path)
+                st = os.stat(filepath)
                 # Add its size to the total bytes count (if applicable)
-                if self.follow_links or (not os.path.islink(filepath)):
-                    if self.bytes_expected is not None:
-                        self.bytes_expected += os.path.getsize(filepath)
+                if self.bytes_expected is not None:
+                    self.bytes_expected += st.st_size
                 self._check_file(filepath,
-                                 self.filename or os.path.basename(path))
+                                 self.filename or os.path.basename(path),
+                                 st)
         # If dry-mode is on, and got up to this point, then we should notify that
         # there aren't any file to upload.
         if self.dry_run:
@@ -626,6 +818,115 @@ class ArvPutUploadJob(object):
             if f != 'stdin' and f != self.filename and not f in self._file_paths:
                 self._local_collection.remove(f)
 
+    def _scan_dir(self, dirpath, relpath):
+        """
+        List a directory for _walk(), leaving out excluded entries.
+
+        Returns its files as a list of (name, stat result, is symlink), and
+        the names of its subdirectories, both sorted. Each file is stat()ed
+        once, following symlinks, and its stat result is None if it's not
+        a regular file. Symlinks to directories are only listed as
+        subdirectories when following links.
+        """
+        try:
+            with os.scandir(dirpath) as it:
+                entries = list(it)
+        except OSError:
+            # Like os.walk(), skip directories that can't be listed.
+            return [], []
+        dirs = []
+        files = []
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir and (not self.follow_links) and entry.is_symlink():
+                continue
+            # Exclude files/dirs by full path matching pattern
+            if self.exclude_paths and any(
+                    pathname_match(os.path.join(relpath, entry.name), pat)
+                    for pat in self.exclude_paths):
+                continue
+            # Exclude files/dirs by name matching pattern
+            if self.exclude_names is not None and self.exclude_names.match(entry.name):
+                continue
+            if is_dir:
+                dirs.append(entry.name)
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                st = None
+            if st is not None and not stat.S_ISREG(st.st_mode):
+                st = None
+            files.append((entry.name, st, entry.is_symlink()))
+        dirs.sort()
+        files.sort(key=lambda f: f[0])
+        return files, dirs
+
+    def _walk(self, top):
+        """
+        Walk the directory tree under `top`, yielding (dirpath, files) for
+        each directory in the order os.walk() would with sorted
+        directories. `files` is the directory's file list from _scan_dir().
+
+        With `scan_threads` > 1, worker threads scan directories ahead of
+        the walk, taking the ones the walk will reach first.
+        """
+        if self.scan_threads <= 1:
+            stack = [(top, '')]
+            while stack:
+                dirpath, relpath = stack.pop()
+                files, dirs = self._scan_dir(dirpath, relpath)
+                yield dirpath, files
+                stack.extend((os.path.join(dirpath, d), os.path.join(relpath, d))
+                             for d in reversed(dirs))
+            return
+
+        # Directories are keyed by their position in the walk: the tuple of
+        # sibling indexes from `top` sorts in the order they're yielded.
+        stop = threading.Event()
+        to_scan = queue.PriorityQueue()
+
+        def scanner():
+            while True:
+                key, dirpath, relpath, listing = to_scan.get()
+                if dirpath is None:
+                    return
+                if stop.is_set():
+                    continue
+                try:
+                    listing.put(self._scan_dir(dirpath, relpath))
+                except Exception as error:
+                    listing.put(error)
+
+        def scan(key, dirpath, relpath):
+            listing = queue.Queue()
+            to_scan.put((key, dirpath, relpath, listing))
+            return (key, dirpath, relpath, listing)
+
+        scanners = [threading.Thread(target=scanner, daemon=True)
+                    for _ in range(self.scan_threads)]
+        for thread in scanners:
+            thread.start()
+        try:
+            stack = [scan((), top, '')]
+            while stack:
+                key, dirpath, relpath, listing = stack.pop()
+                listing = listing.get()
+                if isinstance(listing, Exception):
+                    raise listing
+                files, dirs = listing
+                subdirs = [scan(key + (i,), os.path.join(dirpath, d), os.path.join(relpath, d))
+                           for i, d in enumerate(dirs)]
+                yield dirpath, files
+                stack.extend(reversed(subdirs))
+        finally:
+            stop.set()
+            for _ in scanners:
+                to_scan.put(((float('inf'),), None, None, None))
+
     def start(self, save_collection):
         """
         Start supporting thread & file uploading
@@ -661,6 +962,8 @@ class ArvPutUploadJob(object):
                     # Commit all pending blocks & one last _update()
                     self._local_collection.manifest_text()
                     self._update(final=True)
+                    if self._dedup_cache is not None:
+                        self._update_dedup_cache()
                     if save_collection:
                         self.save_collection()
             if self.use_cache:
@@ -741,19 +1044,10 @@ class ArvPutUploadJob(object):
             with self._collection_lock:
                 self.bytes_written = self._collection_size(self._local_collection)
                 if self.use_cache:
-                    if final:
-                        manifest = self._local_collection.manifest_text()
-                    else:
-                        # Get the manifest text without comitting pending blocks
-                        manifest = self._local_collection.manifest_text(strip=False,
-                                                                        normalize=False,
-                                                                        only_committed=True)
-                    # Update cache
-                    with self._state_lock:
-                        self._state['manifest'] = manifest
+                    record = self._journal_record(final)
             if self.use_cache:
                 try:
-                    self._save_state()
+                    self._save_state(record)
                 except Exception as e:
                     self.logger.error("Unexpected error trying to save cache file: {}".format(e))
             # Keep remote collection's trash_at attribute synced when using relative expire dates
@@ -779,13 +1073,16 @@ class ArvPutUploadJob(object):
         self._write(sys.stdin.buffer, output)
         output.close()
 
-    def _check_file(self, source, filename):
+    def _check_file(self, source, filename, st=None):
         """
-        Check if this file needs to be uploaded
+        Check if this file needs to be uploaded. `st` is the file's stat
+        result, if the caller has it already.
         """
-        # Ignore symlinks when requested
-        if (not self.follow_links) and os.path.islink(source):
-            return
+        if st is None:
+            # Ignore symlinks when requested
+            if (not self.follow_links) and os.path.islink(source):
+                return
+            st = os.stat(source)
         resume_offset = 0
         should_upload = False
         new_file_in_cache = False
@@ -797,9 +1094,10 @@ class ArvPutUploadJob(object):
             # repeated run.
             if source not in self._state['files']:
                 self._state['files'][source] = {
-                    'mtime': os.path.getmtime(source),
-                    'size' : os.path.getsize(source)
+                    'mtime': st.st_mtime,
+                    'size' : st.st_size
                 }
+                self._journal_sources.add(source)
                 new_file_in_cache = True
             cached_file_data = self._state['files'][source]
 
@@ -813,7 +1111,7 @@ class ArvPutUploadJob(object):
         elif new_file_in_cache:
             should_upload = True
         # Local file didn't change from last run.
-        elif cached_file_data['mtime'] == os.path.getmtime(source) and cached_file_data['size'] == os.path.getsize(source):
+        elif cached_file_data['mtime'] == st.st_mtime and cached_file_data['size'] == st.st_size:
             if not file_in_local_collection:
                 # File not uploaded yet, upload it completely
                 should_upload = True
@@ -842,6 +1140,11 @@ class ArvPutUploadJob(object):
                 self._local_collection.remove(filename)
             should_upload = True
 
+        if self._dedup_cache is not None:
+            self._dedup_files[filename] = st
+            if should_upload and resume_offset == 0 and self._upload_by_reference(source, filename, st):
+                should_upload = False
+
         if should_upload:
             try:
                 self._files_to_upload.append((source, resume_offset, filename))
@@ -852,21 +1155,120 @@ class ArvPutUploadJob(object):
                 raise
 
     def _upload_files(self):
+        if self.read_threads > 1:
+            self._upload_files_read_ahead()
+            return
         for source, resume_offset, filename in self._files_to_upload:
             with open(source, 'rb') as source_fd:
-                with self._state_lock:
-                    self._state['files'][source]['mtime'] = os.path.getmtime(source)
-                    self._state['files'][source]['size'] = os.path.getsize(source)
+                output = self._open_output(source, resume_offset, filename,
+                                           os.fstat(source_fd.fileno()))
                 if resume_offset > 0:
                     # Start upload where we left off
-                    output = self._local_collection.open(filename, 'ab')
                     source_fd.seek(resume_offset)
-                else:
-                    # Start from scratch
-                    output = self._local_collection.open(filename, 'wb')
                 self._write(source_fd, output)
                 output.close(flush=False)
 
+    def _open_output(self, source, resume_offset, filename, st):
+        """
+        Record the source file's current mtime & size from its stat result
+        `st`, and open the collection file to upload it to.
+        """
+        with self._state_lock:
+            self._state['files'][source]['mtime'] = st.st_mtime
+            self._state['files'][source]['size'] = st.st_size
+            self._journal_sources.add(source)
+        if self._dedup_cache is not None:
+            self._dedup_files[filename] = st
+        if resume_offset > 0:
+            # Start upload where we left off
+            return self._local_collection.open(filename, 'ab')
+        else:
+            # Start from scratch
+            return self._local_collection.open(filename, 'wb')
+
+    def _upload_files_read_ahead(self):
+        """
+        Upload files while `read_threads` worker threads read the next
+        ones. Each worker reads one file at a time, at most one block
+        ahead of the upload, so the files' data is still written to the
+        collection in order, in the same blocks as when reading serially.
+        """
+        stop = threading.Event()
+        to_read = queue.Queue()
+        reading = collections.deque()
+
+        def put(chunks, item):
+            # The uploader stops taking chunks if it fails, so don't
+            # wait for room in the queue after that.
+            while not stop.is_set():
+                try:
+                    chunks.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def read_file(source, resume_offset, chunks):
+            try:
+                with open(source, 'rb') as source_fd:
+                    if not put(chunks, os.fstat(source_fd.fileno())):
+                        return
+                    if resume_offset > 0:
+                        source_fd.seek(resume_offset)
+                    while True:
+                        data = source_fd.read(arvados.config.KEEP_BLOCK_SIZE)
+                        if not put(chunks, data) or not data:
+                            break
+            except Exception as error:
+                put(chunks, error)
+
+        def reader():
+            while True:
+                job = to_read.get()
+                if job is None or stop.is_set():
+                    return
+                read_file(*job)
+
+        def read_next():
+            try:
+                source, resume_offset, filename = next(files)
+            except StopIteration:
+                return
+            chunks = queue.Queue(maxsize=1)
+            to_read.put((source, resume_offset, chunks))
+            reading.append((source, resume_offset, filename, chunks))
+
+        def get(chunks):
+            item = chunks.get()
+            if isinstance(item, Exception):
+                raise item
+            return item
+
+        files = iter(self._files_to_upload)
+        readers = [threading.Thread(target=reader, daemon=True)
+                   for _ in range(self.read_threads)]
+        for thread in readers:
+            thread.start()
+        try:
+            for _ in range(self.read_threads):
+                read_next()
+            while reading:
+                source, resume_offset, filename, chunks = reading[0]
+                read_next()
+                output = self._open_output(source, resume_offset, filename,
+                                           get(chunks))
+                while True:
+                    data = get(chunks)
+                    if not data:
+                        break
+                    output.write(data)
+                output.close(flush=False)
+                reading.popleft()
+        finally:
+            stop.set()
+            for _ in readers:
+                to_read.put(None)
+
     def _write(self, source_fd, output):
         while True:
             data = source_fd.read(arvados.config.KEEP_BLOCK_SIZE)
@@ -874,9 +1276,72 @@ class ArvPutUploadJob(object):
                 break
             output.write(data)
 
+    def _upload_by_reference(self, source, filename, st):
+        """
+        Add a file to the local collection by reference to the blocks an
+        earlier upload stored it in, if the dedup cache has them and their
+        signatures are still valid. Returns True if it did.
+        """
+        segments = self._dedup_cache.get(st)
+        if not segments:
+            return False
+        locators = [arvados.keep.KeepLocator(loc) for loc, _, _ in segments]
+        if any(loc.permission_expired() for loc in locators):
+            return False
+        if not self._dedup_checked:
+            # Like _cached_manifest_valid(): make sure the index signatures
+            # were made for this cluster & token before using any of them.
+            self._dedup_checked = True
+            kc = arvados.KeepClient(api_client=self._api_client,
+                                    num_retries=self.num_retries)
+            try:
+                kc.head(segments[0][0])
+            except arvados.errors.KeepRequestError:
+                self.logger.info("Invalid signatures on dedup cache file '{}', not using it.".format(self._dedup_cache.path))
+                self._dedup_cache = None
+                return False
+        with self._state_lock:
+            self._state['files'][source]['mtime'] = st.st_mtime
+            self._state['files'][source]['size'] = st.st_size
+            self._journal_sources.add(source)
+        output = self._local_collection.find_or_create(filename, arvados.collection.FILE)
+        if output.size():
+            output.truncate(0)
+        for loc, (locator, offset, size) in zip(locators, segments):
+            output.add_segment([streams.Range(locator, 0, loc.size, 0)], offset, size)
+        self.bytes_skipped += st.st_size
+        return True
+
+    def _update_dedup_cache(self):
+        """
+        Add the blocks of the local collection's files to the dedup cache.
+        """
+        entries = []
+        for filename, st in self._dedup_files.items():
+            item = self._local_collection.find(filename)
+            if not isinstance(item, arvados.arvfile.ArvadosFile) or item.size() != st.st_size:
+                continue
+            segments = [[s.locator, s.segment_offset, s.range_size] for s in item.segments()]
+            if all(arvados.util.keep_locator_pattern.match(loc) for loc, _, _ in segments):
+                entries.append((st, segments))
+        try:
+            self._dedup_cache.update(entries)
+        except (IOError, OSError) as error:
+            self.logger.error("There was a problem while saving the dedup cache file: {}".format(error))
+
     def _my_collection(self):
         return self._remote_collection if self.update else self._local_collection
 
+    def _get_cache_dir(self):
+        cache_path = Path(self.CACHE_DIR)
+        if len(cache_path.parts) == 1:
+            cache_path = basedirs.BaseDirectories('CACHE').storage_path(cache_path)
+        else:
+            # Note this is a noop if cache_path is absolute, which is what we want.
+            cache_path = Path.home() / cache_path
+            cache_path.mkdir(parents=True, exist_ok=True, mode=0o700)
+        return cache_path
+
     def _get_cache_filepath(self):
         # Set up cache file name from input paths.
         md5 = hashlib.md5()
@@ -885,14 +1350,13 @@ class ArvPutUploadJob(object):
         md5.update(b'\0'.join([p.encode() for p in realpaths]))
         if self.filename:
             md5.update(self.filename.encode())
-        cache_path = Path(self.CACHE_DIR)
-        if len(cache_path.parts) == 1:
-            cache_path = basedirs.BaseDirectories('CACHE').storage_path(cache_path)
-        else:
-            # Note this is a noop if cache_path is absolute, which is what we want.
-            cache_path = Path.home() / cache_path
-            cache_path.mkdir(parents=True, exist_ok=True, mode=0o700)
-        return str(cache_path / md5.hexdigest())
+        return str(self._get_cache_dir() / md5.hexdigest())
+
+    def _get_dedup_filepath(self):
+        # One index per cluster, whatever the input paths.
+        md5 = hashlib.md5()
+        md5.update(arvados.config.get('ARVADOS_API_HOST', '!nohost').encode())
+        return str(self._get_cache_dir() / 'dedup-{}'.format(md5.hexdigest()))
 
     def _setup_state(self, update_collection):
         """
@@ -931,10 +1395,13 @@ class ArvPutUploadJob(object):
         with self._state_lock:
             if self.use_cache:
                 try:
-                    self._state = json.load(self._cache_file)
+                    self._state, self._snapshot_size, self._journal_size = ResumeCache.replay(self._cache_file)
                     if not set(['manifest', 'files']).issubset(set(self._state.keys())):
                         # Cache at least partially incomplete, set up new cache
                         self._state = copy.deepcopy(self.EMPTY_STATE)
+                    elif self._journal_size is not None:
+                        # Checkpoints can be appended to the existing file
+                        self._compact_cache = False
                 except ValueError:
                     # Cache file empty, set up new cache
                     self._state = copy.deepcopy(self.EMPTY_STATE)
@@ -942,6 +1409,7 @@ class ArvPutUploadJob(object):
                 self.logger.info("No cache usage requested for this run.")
                 # No cache file, set empty state
                 self._state = copy.deepcopy(self.EMPTY_STATE)
+            cached_manifest = self._state['manifest']
             if not self._cached_manifest_valid():
                 if not self.batch_mode:
                     raise ResumeCacheInvalidError()
@@ -949,14 +1417,18 @@ class ArvPutUploadJob(object):
                     self.logger.info("Invalid signatures on cache file '{}' while being run in 'batch mode' -- continuing anyways.".format(self._cache_file.name))
                     self.use_cache = False # Don't overwrite preexisting cache file.
                     self._state = copy.deepcopy(self.EMPTY_STATE)
+            if self._state['manifest'] is not cached_manifest:
+                self._compact_cache = True
             # Load the previous manifest so we can check if files were modified remotely.
             self._local_collection = arvados.collection.Collection(
                 self._state['manifest'],
                 replication_desired=self.replication_desired,
                 storage_classes_desired=self.storage_classes,
                 put_threads=self.put_threads,
+                put_buffer_size=self.put_buffer_size,
                 api_client=self._api_client,
                 num_retries=self.num_retries)
+            self._local_collection.subscribe(self._journal_change)
 
     def _cached_manifest_valid(self):
         """
@@ -1017,15 +1489,146 @@ class ArvPutUploadJob(object):
         except IOError:
             raise ResumeCacheConflict(u"{} locked".format(fileobj.name))
 
-    def _save_state(self):
+    def _journal_change(self, event, collection, name, item):
         """
-        Atomically save current state into cache.
+        Collection change callback, tracking the files that the next
+        checkpoint has to journal.  Changes that can't be journaled as
+        segments appended to a file make it rewrite the whole cache.
         """
+        key = (collection.stream_name(), name)
+        with self._journal_lock:
+            if isinstance(item, tuple) and item[0] is item[1]:
+                # A file was written, flushed or truncated.
+                if key not in self._journal_files:
+                    # Only its committed segments are in the cache so far.
+                    self._journal_files[key] = [
+                        item[1], self._committed_segments(item[1].segments())]
+                self._journal_dirty.add(key)
+            elif event == arvados.collection.ADD and key not in self._journal_files:
+                if isinstance(item, arvados.arvfile.ArvadosFile):
+                    self._journal_files[key] = [item, None]
+                    self._journal_dirty.add(key)
+                elif len(item) > 0:
+                    self._compact_cache = True
+            else:
+                self._journal_files.pop(key, None)
+                self._compact_cache = True
+
+    def _committed_segments(self, segments):
+        """
+        Count the segments at the start of a file that are stored in Keep.
+        arv-put only ever appends to files, and flushing a file commits all
+        of its buffer blocks, so these are all of its committed segments.
+        """
+        count = 0
+        for segment in segments:
+            if not arvados.util.keep_locator_pattern.match(segment.locator):
+                break
+            count += 1
+        return count
+
+    def _journal_file_text(self, key):
+        """
+        Return manifest text for the segments of a file committed since the
+        last checkpoint, or None if the file was truncated.
+        """
+        with self._journal_lock:
+            entry = self._journal_files.get(key)
+        if entry is None:
+            # Removed: the whole cache is being rewritten anyway.
+            return ''
+        afile, journaled = entry
+        segments = afile.segments()
+        committed = self._committed_segments(segments)
+        if committed < (journaled or 0):
+            return None
+        if committed == journaled:
+            return ''
+        filestream = [streams.LocatorAndRange(
+            segment.locator,
+            arvados.keep.KeepLocator(segment.locator).size,
+            segment.segment_offset,
+            segment.range_size,
+        ) for segment in segments[journaled or 0:committed]]
+        entry[1] = committed
+        stream_name, name = key
+        return ' '.join(streams.normalize_stream(stream_name, {name: filestream})) + '\n'
+
+    def _journal_record(self, final=False):
+        """
+        Get the journal record to append to the cache file for this
+        checkpoint, as a line of JSON, or '' if nothing changed.  Its cost depends on the files
+        changed since the last checkpoint, not on the size of the upload.
+
+        Returns None when the whole state has to be saved instead: on the
+        final update, when the journal has grown larger than the snapshot it
+        follows, or after a change that can't be journaled.  The manifest in
+        the state is brought up to date for that.
+        """
+        with self._journal_lock:
+            dirty = self._journal_dirty
+            self._journal_dirty = set()
+            compact = (final or self._compact_cache or
+                       self._journal_size > self._snapshot_size)
+        manifest = []
+        if not compact:
+            for key in sorted(dirty):
+                text = self._journal_file_text(key)
+                if text is None:
+                    compact = True
+                    break
+                manifest.append(text)
+        if compact:
+            with self._journal_lock:
+                self._compact_cache = False
+            with self._local_collection.lock:
+                if final:
+                    manifest = self._local_collection.manifest_text()
+                else:
+                    # Get the manifest text without comitting pending blocks
+                    manifest = self._local_collection.manifest_text(strip=False,
+                                                                    normalize=False,
+                                                                    only_committed=True)
+                with self._journal_lock:
+                    for entry in self._journal_files.values():
+                        entry[1] = self._committed_segments(entry[0].segments())
+            with self._state_lock:
+                self._state['manifest'] = manifest
+                self._journal_sources.clear()
+            return None
+        with self._state_lock:
+            files = {source: self._state['files'][source]
+                     for source in self._journal_sources}
+            self._journal_sources.clear()
+            manifest = ''.join(manifest)
+            if not (files or manifest):
+                return ''
+            return json.dumps({'files': files, 'manifest': manifest}) + '\n'
+
+    def _save_state(self, record=None):
+        """
+        Save current state into cache: append `record` to its journal if
+        given, otherwise atomically replace it with a snapshot of the state.
+        """
+        if record is not None:
+            if not record:
+                return
+            try:
+                self._cache_file.write(record)
+                self._cache_file.flush()
+                os.fsync(self._cache_file)
+            except (IOError, OSError) as error:
+                self.logger.error("There was a problem while saving the cache file: {}".format(error))
+                # The file may end with part of the record now.
+                self._compact_cache = True
+            else:
+                self._journal_size += len(record)
+            return
         with self._state_lock:
             # We're not using copy.deepcopy() here because it's a lot slower
             # than json.dumps(), and we're already needing JSON format to be
             # saved on disk.
-            state = json.dumps(self._state)
+            state = json.dumps(self._state) + '\n'
         try:
             new_cache = tempfile.NamedTemporaryFile(
                 mode='w+',
@@ -1037,6 +1640,7 @@ class ArvPutUploadJob(object):
             os.rename(new_cache.name, self._cache_filename)
         except (IOError, OSError, ResumeCacheConflict) as error:
             self.logger.error("There was a problem while saving the cache file: {}".format(error))
+            self._compact_cache = True
             try:
                 os.unlink(new_cache_name)
             except NameError:  # mkstemp failed.
@@ -1044,6 +1648,8 @@ class ArvPutUploadJob(object):
         else:
             self._cache_file.close()
             self._cache_file = new_cache
+            self._snapshot_size = len(state)
+            self._journal_size = 0
 
     def collection_name(self):
         return self._my_collection().api_response()['name'] if self._my_collection().api_response() else None
@@ -1291,6 +1897,10 @@ def do_put(arguments=None, stdout=sys.stdout, stderr=sys.stderr,
                                  num_retries = args.retries,
                                  replication_desired = args.replication,
                                  put_threads = args.threads,
+                                 put_buffer_size = args.put_buffer_size and args.put_buffer_size * 2**20,
+                                 read_threads = args.read_threads,
+                                 scan_threads = args.scan_threads,
+                                 dedup_cache = args.dedup_cache,
                                  name = collection_name,
                                  owner_uuid = project_uuid,
                                  ensure_unique_name = True,
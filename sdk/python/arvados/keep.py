@@ -2,12 +2,15 @@
 #
 # SPDX-License-Identifier: Apache-2.0
 
+import bisect
 import copy
 import collections
 import datetime
 import hashlib
 import errno
+import heapq
 import io
+import itertools
 import logging
 import math
 import os
@@ -18,6 +21,7 @@ import socket
 import ssl
 import sys
 import threading
+import time
 import resource
 import urllib.parse
 import traceback
@@ -31,7 +35,7 @@ import arvados.errors
 import arvados.retry as retry
 import arvados.util
 
-from ._internal import basedirs, diskcache, Timer, parse_seq
+from ._internal import basedirs, cachepolicy, diskcache, Timer, parse_seq, uniq
 from ._internal.pycurl import PyCurlHelper
 
 _logger = logging.getLogger('arvados.keep')
@@ -132,20 +136,102 @@ class KeepLocator(object):
 
 
 class KeepBlockCache(object):
-    def __init__(self, cache_max=0, max_slots=0, disk_cache=False, disk_cache_dir=None):
+    DEFAULT_SHARDS = 8
+    SHARED_CACHE_ROOT = '/dev/shm'
+
+    def __init__(self, cache_max=0, max_slots=0, disk_cache=False, disk_cache_dir=None,
+                 shards=DEFAULT_SHARDS, eviction_policy=None, ram_cache_max=0,
+                 shared_cache=False, max_open_blocks=0):
+        # A shared cache is a disk cache, by default in shared memory
+        # (/dev/shm), that coordinates with other processes using the
+        # same directory so each block is only fetched once per node.
+        # Because blocks are mmapped from the same files, processes
+        # also share the memory holding them.
+        if shared_cache:
+            disk_cache = True
+            if disk_cache_dir is None:
+                disk_cache_dir = os.path.join(self.SHARED_CACHE_ROOT, 'arvados-keep-{}'.format(os.getuid()))
+
+        # If ram_cache_max is set along with disk_cache, this is a
+        # two-tier cache: up to ram_cache_max bytes of blocks are held
+        # in RAM, and blocks evicted from RAM are demoted to a disk
+        # cache sized by cache_max and max_slots.  Blocks found on
+        # disk are promoted back to RAM.  Evicted blocks are written to
+        # disk by a background thread, so readers don't wait for it.
+        self._lower = None
+        # locator -> content of blocks waiting to be written to disk,
+        # oldest first, and the thread writing them, if any.
+        self._demotions = collections.OrderedDict()
+        self._demoter = None
+        if disk_cache and ram_cache_max:
+            self._lower = KeepBlockCache(cache_max=cache_max,
+                                         max_slots=max_slots,
+                                         disk_cache=True,
+                                         disk_cache_dir=disk_cache_dir,
+                                         shards=shards,
+                                         eviction_policy=eviction_policy,
+                                         shared_cache=shared_cache,
+                                         max_open_blocks=max_open_blocks)
+            shared_cache = False
+            disk_cache = False
+            disk_cache_dir = self._lower._disk_cache_dir
+            cache_max = ram_cache_max
+            max_slots = 0
+
         self.cache_max = cache_max
-        self._cache = collections.OrderedDict()
+        # Cache slots are spread across several shards, each with its
+        # own lock and eviction policy state, so that cache hits in
+        # different threads don't contend on one lock.  _cache_lock
+        # protects the global accounting (slot count and cache_total)
+        # and is held while adding or evicting slots.  When both locks
+        # are needed, _cache_lock is always taken first.
+        self.eviction_policy = eviction_policy or cachepolicy.DEFAULT_POLICY
+        policy_class = cachepolicy.get_policy(self.eviction_policy)
+        ticks = itertools.count()
+        self._shards = [KeepBlockCache._Shard(policy_class(ticks))
+                        for _ in range(max(1, shards))]
         self._cache_lock = threading.Lock()
         self._max_slots = max_slots
+        self._slot_count = 0
+        self.hits_counter = _Counter()
+        self.misses_counter = _Counter()
         self._disk_cache = disk_cache
         self._disk_cache_dir = disk_cache_dir
+        # Notified whenever a slot is evicted or becomes evictable.
         self._cache_updating = threading.Condition(self._cache_lock)
 
         if self._disk_cache and self._disk_cache_dir is None:
             self._disk_cache_dir = str(basedirs.BaseDirectories('CACHE').storage_path('keep'))
 
+        self._fetch_locks = None
+        if shared_cache:
+            self._fetch_locks = diskcache.FetchLocks(self._disk_cache_dir)
+
+        # Blocks in the disk cache that this cache hasn't mapped yet:
+        # locator -> size, least recently used first.  They count
+        # towards cache_total and the slot count, and are mapped by
+        # get() on first access.
+        self._unmapped = collections.OrderedDict()
+        self._index = None
+        indexed = {}
+        if self._disk_cache:
+            diskcache.DiskCacheSlot.check_cache(self._disk_cache_dir)
+            self._index = diskcache.DiskCacheIndex(self._disk_cache_dir)
+            indexed = self._index.load()
+
+        # If max_open_blocks is set, the disk cache only keeps that
+        # many blocks open and mapped at a time, closing the least
+        # recently used ones and reopening them when they are read
+        # again.  The number of cached blocks is then only limited by
+        # cache_max, not by file handles.
+        self._max_open_blocks = max_open_blocks if self._disk_cache else 0
+        self._open_blocks = collections.OrderedDict()
+        self._open_blocks_lock = threading.Lock()
+
         if self._max_slots == 0:
-            if self._disk_cache:
+            if self._max_open_blocks:
+                self._max_slots = sys.maxsize
+            elif self._disk_cache:
                 # Each block uses two file descriptors, one used to
                 # open it initially and hold the flock(), and a second
                 # hidden one used by mmap().
@@ -170,14 +256,16 @@ class KeepBlockCache(object):
             if self._disk_cache:
                 fs = os.statvfs(self._disk_cache_dir)
                 # Calculation of available space incorporates existing cache usage
-                existing_usage = diskcache.DiskCacheSlot.cache_usage(self._disk_cache_dir)
+                existing_usage = sum(size for size, _ in indexed.values())
                 avail = (fs.f_bavail * fs.f_bsize + existing_usage) / 4
                 maxdisk = int((fs.f_blocks * fs.f_bsize) * 0.10)
                 # pick smallest of:
                 # 10% of total disk size
                 # 25% of available space
                 # max_slots * 64 MiB
-                self.cache_max = min(min(maxdisk, avail), (self._max_slots * 64 * 1024 * 1024))
+                self.cache_max = min(maxdisk, avail)
+                if self._max_slots < sys.maxsize:
+                    self.cache_max = min(self.cache_max, (self._max_slots * 64 * 1024 * 1024))
             else:
                 # 256 MiB in RAM
                 self.cache_max = (256 * 1024 * 1024)
@@ -186,13 +274,16 @@ class KeepBlockCache(object):
 
         self.cache_total = 0
         if self._disk_cache:
-            self._cache = diskcache.DiskCacheSlot.init_cache(self._disk_cache_dir, self._max_slots)
-            for slot in self._cache.values():
-                self.cache_total += slot.size()
+            with self._cache_lock:
+                for locator, (size, _) in indexed.items():
+                    self._unmapped[locator] = size
+                    self.cache_total += size
+                    self._slot_count += 1
             self.cap_cache()
 
     class _CacheSlot:
         __slots__ = ("locator", "ready", "content")
+        released = None
 
         def __init__(self, locator):
             self.locator = locator
@@ -219,25 +310,123 @@ class KeepBlockCache(object):
         def evict(self):
             self.content = None
 
+    class _Shard:
+        __slots__ = ("lock", "slots", "policy")
 
-    def _resize_cache(self, cache_max, max_slots):
-        # Try and make sure the contents of the cache do not exceed
-        # the supplied maximums.
+        def __init__(self, policy):
+            self.lock = threading.Lock()
+            self.slots = {}
+            self.policy = policy
 
-        if self.cache_total <= cache_max and len(self._cache) <= max_slots:
-            return
+        def evictable(self, locator):
+            return self.slots[locator].ready.is_set()
 
-        _evict_candidates = collections.deque(self._cache.values())
-        while _evict_candidates and (self.cache_total > cache_max or len(self._cache) > max_slots):
-            slot = _evict_candidates.popleft()
-            if not slot.ready.is_set():
-                continue
+    def _shard(self, locator):
+        return self._shards[hash(locator) % len(self._shards)]
 
-            sz = slot.size()
-            slot.evict()
-            self.cache_total -= sz
-            del self._cache[slot.locator]
+    @staticmethod
+    def _is_dead(slot):
+        # A slot that failed to fill, or was evicted.  Disk slots
+        # whose file was closed by release() are still live.
+        return slot.ready.is_set() and slot.content is None and slot.released is None
+
+    def _add_slot(self, slot):
+        # Caller must hold _cache_lock.
+        shard = self._shard(slot.locator)
+        with shard.lock:
+            shard.slots[slot.locator] = slot
+            shard.policy.insert(slot.locator)
+        self._slot_count += 1
+        self.cache_total += slot.size()
+
+    def _touch_open_block(self, slot):
+        # Mark a disk cache block as recently opened, and close the
+        # least recently used ones over the max_open_blocks limit.
+        if not self._max_open_blocks:
+            return
+        if slot.content is None and slot.released is not None:
+            slot.remap()
+        with self._open_blocks_lock:
+            self._open_blocks[slot.locator] = slot
+            self._open_blocks.move_to_end(slot.locator)
+            while len(self._open_blocks) > self._max_open_blocks:
+                _, oldest = self._open_blocks.popitem(last=False)
+                oldest.release()
+
+    def _forget_unmapped(self, locator):
+        # Caller must hold _cache_lock.
+        size = self._unmapped.pop(locator, None)
+        if size is not None:
+            self.cache_total -= size
+            self._slot_count -= 1
+
+    def _remove_slot(self, shard, slot):
+        # Caller must hold _cache_lock and shard.lock.
+        del shard.slots[slot.locator]
+        shard.policy.remove(slot.locator)
+        self._slot_count -= 1
+
+    def _discard(self, slot):
+        with self._cache_updating:
+            shard = self._shard(slot.locator)
+            with shard.lock:
+                if shard.slots.get(slot.locator) is slot:
+                    self._remove_slot(shard, slot)
+            self._cache_updating.notify_all()
 
+    def _victim_shard(self):
+        # Return the shard whose policy ranks its next eviction
+        # candidate lowest, or None if nothing can be evicted.
+        victim_rank = None
+        victim = None
+        for shard in self._shards:
+            with shard.lock:
+                rank = shard.policy.evict_rank(shard.evictable)
+            if rank is not None and (victim_rank is None or rank < victim_rank):
+                victim_rank = rank
+                victim = shard
+        return victim
+
+    def _resize_cache(self, cache_max, max_slots):
+        # Try and make sure the contents of the cache do not exceed
+        # the supplied maximums.  Caller must hold _cache_lock.
+        evicted = False
+        while self._unmapped and (self.cache_total > cache_max or self._slot_count > max_slots):
+            # Blocks that haven't been used since the cache started
+            # go first.
+            locator, size = self._unmapped.popitem(last=False)
+            self.cache_total -= size
+            self._slot_count -= 1
+            if diskcache.DiskCacheSlot.remove_from_disk(locator, self._disk_cache_dir):
+                self._index.record_remove(locator)
+            evicted = True
+        while self.cache_total > cache_max or self._slot_count > max_slots:
+            shard = self._victim_shard()
+            if shard is None:
+                break
+            with shard.lock:
+                locator = shard.policy.evict(shard.evictable)
+                if locator is None:
+                    continue
+                slot = shard.slots.pop(locator)
+                sz = slot.size()
+                content = slot.content
+                if slot.evict() and self._index is not None:
+                    self._index.record_remove(locator)
+                if self._max_open_blocks:
+                    with self._open_blocks_lock:
+                        self._open_blocks.pop(locator, None)
+                self.cache_total -= sz
+                self._slot_count -= 1
+                if self._lower is not None and sz:
+                    self._demotions[locator] = content
+                    if self._demoter is None:
+                        self._demoter = threading.Thread(
+                            target=self._demote_evicted, daemon=True)
+                        self._demoter.start()
+            evicted = True
+        if evicted:
+            self._cache_updating.notify_all()
 
     def cap_cache(self):
         '''Cap the cache size to self.cache_max'''
@@ -245,67 +434,211 @@ class KeepBlockCache(object):
             self._resize_cache(self.cache_max, self._max_slots)
             self._cache_updating.notify_all()
 
-    def _get(self, locator):
+    def _demote_evicted(self):
+        # Runs in the demoter thread: save blocks evicted from the RAM
+        # tier to the disk tier, unless they are already there.  Each
+        # block stays in _demotions until it is written, so _promote
+        # can still find it.
+        while True:
+            with self._cache_lock:
+                if not self._demotions:
+                    self._demoter = None
+                    return
+                locator, content = next(iter(self._demotions.items()))
+            try:
+                if self._lower.get(locator) is None:
+                    slot, first = self._lower.reserve_cache(locator)
+                    if first:
+                        self._lower.set(slot, content)
+            except arvados.errors.KeepCacheError as e:
+                _logger.warning("Unable to demote block %s to disk cache: %s", locator, e)
+            except Exception:
+                _logger.exception("Exception demoting block %s to disk cache", locator)
+            with self._cache_lock:
+                if self._demotions.get(locator) is content:
+                    del self._demotions[locator]
+
+    def _wait_for_demotions(self):
+        # Wait until every block evicted so far is in the disk tier.
+        while True:
+            with self._cache_lock:
+                demoter = self._demoter
+            if demoter is None:
+                return
+            demoter.join()
+
+    def _promote(self, locator):
+        # Return a new RAM slot with the block from the disk tier, or
+        # from the blocks waiting to be written there, or None if the
+        # disk tier doesn't have it.
+        with self._cache_lock:
+            content = self._demotions.get(locator)
+        if content is not None:
+            n = KeepBlockCache._CacheSlot(locator)
+            n.set(content)
+            return n
+        disk_slot = self._lower.get(locator)
+        if disk_slot is None or not disk_slot.ready.is_set():
+            return None
+        content = disk_slot.get()
+        if content is None:
+            return None
+        n = KeepBlockCache._CacheSlot(locator)
+        n.set(bytes(content))
+        return n
+
+    def _get_cached(self, locator):
+        # Return (slot, dead) for the slot in memory for this
+        # locator, updating its LRU position if it's usable.
+        shard = self._shard(locator)
+        with shard.lock:
+            n = shard.slots.get(locator)
+            if n is None:
+                return None, False
+            if self._is_dead(n):
+                return n, True
+            shard.policy.hit(locator)
+            return n, False
+
+    def get(self, locator):
         # Test if the locator is already in the cache
-        if locator in self._cache:
-            n = self._cache[locator]
-            if n.ready.is_set() and n.content is None:
-                del self._cache[n.locator]
-                return None
-            self._cache.move_to_end(locator)
+        n, dead = self._get_cached(locator)
+        if dead:
+            self._discard(n)
+            return None
+        if n is not None:
+            self._touch_open_block(n)
             return n
         if self._disk_cache:
             # see if it exists on disk
             n = diskcache.DiskCacheSlot.get_from_disk(locator, self._disk_cache_dir)
-            if n is not None:
-                self._cache[n.locator] = n
-                self.cache_total += n.size()
-                return n
+        elif self._lower is not None:
+            n = self._promote(locator)
+        if n is not None:
+            with self._cache_lock:
+                cached, dead = self._get_cached(locator)
+                if cached is not None and not dead:
+                    # Another thread got here first.
+                    return cached
+                if cached is not None:
+                    shard = self._shard(locator)
+                    with shard.lock:
+                        self._remove_slot(shard, cached)
+                self._forget_unmapped(locator)
+                self._add_slot(n)
+            if self._index is not None:
+                # Update the access time
+                self._index.record_access(locator, n.size())
+            self._touch_open_block(n)
+            if self._lower is not None:
+                self.cap_cache()
+            return n
         return None
 
-    def get(self, locator):
-        with self._cache_lock:
-            return self._get(locator)
-
     def reserve_cache(self, locator):
         '''Reserve a cache slot for the specified locator,
         or return the existing slot.'''
+        n = self.get(locator)
+        if n:
+            self.hits_counter.add(1)
+            return n, False
+        n, first = self._reserve_new(locator)
+        if first and self._fetch_locks is not None:
+            try:
+                first = self._reserve_shared(n)
+            except BaseException:
+                # Don't leave other threads waiting for a slot nobody
+                # will fill.  They see None and fetch the block again.
+                n.set(None)
+                self._slot_filled(n, False)
+                raise
+        if first:
+            self.misses_counter.add(1)
+        else:
+            self.hits_counter.add(1)
+        return n, first
+
+    def _reserve_shared(self, slot):
+        # Wait for any other process fetching this block.  If it
+        # finished, fill the slot with its copy and return False.
+        # Otherwise return True, and keep holding the lock until
+        # set() is called with the block.
+        self._fetch_locks.acquire(slot.locator)
+        try:
+            existing = diskcache.DiskCacheSlot.get_from_disk(slot.locator, self._disk_cache_dir)
+        except BaseException:
+            self._fetch_locks.release(slot.locator)
+            raise
+        if existing is None:
+            return True
+        self._fetch_locks.release(slot.locator)
+        slot.filehandle = existing.filehandle
+        slot.content = existing.content
+        slot.ready.set()
+        self._slot_filled(slot, True)
+        return False
+
+    def _reserve_new(self, locator):
         with self._cache_updating:
-            n = self._get(locator)
-            if n:
-                return n, False
-            else:
-                # Add a new cache slot for the locator
+            # Add a new cache slot for the locator
+            self._resize_cache(self.cache_max, self._max_slots-1)
+            while self._slot_count >= self._max_slots:
+                # If there isn't a slot available, need to wait for
+                # another thread to finish filling a slot (which makes
+                # it evictable) or release one.
+                self._cache_updating.wait()
                 self._resize_cache(self.cache_max, self._max_slots-1)
-                while len(self._cache) >= self._max_slots:
-                    # If there isn't a slot available, need to wait
-                    # for something to happen that releases one of the
-                    # cache slots.  Idle for 200 ms or woken up by
-                    # another thread
-                    self._cache_updating.wait(timeout=0.2)
-                    self._resize_cache(self.cache_max, self._max_slots-1)
-
-                if self._disk_cache:
-                    n = diskcache.DiskCacheSlot(locator, self._disk_cache_dir)
-                else:
-                    n = KeepBlockCache._CacheSlot(locator)
-                self._cache[n.locator] = n
-                return n, True
+
+            # Another thread may have reserved this locator while we
+            # were waiting.
+            shard = self._shard(locator)
+            with shard.lock:
+                n = shard.slots.get(locator)
+                if n is not None:
+                    if not self._is_dead(n):
+                        shard.policy.hit(locator)
+                        return n, False
+                    self._remove_slot(shard, n)
+
+            if self._disk_cache:
+                self._forget_unmapped(locator)
+                n = diskcache.DiskCacheSlot(locator, self._disk_cache_dir)
+            else:
+                n = KeepBlockCache._CacheSlot(locator)
+            self._add_slot(n)
+            return n, True
+
+    def _slot_filled(self, slot, filled):
+        with self._cache_updating:
+            if filled:
+                self.cache_total += slot.size()
+            # The slot is ready now, so it can be evicted.
+            self._cache_updating.notify_all()
+        if filled and self._index is not None:
+            self._index.record_add(slot.locator, slot.size())
+        if filled:
+            self._touch_open_block(slot)
 
     def set(self, slot, blob):
         try:
-            if slot.set(blob):
-                self.cache_total += slot.size()
+            self._set(slot, blob)
+        finally:
+            if self._fetch_locks is not None:
+                self._fetch_locks.release(slot.locator)
+
+    def _set(self, slot, blob):
+        try:
+            self._slot_filled(slot, slot.set(blob))
             return
         except OSError as e:
             if e.errno == errno.ENOMEM:
                 # Reduce max slots to current - 4, cap cache and retry
                 with self._cache_lock:
-                    self._max_slots = max(4, len(self._cache) - 4)
+                    self._max_slots = max(4, self._slot_count - 4)
             elif e.errno == errno.ENOSPC:
                 # Reduce disk max space to current - 256 MiB, cap cache and retry
                 with self._cache_lock:
-                    sm = sum(st.size() for st in self._cache.values())
+                    sm = sum(st.size() for st in self._all_slots()) + sum(self._unmapped.values())
                     self.cache_max = max((256 * 1024 * 1024), sm - (256 * 1024 * 1024))
             elif e.errno == errno.ENODEV:
                 _logger.error("Unable to use disk cache: The underlying filesystem does not support memory mapping.")
@@ -323,19 +656,117 @@ class KeepBlockCache(object):
             # exception handler adjusts limits downward in some cases
             # to free up resources, which would make the operation
             # succeed.
-            if slot.set(blob):
-                self.cache_total += slot.size()
+            self._slot_filled(slot, slot.set(blob))
         except Exception as e:
             # It failed again.  Give up.
             slot.set(None)
+            self._slot_filled(slot, False)
             raise arvados.errors.KeepCacheError("Unable to save block %s to disk cache: %s" % (slot.locator, e))
 
         self.cap_cache()
 
+    def _all_slots(self):
+        for shard in self._shards:
+            with shard.lock:
+                slots = list(shard.slots.values())
+            yield from slots
+
     def clear(self):
-        with self._cache_lock:
-            self._cache.clear()
+        with self._cache_updating:
+            for shard in self._shards:
+                with shard.lock:
+                    for locator in shard.slots:
+                        shard.policy.remove(locator)
+                    shard.slots.clear()
+            self._unmapped.clear()
+            with self._open_blocks_lock:
+                self._open_blocks.clear()
+            self._slot_count = 0
             self.cache_total = 0
+            self._demotions.clear()
+            self._cache_updating.notify_all()
+        if self._lower is not None:
+            self._wait_for_demotions()
+            self._lower.clear()
+        if self._index is not None:
+            # clear() is the last thing arv-mount does with its cache,
+            # so don't leave access records behind.
+            self._index.flush()
+
+class _ExtentCache(object):
+    """Small LRU cache of parts of blocks fetched by range requests"""
+    DEFAULT_MAX = 32 * 1024 * 1024
+
+    def __init__(self, cache_max=DEFAULT_MAX):
+        self.cache_max = cache_max
+        self.cache_total = 0
+        self._lock = threading.Lock()
+        # (md5sum, start) -> data, least recently used first
+        self._extents = collections.OrderedDict()
+        # md5sum -> set of starts
+        self._starts = collections.defaultdict(set)
+        # (md5sum, start, stop) -> _CacheSlot of extents being fetched
+        self._in_flight = {}
+
+    def reserve(self, md5sum, start, stop):
+        """Reserve the extent `start`-`stop` of a block for fetching
+
+        Returns (slot, first).  If `first` is True, the caller must
+        fetch the extent and pass it to `fill`.  Otherwise another
+        thread is fetching it, and `slot.get()` waits for its result,
+        which is None if that fetch failed.
+        """
+        key = (md5sum, start, stop)
+        with self._lock:
+            slot = self._in_flight.get(key)
+            if slot is not None:
+                return slot, False
+            slot = self._in_flight[key] = KeepBlockCache._CacheSlot(key)
+            return slot, True
+
+    def fill(self, slot, data):
+        """Finish fetching a reserved extent, with its data or None"""
+        md5sum, start, stop = slot.locator
+        if data is not None:
+            self.set(md5sum, start, data)
+        with self._lock:
+            del self._in_flight[slot.locator]
+        slot.content = data
+        slot.ready.set()
+
+    def get(self, md5sum, start, stop):
+        with self._lock:
+            for extent_start in self._starts.get(md5sum, ()):
+                data = self._extents[(md5sum, extent_start)]
+                if extent_start <= start and stop <= extent_start + len(data):
+                    self._extents.move_to_end((md5sum, extent_start))
+                    return data[start - extent_start:stop - extent_start]
+        return None
+
+    def set(self, md5sum, start, data):
+        if len(data) > self.cache_max:
+            return
+        with self._lock:
+            key = (md5sum, start)
+            old = self._extents.pop(key, None)
+            if old is not None:
+                self.cache_total -= len(old)
+            self._extents[key] = data
+            self._starts[md5sum].add(start)
+            self.cache_total += len(data)
+            while self.cache_total > self.cache_max:
+                (old_md5sum, old_start), old = self._extents.popitem(last=False)
+                self.cache_total -= len(old)
+                self._starts[old_md5sum].discard(old_start)
+                if not self._starts[old_md5sum]:
+                    del self._starts[old_md5sum]
+
+    def clear(self):
+        with self._lock:
+            self._extents.clear()
+            self._starts.clear()
+            self.cache_total = 0
+
 
 class _Counter:
     def __init__(self, v=0):
@@ -351,6 +782,288 @@ class _Counter:
             return self._val
 
 
+class _ResponseBody:
+    """Curl write target for Keep GET responses
+
+    A Keep block's size is given by its locator, so the body of a GET
+    response can be written straight into a bytearray of that size.
+    A read-only memoryview of that bytearray then becomes the block's
+    content, including in the block cache, without any further copies.
+    The buffer is allocated here rather than supplied by the caller,
+    since it is shared by every reader of the cached block, and nothing
+    may write to it once it is filled.  If the size is unknown,
+    or the response turns out to be bigger than expected (e.g., an
+    error message for a small block), the body is collected in a
+    BytesIO instead.
+
+    The MD5 digest of the body is updated as each chunk arrives, so
+    checking the block's hash overlaps with the download instead of
+    taking another pass over the whole block afterward.
+    """
+    __slots__ = ('_buffer', '_view', '_pos', '_overflow', '_md5')
+
+    def __init__(self, size=None):
+        self._md5 = hashlib.md5()
+        self._pos = 0
+        if size:
+            self._buffer = bytearray(size)
+            self._view = memoryview(self._buffer)
+            self._overflow = None
+        else:
+            self._buffer = None
+            self._view = None
+            self._overflow = BytesIO()
+
+    def write(self, data):
+        self._md5.update(data)
+        if self._overflow is not None:
+            return self._overflow.write(data)
+        end = self._pos + len(data)
+        if end > len(self._buffer):
+            self._overflow = BytesIO()
+            self._overflow.write(self._view[:self._pos])
+            return self._overflow.write(data)
+        self._view[self._pos:end] = data
+        self._pos = end
+
+    def getvalue(self):
+        if self._view is not None:
+            self._view.release()
+        if self._overflow is not None:
+            return self._overflow.getvalue()
+        if self._pos < len(self._buffer):
+            # Short response.  It won't pass the checksum, but return
+            # what we got.
+            del self._buffer[self._pos:]
+        return memoryview(self._buffer).toreadonly()
+
+    def hexdigest(self):
+        return self._md5.hexdigest()
+
+
+class _RequestBody:
+    """Curl read source for Keep PUT requests
+
+    Hands out the body in the chunks curl asks for, without first
+    copying the whole block the way `BytesIO` would for anything other
+    than `bytes`.  This lets callers upload a memoryview of a buffer
+    they are still holding.
+    """
+    __slots__ = ('_view', '_pos')
+
+    def __init__(self, data):
+        self._view = memoryview(data).cast('B')
+        self._pos = 0
+
+    def __len__(self):
+        return len(self._view)
+
+    def read(self, size):
+        end = min(self._pos + size, len(self._view))
+        chunk = self._view[self._pos:end].tobytes()
+        self._pos = end
+        return chunk
+
+
+class _KeepServiceHealth:
+    """Process-wide scoreboard of Keep service latency and errors
+
+    Every `KeepClient._KeepService` reports the outcome of each request
+    here, keyed by service root.  `KeepClient.weighted_service_roots`
+    uses the scoreboard to move services that are currently failing or
+    much slower than their peers to the end of the probe order.  Within
+    each group, rendezvous order is preserved.
+
+    Latency is averaged separately for each request method and response
+    size bucket, so a service that just transferred large blocks is only
+    compared with its peers' timings for blocks of the same size.
+    """
+    # Weight of the newest sample in the moving averages.
+    EWMA_ALPHA = 0.3
+    # Upper bounds of the size buckets for latency averages, in bytes
+    # sent or received.  Larger requests go in one last bucket.
+    SIZE_BUCKETS = (1 << 16, 1 << 20, 1 << 24)
+    # A service whose most recent request failed is demoted for this
+    # many seconds.  After that it gets probed in rendezvous order
+    # again, so it can recover.
+    FAILURE_TTL = 30
+    # A service is considered slow when its average latency for some
+    # method and size bucket is more than SLOW_FACTOR times the median
+    # of its peers for the same, and at least SLOW_MIN_SECS.
+    SLOW_FACTOR = 4
+    SLOW_MIN_SECS = 1.0
+    # Window, in seconds, for the recent server/transport error counts.
+    RECENT_WINDOW = 300
+
+    class _Stats:
+        __slots__ = (
+            "latency", "error_rate", "consecutive_failures", "last_failure",
+            "recent_server_errors", "recent_transport_errors",
+        )
+
+        def __init__(self):
+            # {(method, size bucket): average seconds}
+            self.latency = {}
+            self.error_rate = 0.0
+            self.consecutive_failures = 0
+            self.last_failure = None
+            self.recent_server_errors = collections.deque()
+            self.recent_transport_errors = collections.deque()
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, root, secs, status_code, method='GET', size=0):
+        """Record the outcome of one request to the service at `root`
+
+        `status_code` is the HTTP response status, or None if the request
+        failed without a response (connection error, timeout).  Responses
+        other than 5xx mean the service is healthy, even if the request
+        itself was unsuccessful (e.g., 404).  `method` is the HTTP request
+        method, and `size` the number of bytes of data sent or received.
+        """
+        now = time.monotonic()
+        failed = status_code is None or status_code >= 500
+        alpha = self.EWMA_ALPHA
+        with self._lock:
+            st = self._stats.get(root)
+            if st is None:
+                st = self._stats[root] = self._Stats()
+            st.error_rate = (1 - alpha) * st.error_rate + alpha * failed
+            if failed:
+                st.consecutive_failures += 1
+                st.last_failure = now
+                if status_code is None:
+                    st.recent_transport_errors.append(now)
+                else:
+                    st.recent_server_errors.append(now)
+            else:
+                st.consecutive_failures = 0
+                key = (method, bisect.bisect_left(self.SIZE_BUCKETS, size))
+                latency = st.latency.get(key)
+                if latency is None:
+                    st.latency[key] = secs
+                else:
+                    st.latency[key] = (1 - alpha) * latency + alpha * secs
+            for recent in (st.recent_server_errors, st.recent_transport_errors):
+                while recent and recent[0] < now - self.RECENT_WINDOW:
+                    recent.popleft()
+
+    def _penalty(self, st, now, slow_secs):
+        if st is None:
+            return 0
+        if st.consecutive_failures and now - st.last_failure < self.FAILURE_TTL:
+            return 2
+        if any(latency > slow_secs[key]
+               for key, latency in st.latency.items()
+               if key in slow_secs):
+            return 1
+        return 0
+
+    def prioritize(self, roots):
+        """Return `roots` reordered with unhealthy services last
+
+        Healthy services come first, then slow ones, then failing ones.
+        The relative order of services in each group is unchanged.
+        """
+        now = time.monotonic()
+        with self._lock:
+            stats = [self._stats.get(root) for root in roots]
+            latencies = collections.defaultdict(list)
+            for st in stats:
+                if st is not None:
+                    for key, latency in st.latency.items():
+                        latencies[key].append(latency)
+            slow_secs = {}
+            for key, peers in latencies.items():
+                if len(peers) > 1:
+                    peers.sort()
+                    slow_secs[key] = max(self.SLOW_MIN_SECS,
+                                         self.SLOW_FACTOR * peers[len(peers) // 2])
+            penalties = [self._penalty(st, now, slow_secs) for st in stats]
+        if not any(penalties):
+            return roots
+        return [root for _, root in sorted(zip(penalties, roots), key=lambda pr: pr[0])]
+
+    def stats(self, root):
+        """Return a dict summarizing the recorded history of `root`"""
+        now = time.monotonic()
+        with self._lock:
+            st = self._stats.get(root)
+            if st is None:
+                return None
+            return {
+                'latency': dict(st.latency),
+                'error_rate': st.error_rate,
+                'consecutive_failures': st.consecutive_failures,
+                'recent_server_errors': sum(
+                    1 for t in st.recent_server_errors if t >= now - self.RECENT_WINDOW),
+                'recent_transport_errors': sum(
+                    1 for t in st.recent_transport_errors if t >= now - self.RECENT_WINDOW),
+            }
+
+    def reset(self):
+        """Forget all recorded history"""
+        with self._lock:
+            self._stats.clear()
+
+
+_service_health = _KeepServiceHealth()
+
+
+class _DeadlineTimer(object):
+    """Run callbacks after a delay, all on one long-lived thread
+
+    The thread is started the first time a callback is scheduled.
+    Callbacks should return quickly, since later ones wait for them.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._heap = []
+        self._seq = itertools.count()
+        self._thread = None
+
+    def call_later(self, delay, callback):
+        """Run `callback` after `delay` seconds
+
+        Returns a handle to pass to `cancel`.
+        """
+        entry = [time.monotonic() + delay, next(self._seq), callback]
+        with self._cond:
+            heapq.heappush(self._heap, entry)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return entry
+
+    def cancel(self, entry):
+        """Don't run a scheduled callback, if it hasn't started yet"""
+        with self._cond:
+            entry[2] = None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    while self._heap and self._heap[0][2] is None:
+                        heapq.heappop(self._heap)
+                    now = time.monotonic()
+                    if self._heap and self._heap[0][0] <= now:
+                        callback = heapq.heappop(self._heap)[2]
+                        break
+                    self._cond.wait(self._heap[0][0] - now if self._heap else None)
+            try:
+                callback()
+            except Exception:
+                _logger.exception("Exception in timer callback")
+
+
+_hedge_timer = _DeadlineTimer()
+
+
 class KeepClient(object):
     DEFAULT_TIMEOUT = PyCurlHelper.DEFAULT_TIMEOUT
     DEFAULT_PROXY_TIMEOUT = PyCurlHelper.DEFAULT_PROXY_TIMEOUT
@@ -377,7 +1090,8 @@ class KeepClient(object):
                      upload_counter=None,
                      download_counter=None,
                      headers={},
-                     insecure=False):
+                     insecure=False,
+                     health=None):
             super().__init__()
             self.root = root
             self._user_agent_pool = user_agent_pool
@@ -391,6 +1105,9 @@ class KeepClient(object):
             self.upload_counter = upload_counter
             self.download_counter = download_counter
             self.insecure = insecure
+            self._cancelled = threading.Event()
+            self.cancellable = False
+            self._health = health
 
         def usable(self):
             """Is it worth attempting a request?"""
@@ -403,6 +1120,28 @@ class KeepClient(object):
         def last_result(self):
             return self._result
 
+        def cancel(self):
+            """Abort the request in progress, if any.
+
+            This is used to cancel the slower request when a hedged read
+            gets an answer from another service.  A cancelled request
+            fails like a transient network error.  Only requests started
+            after setting `cancellable` can be cancelled while they are
+            in progress.
+            """
+            self._cancelled.set()
+
+        def _record_health(self, secs, method, size):
+            # Cancelled requests say nothing about the service's health.
+            if self._health is None or self._cancelled.is_set():
+                return
+            self._health.record(self.root, secs, self._result.get('status_code'),
+                                method=method, size=size)
+
+        def _xferinfofunction(self, *args):
+            # Returning nonzero tells curl to abort the transfer.
+            return 1 if self._cancelled.is_set() else 0
+
         def _get_user_agent(self):
             try:
                 return self._user_agent_pool.get(block=False)
@@ -416,8 +1155,10 @@ class KeepClient(object):
             except:
                 ua.close()
 
-        def get(self, locator, method="GET", timeout=None):
-            # locator is a KeepLocator object.
+        def get(self, locator, method="GET", timeout=None, byte_range=None):
+            # locator is a KeepLocator object.  byte_range is an
+            # optional (start, stop) tuple; the service may answer
+            # with just those bytes, or with the whole block.
             url = self.root + str(locator)
             _logger.debug("Request: %s %s", method, url)
             curl = self._get_user_agent()
@@ -425,15 +1166,24 @@ class KeepClient(object):
             try:
                 with Timer() as t:
                     self._headers = {}
-                    response_body = BytesIO()
+                    if byte_range is not None:
+                        response_body = _ResponseBody(byte_range[1] - byte_range[0])
+                    else:
+                        response_body = _ResponseBody(locator.size if method == "GET" else None)
+                    request_headers = [
+                        '{}: {}'.format(k,v) for k,v in self.get_headers.items()]
+                    if byte_range is not None:
+                        request_headers.append('Range: bytes={}-{}'.format(byte_range[0], byte_range[1] - 1))
                     curl.setopt(pycurl.NOSIGNAL, 1)
                     curl.setopt(pycurl.OPENSOCKETFUNCTION,
                                 lambda *args, **kwargs: self._socket_open(*args, **kwargs))
                     curl.setopt(pycurl.URL, url.encode('utf-8'))
-                    curl.setopt(pycurl.HTTPHEADER, [
-                        '{}: {}'.format(k,v) for k,v in self.get_headers.items()])
+                    curl.setopt(pycurl.HTTPHEADER, request_headers)
                     curl.setopt(pycurl.WRITEFUNCTION, response_body.write)
                     curl.setopt(pycurl.HEADERFUNCTION, self._headerfunction)
+                    if self.cancellable:
+                        curl.setopt(pycurl.NOPROGRESS, 0)
+                        curl.setopt(pycurl.XFERINFOFUNCTION, self._xferinfofunction)
                     if self.insecure:
                         curl.setopt(pycurl.SSL_VERIFYPEER, 0)
                         curl.setopt(pycurl.SSL_VERIFYHOST, 0)
@@ -469,6 +1219,7 @@ class KeepClient(object):
                 self._result = {
                     'error': e,
                 }
+            self._record_health(t.secs, method, len(self._result.get('body') or b''))
             self._usable = ok != False
             if self._result.get('status_code', None):
                 # The client worked well enough to get an HTTP status
@@ -501,7 +1252,22 @@ class KeepClient(object):
 
             if self.download_counter:
                 self.download_counter.add(len(self._result['body']))
-            resp_md5 = hashlib.md5(self._result['body']).hexdigest()
+            if byte_range is not None and self._result['status_code'] == 206:
+                # A partial block can't be checked against the
+                # locator's hash, so check that the service says it
+                # sent the bytes asked for, and that it sent that many.
+                content_range = 'bytes {}-{}/{}'.format(
+                    byte_range[0], byte_range[1] - 1, locator.size)
+                if (self._headers.get('content-range') != content_range or
+                    len(self._result['body']) != byte_range[1] - byte_range[0]):
+                    _logger.warning("Range fail: %s bytes %s-%s returned %s bytes (Content-Range: %s)",
+                                    url, byte_range[0], byte_range[1] - 1, len(self._result['body']),
+                                    self._headers.get('content-range'))
+                    self._result['error'] = arvados.errors.HttpError(
+                        0, 'Range fail')
+                    return None
+                return self._result['body']
+            resp_md5 = response_body.hexdigest()
             if resp_md5 != locator.md5sum:
                 _logger.warning("Checksum fail: md5(%s) = %s",
                                 url, resp_md5)
@@ -520,7 +1286,7 @@ class KeepClient(object):
             try:
                 with Timer() as t:
                     self._headers = {}
-                    body_reader = BytesIO(body)
+                    body_reader = _RequestBody(body)
                     response_body = BytesIO()
                     curl.setopt(pycurl.NOSIGNAL, 1)
                     curl.setopt(pycurl.OPENSOCKETFUNCTION,
@@ -533,7 +1299,7 @@ class KeepClient(object):
                     # is invalid or the server is read-only, without waiting for
                     # the client to send the entire block.
                     curl.setopt(pycurl.UPLOAD, True)
-                    curl.setopt(pycurl.INFILESIZE, len(body))
+                    curl.setopt(pycurl.INFILESIZE, len(body_reader))
                     curl.setopt(pycurl.READFUNCTION, body_reader.read)
                     curl.setopt(pycurl.HTTPHEADER, [
                         '{}: {}'.format(k,v) for k,v in put_headers.items()])
@@ -568,6 +1334,7 @@ class KeepClient(object):
                 self._result = {
                     'error': e,
                 }
+            self._record_health(t.secs, "PUT", len(body_reader))
             self._usable = ok != False # still usable if ok is True or None
             if self._result.get('status_code', None):
                 # Client is functional. See comment in get().
@@ -673,8 +1440,72 @@ class KeepClient(object):
                         self.pending_tries_notification.wait()
 
 
+    class _KeepWriterExecutor:
+        """Long-lived, bounded pool of threads that run Keep writes.
+
+        A KeepClient keeps one of these so that all of its put() calls
+        share the same threads instead of starting new ones for every
+        block.  Threads are started as needed, up to `max_threads` or the
+        number of callers waiting for their jobs, whichever is larger,
+        and then stay around to run later jobs.
+        """
+        def __init__(self, max_threads):
+            self.max_threads = max(1, max_threads)
+            self._jobs = queue.Queue()
+            self._lock = threading.Lock()
+            self._threads = []
+            self._idle = 0
+            self._callers = 0
+
+        def add_caller(self):
+            """Note that a caller is about to submit jobs and wait for them.
+
+            Callers like the upload threads of a `_BlockManager` can
+            outnumber `max_threads`.  Until the matching
+            `remove_caller()`, the pool can grow so every waiting caller
+            has a thread, instead of silently queueing behind the others.
+            """
+            with self._lock:
+                self._callers += 1
+
+        def remove_caller(self):
+            with self._lock:
+                self._callers -= 1
+
+        def submit(self, job):
+            with self._lock:
+                self._jobs.put(job)
+                if (self._jobs.qsize() > self._idle and
+                    len(self._threads) < max(self.max_threads, self._callers)):
+                    thread = threading.Thread(target=self._run, daemon=True)
+                    self._threads.append(thread)
+                    thread.start()
+
+        def _run(self):
+            while True:
+                with self._lock:
+                    self._idle += 1
+                job = self._jobs.get()
+                with self._lock:
+                    self._idle -= 1
+                if job is None:
+                    return
+                try:
+                    job()
+                except Exception:
+                    _logger.exception("Exception in _KeepWriterExecutor")
+
+        def shutdown(self):
+            with self._lock:
+                threads, self._threads = self._threads, []
+                for _ in threads:
+                    self._jobs.put(None)
+            for thread in threads:
+                thread.join()
+
+
     class _KeepWriterThreadPool:
-        def __init__(self, data, data_hash, copies, max_service_replicas, timeout=None, classes=[]):
+        def __init__(self, data, data_hash, copies, max_service_replicas, timeout=None, classes=[], executor=None):
             self.total_task_nr = 0
             if (not max_service_replicas) or (max_service_replicas >= copies):
                 num_threads = 1
@@ -683,6 +1514,9 @@ class KeepClient(object):
             _logger.debug("Pool max threads is %d", num_threads)
             self.workers = []
             self.queue = KeepClient._KeepWriterQueue(copies, classes)
+            # If an executor is given, the workers run on its threads.
+            # Otherwise each worker is started as its own thread.
+            self.executor = executor
             # Create workers
             for _ in range(num_threads):
                 w = KeepClient._KeepWriterThread(self.queue, data, data_hash, timeout)
@@ -696,11 +1530,20 @@ class KeepClient(object):
             return self.queue.successful_copies, self.queue.satisfied_classes()
 
         def join(self):
-            # Start workers
-            for worker in self.workers:
-                worker.start()
-            # Wait for finished work
-            self.queue.join()
+            if self.executor is not None:
+                self.executor.add_caller()
+            try:
+                # Start workers
+                for worker in self.workers:
+                    if self.executor is None:
+                        worker.start()
+                    else:
+                        self.executor.submit(worker.run)
+                # Wait for finished work
+                self.queue.join()
+            finally:
+                if self.executor is not None:
+                    self.executor.remove_caller()
 
         def response(self):
             return self.queue.response
@@ -788,7 +1631,9 @@ class KeepClient(object):
     def __init__(self, api_client=None, proxy=None,
                  timeout=DEFAULT_TIMEOUT, proxy_timeout=DEFAULT_PROXY_TIMEOUT,
                  api_token=None, local_store=None, block_cache=None,
-                 num_retries=10, session=None, num_prefetch_threads=None):
+                 num_retries=10, session=None, num_prefetch_threads=None,
+                 hedge_delay=None, num_writer_threads=None,
+                 cache_eviction_policy=None, max_range_read=0):
         """Initialize a new KeepClient.
 
         Arguments:
@@ -842,6 +1687,32 @@ class KeepClient(object):
           The default number of times to retry failed requests.
           This will be used as the default num_retries value when get() and
           put() are called.  Default 10.
+
+        :hedge_delay:
+          If specified, GET and HEAD requests are hedged: when a Keep
+          service has not answered within this many seconds, the same
+          request is also sent to the next service in probe order, and
+          the first successful answer is used.  The slower request is
+          cancelled.  If unspecified, services are tried one at a time.
+
+        :num_writer_threads:
+          The maximum number of threads used to send blocks to Keep
+          services.  These threads are shared by all put() calls on
+          this client.  Default 16.  More threads are started while
+          more put() calls than this are waiting.
+
+        :cache_eviction_policy:
+          The name of the eviction policy for the block cache this
+          KeepClient builds: `'lru'` (the default) or `'s3fifo'`, which
+          keeps frequently read blocks cached through large sequential
+          reads.  It is an error to specify both block_cache and
+          cache_eviction_policy.
+
+        :max_range_read:
+          If nonzero, ArvadosFile reads of up to this many bytes that
+          aren't part of a sequential read, from blocks that aren't
+          cached, fetch just the needed part of the block with
+          get_range().  Default 0 (always fetch whole blocks).
         """
         self.lock = threading.Lock()
         if proxy is None:
@@ -865,7 +1736,12 @@ class KeepClient(object):
         else:
             self.insecure = api_client.insecure
 
-        self.block_cache = block_cache if block_cache else KeepBlockCache()
+        if block_cache is None:
+            block_cache = KeepBlockCache(eviction_policy=cache_eviction_policy)
+        elif cache_eviction_policy is not None:
+            raise ValueError(
+                "can't build KeepClient with both block_cache and cache_eviction_policy")
+        self.block_cache = block_cache
         self.timeout = timeout
         self.proxy_timeout = proxy_timeout
         self._user_agent_pool = queue.LifoQueue()
@@ -883,11 +1759,22 @@ class KeepClient(object):
             self.num_prefetch_threads = 2
         self._prefetch_queue = None
         self._prefetch_threads = None
+        self.hedge_delay = hedge_delay
+        self.max_range_read = max_range_read
+        self._extent_cache = _ExtentCache()
+        self._range_unsupported = False
+        self._service_health = _service_health
+        if num_writer_threads is not None:
+            self.num_writer_threads = num_writer_threads
+        else:
+            self.num_writer_threads = 16
+        self._writer_executor = None
 
         if local_store:
             self.local_store = local_store
             self.head = self.local_store_head
             self.get = self.local_store_get
+            self.get_range = self.local_store_get_range
             self.put = self.local_store_put
         else:
             self.num_retries = num_retries
@@ -951,6 +1838,14 @@ class KeepClient(object):
         return any(ks.get('service_type', 'disk') != 'disk'
                    for ks in service_list)
 
+    def writable_services_count(self):
+        """Return the number of writable Keep services
+
+        Returns 0 if the services list hasn't been loaded yet.  This
+        never makes an API request.
+        """
+        return len(getattr(self, '_writable_services', None) or ())
+
     def build_services_list(self, force_rebuild=False):
         if (self._static_services_list or
               (self._keep_services and not force_rebuild)):
@@ -1007,6 +1902,9 @@ class KeepClient(object):
         """Return an array of Keep service endpoints, in the order in
         which they should be probed when reading or writing data with
         the given hash+hints.
+
+        Services that recently failed, or are much slower than their
+        peers, are moved after the healthy ones.
         """
         self.build_services_list(force_rebuild)
 
@@ -1031,11 +1929,14 @@ class KeepClient(object):
         if need_writable:
             use_services = self._writable_services
         self.using_proxy = self._any_nondisk_services(use_services)
-        sorted_roots.extend([
+        # Services that are currently failing or slow are moved to
+        # the end of the list; healthy ones keep their rendezvous
+        # order.
+        sorted_roots.extend(self._service_health.prioritize([
             svc['_service_root'] for svc in sorted(
                 use_services,
                 reverse=True,
-                key=lambda svc: self._service_weight(locator.md5sum, svc['uuid']))])
+                key=lambda svc: self._service_weight(locator.md5sum, svc['uuid']))]))
         _logger.debug("{}: {}".format(locator, sorted_roots))
         return sorted_roots
 
@@ -1053,7 +1954,8 @@ class KeepClient(object):
                     upload_counter=self.upload_counter,
                     download_counter=self.download_counter,
                     headers=headers,
-                    insecure=self.insecure)
+                    insecure=self.insecure,
+                    health=self._service_health)
         return local_roots
 
     @staticmethod
@@ -1074,12 +1976,15 @@ class KeepClient(object):
         else:
             return None
 
-    def get_from_cache(self, loc_s):
-        """Fetch a block only if is in the cache, otherwise return None."""
+    def get_from_cache(self, loc_s, return_memoryview=False):
+        """Fetch a block only if is in the cache, otherwise return None.
+
+        See `get()` for `return_memoryview`.
+        """
         locator = KeepLocator(loc_s)
         slot = self.block_cache.get(locator.md5sum)
         if slot is not None and slot.ready.is_set():
-            return slot.get()
+            return self._copy_shared(slot.get(), return_memoryview)
         else:
             return None
 
@@ -1093,10 +1998,188 @@ class KeepClient(object):
         return self._get_or_head(loc_s, method="HEAD", **kwargs)
 
     @retry.retry_method
-    def get(self, loc_s, **kwargs):
-        return self._get_or_head(loc_s, method="GET", **kwargs)
+    def get(self, loc_s, return_memoryview=False, **kwargs):
+        """Fetch a block from Keep, or from the block cache
+
+        Returns the block's content as `bytes`, or as an `mmap` of the
+        block's file when it comes from the disk cache.
+
+        If `return_memoryview` is True, a block held in the RAM cache is
+        returned as a read-only `memoryview` of the cached data rather
+        than a copy.  Callers that only read it, like `ArvadosFile`,
+        save copying the whole block on every read.
+        """
+        return self._copy_shared(self._get_or_head(loc_s, method="GET", **kwargs),
+                                 return_memoryview)
+
+    @staticmethod
+    def _copy_shared(blob, return_memoryview):
+        # The RAM cache holds read-only views of the buffers GET
+        # responses were read into, shared by all readers.
+        if isinstance(blob, memoryview) and not return_memoryview:
+            return blob.tobytes()
+        return blob
+
+    # Range requests are widened to multiples of this size, so nearby
+    # small reads can be served from the same cached extent.
+    RANGE_ALIGNMENT = 64 * 1024
 
-    def _get_or_head(self, loc_s, method="GET", num_retries=None, request_id=None, headers=None, prefetch=False):
+    @retry.retry_method
+    def get_range(self, loc_s, offset, size, num_retries=None, request_id=None):
+        """Fetch part of a block from Keep.
+
+        Returns up to `size` bytes of the block `loc_s`, starting at
+        `offset`.  If the whole block is in the block cache, the data
+        comes from there.  Otherwise this sends an HTTP Range request
+        for the surrounding `RANGE_ALIGNMENT`-aligned extent, and keeps
+        the extent in a small cache of partial blocks for later reads.
+        Concurrent reads of the same extent share one request.
+
+        If a service answers a Range request with the whole block, it
+        is checked and added to the block cache as `get()` would, and
+        later calls fetch whole blocks with `get()` from the start.
+
+        Unlike whole blocks, partial blocks can't be checked against
+        the block's hash; only their Content-Range and size are.
+        """
+        locator = KeepLocator(loc_s)
+        if locator.size is not None:
+            size = max(0, min(size, locator.size - offset))
+        if size == 0:
+            return b''
+        blob = self.get_from_cache(loc_s, return_memoryview=True)
+        if blob is not None:
+            return bytes(memoryview(blob)[offset:offset+size])
+
+        start = offset - offset % self.RANGE_ALIGNMENT
+        stop = offset + size + (-(offset + size) % self.RANGE_ALIGNMENT)
+        if (self._range_unsupported or locator.size is None or
+            (start == 0 and stop >= locator.size)):
+            blob = self.get(loc_s, num_retries=num_retries, request_id=request_id, return_memoryview=True)
+            return bytes(memoryview(blob)[offset:offset+size])
+        stop = min(stop, locator.size)
+
+        while True:
+            data = self._extent_cache.get(locator.md5sum, offset, offset + size)
+            if data is not None:
+                self.hits_counter.add(1)
+                return data
+            slot, first = self._extent_cache.reserve(locator.md5sum, start, stop)
+            if first:
+                break
+            data = slot.get()
+            if data is not None:
+                self.hits_counter.add(1)
+                return data[offset - start:offset - start + size]
+            # The other fetch failed; try again.
+
+        data = None
+        try:
+            blob = self._get_or_head(loc_s, method="GET", num_retries=num_retries,
+                                     request_id=request_id, byte_range=(start, stop))
+            if len(blob) == locator.size:
+                # The service ignored the Range header and sent (and we
+                # checked) the whole block.  Cache it as get() would,
+                # and stop asking for ranges.
+                self._range_unsupported = True
+                block_slot, first = self.block_cache.reserve_cache(locator.md5sum)
+                if first:
+                    self.block_cache.set(block_slot, blob)
+                data = bytes(memoryview(blob)[start:stop])
+            else:
+                data = bytes(blob)
+            return data[offset - start:offset - start + size]
+        finally:
+            self._extent_cache.fill(slot, data)
+
+    def get_many(self, locators, ordered=True, threads=4, **kwargs):
+        """Fetch several blocks from Keep concurrently.
+
+        This method fetches the blocks named in `locators` using a pool
+        of up to `threads` worker threads, and yields a `(locator,
+        data)` tuple for each item of `locators`.  Each distinct block
+        is only fetched once.  Blocks that are already cached, or that
+        another thread is already downloading, are taken from the block
+        cache as they would be by `get()`.
+
+        If `ordered` is true (the default), results are yielded in the
+        same order as `locators`.  Otherwise, they are yielded as soon as
+        they arrive.  At most `2 * threads` blocks are being fetched or
+        held waiting to be yielded at any time.  If fetching a block
+        fails, the error is raised when that block's result would have
+        been yielded.
+
+        Additional keyword arguments are passed to `get()`.
+        """
+        locators = list(locators)
+        remaining = collections.Counter(locators)
+        unique = list(uniq(locators))
+        if not unique:
+            return
+        todo = queue.Queue()
+        results = queue.Queue()
+        stop = threading.Event()
+
+        def _worker():
+            while True:
+                loc_s = todo.get()
+                if loc_s is None or stop.is_set():
+                    return
+                try:
+                    results.put((loc_s, self.get(loc_s, **kwargs), None))
+                except Exception as e:
+                    results.put((loc_s, None, e))
+
+        workers = [threading.Thread(target=_worker, daemon=True)
+                   for _ in range(max(1, min(threads, len(unique))))]
+        for worker in workers:
+            worker.start()
+        window = 2 * len(workers)
+        submitted = 0
+        in_flight = 0
+        yielded = 0
+        next_out = 0
+        done = {}
+        unyielded = set()
+        try:
+            while yielded < len(locators):
+                # Limit the number of blocks being fetched, plus
+                # fetched blocks that haven't been yielded yet.
+                while submitted < len(unique) and in_flight + len(unyielded) < window:
+                    todo.put(unique[submitted])
+                    submitted += 1
+                    in_flight += 1
+                loc_s, blob, error = results.get()
+                in_flight -= 1
+                done[loc_s] = (blob, error)
+                unyielded.add(loc_s)
+                if ordered:
+                    ready = []
+                    while next_out < len(locators) and locators[next_out] in done:
+                        ready.append(locators[next_out])
+                        next_out += 1
+                else:
+                    ready = [loc_s] * remaining[loc_s]
+                for loc_s in ready:
+                    blob, error = done[loc_s]
+                    if error is not None:
+                        raise error
+                    unyielded.discard(loc_s)
+                    remaining[loc_s] -= 1
+                    if remaining[loc_s] == 0:
+                        del done[loc_s]
+                    yielded += 1
+                    yield loc_s, blob
+        finally:
+            # Let requests already in progress finish, so nothing is
+            # still writing to the block cache after we return.
+            stop.set()
+            for worker in workers:
+                todo.put(None)
+            for worker in workers:
+                worker.join()
+
+    def _get_or_head(self, loc_s, method="GET", num_retries=None, request_id=None, headers=None, prefetch=False, byte_range=None):
         """Get data from Keep.
 
         This method fetches one or more blocks of data from Keep.  It
@@ -1115,9 +2198,14 @@ class KeepClient(object):
           to fetch data from every available Keep service, along with any
           that are named in location hints in the locator.  The default value
           is set when the KeepClient is initialized.
+        * byte_range: A (start, stop) tuple.  If given, ask for just
+          these bytes of the block, bypassing the block cache.  The
+          result may be the whole block, if the service doesn't
+          support range requests.
         """
         if ',' in loc_s:
-            return ''.join(self.get(x) for x in loc_s.split(','))
+            return b''.join(blob for _, blob in self.get_many(
+                loc_s.split(','), num_retries=num_retries, request_id=request_id))
 
         self.get_counter.add(1)
 
@@ -1132,7 +2220,7 @@ class KeepClient(object):
         blob = None
         try:
             locator = KeepLocator(loc_s)
-            if method == "GET":
+            if method == "GET" and byte_range is None:
                 while slot is None:
                     slot, first = self.block_cache.reserve_cache(locator.md5sum)
                     if first:
@@ -1187,7 +2275,8 @@ class KeepClient(object):
                                        upload_counter=self.upload_counter,
                                        download_counter=self.download_counter,
                                        headers=headers,
-                                       insecure=self.insecure)
+                                       insecure=self.insecure,
+                                       health=self._service_health)
                 for root in hint_roots
             }
 
@@ -1216,10 +2305,14 @@ class KeepClient(object):
                 services_to_try = [roots_map[root]
                                    for root in sorted_roots
                                    if roots_map[root].usable()]
-                for keep_service in services_to_try:
-                    blob = keep_service.get(locator, method=method, timeout=self.current_timeout(num_retries-tries_left))
-                    if blob is not None:
-                        break
+                timeout = self.current_timeout(num_retries-tries_left)
+                if self.hedge_delay is not None:
+                    blob = self._hedged_get(services_to_try, locator, method, timeout, byte_range)
+                else:
+                    for keep_service in services_to_try:
+                        blob = keep_service.get(locator, method=method, timeout=timeout, byte_range=byte_range)
+                        if blob is not None:
+                            break
                 loop.save_result((blob, len(services_to_try)))
 
             # Always cache the result, then return it if we succeeded.
@@ -1246,15 +2339,98 @@ class KeepClient(object):
             raise arvados.errors.KeepReadError(
                 "[{}] failed to read {} after {}".format(request_id, loc_s, loop.attempts_str()), service_errors, label="service")
 
+    def _hedged_get(self, services, locator, method, timeout, byte_range=None):
+        """Request a block from services, hedging against slow ones.
+
+        Services are tried in the given order, on the calling thread.
+        When a request has not been answered after `hedge_delay`
+        seconds, a hedge thread sends it to the next service, and goes on
+        down the list while its own requests fail.  At most two requests
+        are in flight at once, and whichever succeeds first cancels the
+        other.  Returns the first successful result, or None if every
+        service fails.
+        """
+        lock = threading.Lock()
+        pending = collections.deque(services)
+        # Each hedge thread puts its successful result, or None, here
+        # just before it stops.
+        results = queue.Queue()
+        # The services being requested on the calling thread and on the
+        # hedge thread, and whether the hedge thread is running.
+        current = None
+        hedge_service = None
+        hedging = False
+
+        def _hedge():
+            nonlocal hedging
+            with lock:
+                if current is None or not pending or hedging:
+                    return
+                hedging = True
+            _logger.debug("Hedging %s %s after %s seconds", method, locator, self.hedge_delay)
+            threading.Thread(target=_run_hedge, daemon=True).start()
+
+        def _run_hedge():
+            nonlocal hedging, hedge_service
+            blob = None
+            while blob is None:
+                with lock:
+                    if current is None or not pending:
+                        break
+                    hedge_service = pending.popleft()
+                    hedge_service.cancellable = True
+                try:
+                    blob = hedge_service.get(locator, method=method, timeout=timeout, byte_range=byte_range)
+                except Exception:
+                    _logger.exception("Exception in hedged Keep request")
+            with lock:
+                if blob is not None and current is not None:
+                    current.cancel()
+                hedge_service = None
+                hedging = False
+                results.put(blob)
+
+        blob = None
+        while blob is None:
+            with lock:
+                if not pending:
+                    break
+                current = pending.popleft()
+                # Only a request that runs alongside another one may
+                # need to be cancelled.
+                current.cancellable = bool(pending) or hedging
+                timer = None
+                if pending and not hedging:
+                    timer = _hedge_timer.call_later(self.hedge_delay, _hedge)
+            try:
+                blob = current.get(locator, method=method, timeout=timeout, byte_range=byte_range)
+            finally:
+                if timer is not None:
+                    _hedge_timer.cancel(timer)
+                with lock:
+                    current = None
+                    if blob is not None and hedge_service is not None:
+                        hedge_service.cancel()
+            while blob is None and not results.empty():
+                blob = results.get()
+
+        # Wait for a hedge thread still going down the list.
+        while blob is None:
+            with lock:
+                if not hedging and results.empty():
+                    break
+            blob = results.get()
+        return blob
+
     @retry.retry_method
-    def put(self, data, copies=2, num_retries=None, request_id=None, classes=None):
+    def put(self, data, copies=2, num_retries=None, request_id=None, classes=None, data_hash=None):
         """Save data in Keep.
 
         This method will get a list of Keep services from the API server, and
-        send the data to each one simultaneously in a new thread.  Once the
-        uploads are finished, if enough copies are saved, this method returns
-        the most recent HTTP response body.  If requests fail to upload
-        enough copies, this method raises KeepWriteError.
+        send the data to them simultaneously using the client's shared writer
+        threads.  Once the uploads are finished, if enough copies are saved,
+        this method returns the most recent HTTP response body.  If requests
+        fail to upload enough copies, this method raises KeepWriteError.
 
         Arguments:
         * data: The string of data to upload.
@@ -1266,16 +2442,21 @@ class KeepClient(object):
           KeepClient is initialized.
         * classes: An optional list of storage class names where copies should
           be written.
+        * data_hash: The MD5 hex digest of data, if the caller has already
+          computed it.  It is trusted as given.
         """
 
         classes = classes or self._default_classes
 
-        if not isinstance(data, bytes):
+        if isinstance(data, str):
             data = data.encode()
+        elif isinstance(data, memoryview):
+            data = data.cast('B')
 
         self.put_counter.add(1)
 
-        data_hash = hashlib.md5(data).hexdigest()
+        if data_hash is None:
+            data_hash = hashlib.md5(data).hexdigest()
         loc_s = data_hash + '+' + str(len(data))
         if copies < 1:
             return loc_s
@@ -1314,6 +2495,7 @@ class KeepClient(object):
                 max_service_replicas=self.max_replicas_per_service,
                 timeout=self.current_timeout(num_retries - tries_left),
                 classes=pending_classes,
+                executor=self._get_writer_executor(),
             )
             for service_root, ks in [(root, roots_map[root])
                                      for root in sorted_roots]:
@@ -1354,6 +2536,19 @@ class KeepClient(object):
                 "[{}] failed to write {} after {} (wanted {} copies but wrote {})".format(
                     request_id, data_hash, loop.attempts_str(), (copies, classes), writer_pool.done()), service_errors, label="service")
 
+    def _get_writer_executor(self):
+        if self._writer_executor is None:
+            with self.lock:
+                if self._writer_executor is None:
+                    self._writer_executor = KeepClient._KeepWriterExecutor(self.num_writer_threads)
+        return self._writer_executor
+
+    def stop_writer_threads(self):
+        with self.lock:
+            if self._writer_executor is not None:
+                self._writer_executor.shutdown()
+            self._writer_executor = None
+
     def _block_prefetch_worker(self):
         """The background downloader thread."""
         while True:
@@ -1361,7 +2556,7 @@ class KeepClient(object):
                 b = self._prefetch_queue.get()
                 if b is None:
                     return
-                self.get(b, prefetch=True)
+                self.get(b, prefetch=True, return_memoryview=True)
             except Exception:
                 _logger.exception("Exception doing block prefetch")
 
@@ -1402,7 +2597,7 @@ class KeepClient(object):
             self._prefetch_threads = None
             self._prefetch_queue = None
 
-    def local_store_put(self, data, copies=1, num_retries=None, classes=[]):
+    def local_store_put(self, data, copies=1, num_retries=None, classes=[], data_hash=None):
         """A stub for put().
 
         This method is used in place of the real put() method when
@@ -1414,7 +2609,7 @@ class KeepClient(object):
 
         Data stored this way can be retrieved via local_store_get().
         """
-        md5 = hashlib.md5(data).hexdigest()
+        md5 = data_hash or hashlib.md5(data).hexdigest()
         locator = '%s+%d' % (md5, len(data))
         with open(os.path.join(self.local_store, md5 + '.tmp'), 'wb') as f:
             f.write(data)
@@ -1434,6 +2629,10 @@ class KeepClient(object):
         with open(os.path.join(self.local_store, locator.md5sum), 'rb') as f:
             return f.read()
 
+    def local_store_get_range(self, loc_s, offset, size, num_retries=None, request_id=None):
+        """Companion to local_store_put()."""
+        return self.local_store_get(loc_s)[offset:offset+size]
+
     def local_store_head(self, loc_s, num_retries=None):
         """Companion to local_store_put()."""
         try:
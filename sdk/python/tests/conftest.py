@@ -4,6 +4,8 @@
 
 import pytest
 
+import arvados.keep
+
 from . import run_test_server
 
 @pytest.fixture
@@ -13,3 +15,9 @@ def reset_test_server_db():
         yield
     finally:
         run_test_server.reset()
+
+@pytest.fixture(autouse=True)
+def reset_keep_service_health():
+    """Keep service health history is process-wide; isolate tests from it"""
+    arvados.keep._service_health.reset()
+    yield
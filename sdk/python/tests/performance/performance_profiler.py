@@ -14,6 +14,12 @@
 #
 #   See "test_a_sample.py" for a working example.
 #
+# Use report() to print a summary, such as timings of two ways of doing
+# the same thing, and save it next to the profiling data:
+#
+#   # See report in tmp/profile/foobar.txt
+#   report('foobar', 'took {:.3f}s'.format(elapsed))
+#
 # Performance tests run as part of regular test suite.
 # You can also run only the performance tests using one of the following:
 #     python -m unittest discover tests.performance
@@ -33,6 +39,11 @@ output_dir = os.path.abspath(os.path.join('tmp', 'profile'))
 if not os.path.exists(output_dir):
     os.makedirs(output_dir)
 
+def report(name, text):
+    print(text)
+    with open(os.path.join(output_dir, name + '.txt'), "w") as outfile:
+        outfile.write(text + '\n')
+
 def profiled(function):
     @functools.wraps(function)
     def profiled_function(*args, **kwargs):
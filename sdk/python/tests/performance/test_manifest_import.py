@@ -0,0 +1,129 @@
+# Copyright (C) The Arvados Authors. All rights reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import hashlib
+import os
+import time
+import unittest
+
+from unittest import mock
+
+import arvados.arvfile
+import arvados.collection
+
+from arvados._internal import streams
+from .performance_profiler import profiled, report
+
+def synthetic_manifest(nstreams, nfiles, nblocks, segments=1, blocksize=1 << 20):
+    """Build a manifest whose files are spread evenly over each stream's blocks.
+
+    With `segments` > 1, each file is stored as that many segments,
+    interleaved with the other files' segments the way concurrent writers
+    leave them.
+    """
+    lines = []
+    segsize = nblocks * blocksize // (nfiles * segments)
+    for s in range(nstreams):
+        tokens = ['./stream{}'.format(s) if s else '.']
+        for b in range(nblocks):
+            md5 = hashlib.md5('{}/{}'.format(s, b).encode()).hexdigest()
+            tokens.append('{}+{}'.format(md5, blocksize))
+        for n in range(nfiles * segments):
+            tokens.append('{}:{}:file\\040{}.dat'.format(n * segsize, segsize, n % nfiles))
+        lines.append(' '.join(tokens))
+    return '\n'.join(lines) + '\n'
+
+def api_client():
+    api = mock.MagicMock(name='api_client')
+    api._rootDesc = {}
+    return api
+
+def segment_by_segment(manifest_text):
+    """Build the collection for `manifest_text` one file segment at a time.
+
+    This is how `_import_manifest` used to load manifests, and is kept here
+    as the baseline for the benchmark.
+    """
+    coll = arvados.collection.Collection(api_client=api_client())
+    for line in manifest_text.splitlines():
+        tokens = line.split()
+        stream_name = coll._unescape_manifest_path(tokens[0])
+        coll.find_or_create(stream_name, arvados.collection.COLLECTION)
+        blocks = []
+        streamoffset = 0
+        for tok in tokens[1:]:
+            if coll._block_re.match(tok):
+                blocksize = int(tok.split('+')[1])
+                blocks.append(streams.Range(tok, streamoffset, blocksize, 0))
+                streamoffset += blocksize
+                continue
+            pos, size, name = tok.split(':', 2)
+            path = os.path.join(stream_name, coll._unescape_manifest_path(name))
+            afile = coll.find_or_create(path, arvados.collection.FILE)
+            afile.add_segment(blocks, int(pos), int(size))
+    coll.set_committed(True)
+    return coll
+
+
+class ManifestImportBenchmark(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.MANIFEST = synthetic_manifest(nstreams=50, nfiles=400, nblocks=400)
+        cls.FRAGMENTED_MANIFEST = synthetic_manifest(nstreams=20, nfiles=20, nblocks=2000, segments=500)
+
+    def import_both_ways(self, name, manifest_text):
+        """Import `manifest_text` segment by segment and in a single pass.
+
+        Reports how long each took, without asserting anything about
+        it, since wall-clock times vary too much between test hosts.
+        """
+        started = time.monotonic()
+        baseline = segment_by_segment(manifest_text)
+        baseline_elapsed = time.monotonic() - started
+        started = time.monotonic()
+        coll = arvados.collection.Collection(manifest_text, api_client=api_client())
+        elapsed = time.monotonic() - started
+        report(name, 'imported {} bytes of manifest in {:.3f}s segment by segment, '
+               '{:.3f}s in a single pass ({:.1f}x)'.format(
+                   len(manifest_text), baseline_elapsed, elapsed,
+                   baseline_elapsed / max(elapsed, 1e-9)))
+        self.assertEqual(coll.manifest_text(normalize=True),
+                         baseline.manifest_text(normalize=True))
+        return coll
+
+    @profiled
+    def test_import_large_manifest(self):
+        coll = self.import_both_ways('test_import_large_manifest', self.MANIFEST)
+        self.assertEqual(len(coll), 50 - 1 + 400)
+        self.assertEqual(coll.find('stream1/file 399.dat').size(), (400 << 20) // 400)
+
+    @profiled
+    def test_import_fragmented_manifest(self):
+        self.import_both_ways('test_import_fragmented_manifest', self.FRAGMENTED_MANIFEST)
+
+    def test_import_skips_add_segment(self):
+        manifest_text = synthetic_manifest(nstreams=3, nfiles=5, nblocks=4, segments=3)
+        baseline = segment_by_segment(manifest_text)
+        with mock.patch.object(arvados.arvfile.ArvadosFile, 'add_segment') as add_segment:
+            coll = arvados.collection.Collection(manifest_text, api_client=api_client())
+        # The single pass adds segments to each file's list directly,
+        # rather than searching the stream's blocks for each one.
+        add_segment.assert_not_called()
+        self.assertEqual(coll.manifest_text(normalize=True),
+                         baseline.manifest_text(normalize=True))
+
+    def test_lazy_import_reads_one_stream(self):
+        eager_size = arvados.collection.Collection(
+            self.MANIFEST, api_client=api_client()).find('stream7/file 3.dat').size()
+        coll = arvados.collection.Collection(self.MANIFEST, api_client=api_client(), lazy=True)
+        stream6 = coll._loaded_items['stream6']
+        stream7 = coll._loaded_items['stream7']
+        self.assertTrue(coll._pending)
+        self.assertTrue(stream6._pending)
+        self.assertTrue(stream7._pending)
+        self.assertEqual(coll.find('stream7/file 3.dat').size(), eager_size)
+        # Only the stream that was looked in has been parsed.
+        self.assertIsNone(stream7._pending)
+        self.assertTrue(stream6._pending)
+        self.assertTrue(coll._pending)
@@ -101,6 +101,23 @@ class ArvadosGetTestCase(run_test_server.TestCaseWithServers,
         with open(os.path.join(self.tempdir, "subdir", "baz.txt"), "r") as f:
             self.assertEqual("baz", f.read())
 
+    def test_get_multiple_files_in_parallel(self):
+        # Hashes and progress are reported in the same order however
+        # many files are read at once.
+        outputs = []
+        for file_threads in ['1', '3']:
+            outdir = os.path.join(self.tempdir, file_threads)
+            os.mkdir(outdir)
+            r = self.run_get(['--md5sum', '--batch-progress',
+                              '--file-threads', file_threads,
+                              "{}/".format(self.col_loc), outdir])
+            self.assertEqual(0, r)
+            with open(os.path.join(outdir, "subdir", "baz.txt"), "r") as f:
+                self.assertEqual("baz", f.read())
+            outputs.append(self.stderr.getvalue())
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertIn('37b51d194a7513e45b56f6524f2d51f2  ./bar.txt\n', outputs[0])
+
     def test_get_collection_unstripped_manifest(self):
         dummy_token = "+Axxxxxxx"
         # Get the collection manifest by UUID
@@ -210,6 +210,33 @@ class ArvadosPutResumeCacheTest(ArvadosBaseTestCase):
         self.last_cache.save(thing)
         self.assertEqual(thing, self.last_cache.load())
 
+    def test_cache_replays_journal(self):
+        path = os.path.join(self.make_tmpdir(), 'cache')
+        cache = arv_put.ResumeCache(path)
+        cache.save({'manifest': ". acbd18db4cc2f85cedef654fccc4a4d8+3 0:3:foo\n",
+                    'files': {'/tmp/foo': {'mtime': 1, 'size': 6}}})
+        cache.close()
+        with open(path, 'a') as f:
+            f.write(json.dumps({
+                'files': {'/tmp/bar': {'mtime': 2, 'size': 3}},
+                'manifest': ". 37b51d194a7513e45b56f6524f2d51f2+3 0:3:foo\n"}) + "\n")
+            f.write(json.dumps({
+                'files': {'/tmp/foo': {'mtime': 3, 'size': 6}},
+                'manifest': "./dir d41d8cd98f00b204e9800998ecf8427e+0 0:0:bar\n"}) + "\n")
+            # A record cut short by a crash is ignored.
+            f.write('{"files": {"/tmp/baz"')
+        self.last_cache = arv_put.ResumeCache(path)
+        state = self.last_cache.load()
+        self.assertEqual(
+            ". acbd18db4cc2f85cedef654fccc4a4d8+3 0:3:foo\n"
+            ". 37b51d194a7513e45b56f6524f2d51f2+3 0:3:foo\n"
+            "./dir d41d8cd98f00b204e9800998ecf8427e+0 0:0:bar\n",
+            state['manifest'])
+        self.assertEqual({'/tmp/foo': {'mtime': 3, 'size': 6},
+                          '/tmp/bar': {'mtime': 2, 'size': 3}},
+                         state['files'])
+        self.assertIsNone(arv_put.ResumeCache.replay(self.last_cache.cache_file)[2])
+
     def test_cache_is_locked(self):
         with tempfile.NamedTemporaryFile() as cachefile:
             _ = arv_put.ResumeCache(cachefile.name)
@@ -249,6 +276,60 @@ class ArvadosPutResumeCacheTest(ArvadosBaseTestCase):
                           arv_put.ResumeCache, path)
 
 
+class ArvadosPutDedupCacheTest(ArvadosBaseTestCase):
+    def test_dedup_cache_persists_entries(self):
+        tmpdir = self.make_tmpdir()
+        path = os.path.join(tmpdir, 'dedup')
+        with open(os.path.join(tmpdir, 'foo'), 'w') as f:
+            f.write('foo')
+        st = os.stat(os.path.join(tmpdir, 'foo'))
+        segments = [['acbd18db4cc2f85cedef654fccc4a4d8+3', 0, 3]]
+        cache = arv_put.DedupCache(path)
+        self.assertIsNone(cache.get(st))
+        cache.update([(st, segments)])
+        self.assertEqual(segments, arv_put.DedupCache(path).get(st))
+        # A line cut short by a crash is ignored.
+        with open(path, 'a') as f:
+            f.write('["{}", [["37b51d194a7513e45b56'.format(arv_put.DedupCache.key(st)))
+        self.assertEqual(segments, arv_put.DedupCache(path).get(st))
+
+    def test_dedup_cache_replaces_changed_entries(self):
+        tmpdir = self.make_tmpdir()
+        path = os.path.join(tmpdir, 'dedup')
+        with open(os.path.join(tmpdir, 'foo'), 'w') as f:
+            f.write('foo')
+        st = os.stat(os.path.join(tmpdir, 'foo'))
+        cache = arv_put.DedupCache(path)
+        for n in range(10):
+            cache.update([(st, [['acbd18db4cc2f85cedef654fccc4a4d8+3', n, 3]])])
+        self.assertEqual([['acbd18db4cc2f85cedef654fccc4a4d8+3', 9, 3]],
+                         arv_put.DedupCache(path).get(st))
+        with open(path) as f:
+            self.assertLessEqual(len(f.readlines()), 2)
+
+    def test_dedup_cache_compaction_keeps_other_writers_entries(self):
+        tmpdir = self.make_tmpdir()
+        path = os.path.join(tmpdir, 'dedup')
+        stats = []
+        for name in ['foo', 'bar', 'baz']:
+            with open(os.path.join(tmpdir, name), 'w') as f:
+                f.write(name)
+            stats.append(os.stat(os.path.join(tmpdir, name)))
+        expired = [['acbd18db4cc2f85cedef654fccc4a4d8+3+A{}@00000001'.format('0' * 40), 0, 3]]
+        valid = [['37b51d194a7513e45b56f6524f2d51f2+3', 0, 3]]
+        cache = arv_put.DedupCache(path)
+        other = arv_put.DedupCache(path)
+        other.update([(stats[0], valid), (stats[1], expired)])
+        for n in range(10):
+            cache.update([(stats[2], [['73feffa4b7f6bb68e44cf984c85f6e88+3', n, 3]])])
+        reread = arv_put.DedupCache(path)
+        self.assertEqual(valid, reread.get(stats[0]))
+        self.assertIsNone(reread.get(stats[1]))
+        self.assertEqual([['73feffa4b7f6bb68e44cf984c85f6e88+3', 9, 3]], reread.get(stats[2]))
+        with open(path) as f:
+            self.assertLessEqual(len(f.readlines()), 3)
+
+
 class TestArvadosPutResumeCacheDir:
     @pytest.fixture
     def args(self, tmp_path):
@@ -499,6 +580,66 @@ class ArvPutUploadJobTest(run_test_server.TestCaseWithServers,
         writer2.destroy_cache()
         del(self.writer)
 
+    def test_parallel_scan_matches_serial_scan(self):
+        scans = []
+        for scan_threads in [1, 4]:
+            cwriter = arv_put.ArvPutUploadJob([self.tempdir_with_symlink, self.small_files_dir],
+                                              use_cache=False, resume=False,
+                                              scan_threads=scan_threads)
+            scans.append((list(cwriter._files_to_upload), cwriter.bytes_expected))
+        self.assertEqual(scans[0], scans[1])
+        self.assertEqual(len(scans[0][0]), 6 + 69)
+
+    def test_read_ahead_upload_matches_serial_upload(self):
+        manifests = []
+        for read_threads in [1, 4]:
+            cwriter = arv_put.ArvPutUploadJob([self.small_files_dir, self.tempdir],
+                                              use_cache=False, resume=False,
+                                              read_threads=read_threads)
+            cwriter.start(save_collection=False)
+            self.assertEqual(cwriter.bytes_written, cwriter.bytes_expected)
+            manifests.append(cwriter.manifest_text())
+        self.assertEqual(manifests[0], manifests[1])
+
+    def test_dedup_cache_adds_unchanged_files_by_reference(self):
+        manifests = []
+        for _ in range(2):
+            cwriter = arv_put.ArvPutUploadJob([self.small_files_dir],
+                                              use_cache=False, resume=False,
+                                              dedup_cache=True)
+            cwriter.start(save_collection=False)
+            manifests.append(cwriter.manifest_text())
+        self.assertEqual(0, cwriter.bytes_written)
+        self.assertEqual(cwriter.bytes_expected, cwriter.bytes_skipped)
+        self.assertEqual(manifests[0], manifests[1])
+
+    def test_checkpoints_append_to_cache_journal(self):
+        cache_lines = []
+        def wrapped_write(*args, **kwargs):
+            result = self.arvfile_write(*args, **kwargs)
+            self.writer._update()
+            with open(self.writer._cache_filename) as f:
+                cache_lines.append(len(f.readlines()))
+            return result
+
+        with mock.patch('arvados.arvfile.ArvadosFileWriter.write',
+                        autospec=True) as mocked_write:
+            mocked_write.side_effect = wrapped_write
+            writer = arv_put.ArvPutUploadJob([self.tempdir],
+                                             replication_desired=1)
+            # We'll be accessing from inside the wrapper
+            self.writer = writer
+            writer.start(save_collection=False)
+        # The first checkpoint saved a snapshot, the next ones appended
+        # a journal record for each new file...
+        self.assertEqual([1, 2, 3], cache_lines[:3])
+        # ...and the last one compacted them.
+        with open(writer._cache_filename) as f:
+            state = json.load(f)
+        self.assertEqual(writer.manifest_text(), state['manifest'])
+        writer.destroy_cache()
+        del(self.writer)
+
     # Test for bug #11002
     def test_graceful_exit_while_repacking_small_blocks(self):
         def wrapped_commit(*args, **kwargs):
@@ -3,7 +3,9 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import datetime
+import hashlib
 import os
+import threading
 import time
 import unittest
 
@@ -12,7 +14,7 @@ from unittest import mock
 import arvados
 
 from arvados._internal.streams import Range
-from arvados.arvfile import ArvadosFile, ArvadosFileReader
+from arvados.arvfile import ArvadosFile, ArvadosFileReader, _Readahead
 from arvados.collection import Collection
 from arvados.keep import KeepLocator
 
@@ -25,13 +27,14 @@ class ArvadosFileWriterTestCase(unittest.TestCase):
             self.blocks = blocks
             self.requests = []
             self.num_prefetch_threads = 1
-        def get(self, locator, num_retries=0, prefetch=False):
+        def get(self, locator, num_retries=0, prefetch=False, return_memoryview=False):
             self.requests.append(locator)
             return self.blocks.get(locator)
-        def get_from_cache(self, locator):
+        def get_from_cache(self, locator, return_memoryview=False):
             self.requests.append(locator)
             return self.blocks.get(locator)
-        def put(self, data, num_retries=None, copies=None, classes=[]):
+        def put(self, data, num_retries=None, copies=None, classes=[], data_hash=None):
+            data = bytes(data)
             pdh = tutil.str_keep_locator(data)
             self.blocks[pdh] = bytes(data)
             return pdh
@@ -620,6 +623,26 @@ class ArvadosFileWriterTestCase(unittest.TestCase):
             self.assertFalse(c.modified())
             self.assertEqual(b"01234567", keep.get("2e9ec317e197819358fbc43afca7d837+8"))
 
+    def test_manifest_text_renders_changed_streams_only(self):
+        keep = ArvadosFileWriterTestCase.MockKeep({})
+        api = ArvadosFileWriterTestCase.MockApi(None, None)
+        with Collection(api_client=api, keep_client=keep) as c:
+            for d in ("a", "b"):
+                with c.open(d + "/count.txt", "wb") as f:
+                    f.write(b"0123456789")
+            text = c.manifest_text()
+            normalize_stream = arvados._internal.streams.normalize_stream
+            with mock.patch("arvados._internal.streams.normalize_stream",
+                            wraps=normalize_stream) as normalize:
+                self.assertEqual(text, c.manifest_text())
+                self.assertEqual(normalize.call_count, 0)
+                with c.open("b/count.txt", "ab") as f:
+                    f.write(b"x")
+                self.assertEqual("./a 781e5e245d69b566979b86e28d23f2c7+10 0:10:count.txt\n"
+                                 "./b 781e5e245d69b566979b86e28d23f2c7+10 9dd4e461268c8034f5c8564e155c67a6+1 0:11:count.txt\n",
+                                 c.manifest_text())
+                self.assertEqual(normalize.call_count, 1)
+
 
 class ArvadosFileReaderTestCase(unittest.TestCase, StreamFileReaderTestMixin):
     class MockParent(object):
@@ -716,8 +739,8 @@ class ArvadosFileReaderTestCase(unittest.TestCase, StreamFileReaderTestMixin):
         self.assertEqual(["2e9ec317e197819358fbc43afca7d837+8"], keep.requests)
 
     def test_prefetch_first_read_only(self):
-        # test behavior that prefetch only happens every 128 reads
-        # check that it doesn't make a prefetch request on the second read
+        # check that it doesn't make another prefetch request while
+        # the reader is still in the first half of the window
         keep = ArvadosFileWriterTestCase.MockKeep({
             "2e9ec317e197819358fbc43afca7d837+8": b"01234567",
             "e8dc4081b13434b45189a720b77b6818+8": b"abcdefgh",
@@ -732,8 +755,7 @@ class ArvadosFileReaderTestCase(unittest.TestCase, StreamFileReaderTestMixin):
         self.assertEqual(3, len(keep.requests))
 
     def test_prefetch_again(self):
-        # test behavior that prefetch only happens every 128 reads
-        # check that it does make another prefetch request after 128 reads
+        # check that rereading the same range doesn't prefetch again
         keep = ArvadosFileWriterTestCase.MockKeep({
             "2e9ec317e197819358fbc43afca7d837+8": b"01234567",
             "e8dc4081b13434b45189a720b77b6818+8": b"abcdefgh",
@@ -744,16 +766,113 @@ class ArvadosFileReaderTestCase(unittest.TestCase, StreamFileReaderTestMixin):
                 r.seek(0)
                 self.assertEqual(b"0123", r.read(4))
         self.assertEqual(["2e9ec317e197819358fbc43afca7d837+8",
-                          "e8dc4081b13434b45189a720b77b6818+8",
-                          "2e9ec317e197819358fbc43afca7d837+8",
-                          "2e9ec317e197819358fbc43afca7d837+8"], keep.requests[0:4])
-        self.assertEqual(["2e9ec317e197819358fbc43afca7d837+8",
-                          "2e9ec317e197819358fbc43afca7d837+8",
-                          "2e9ec317e197819358fbc43afca7d837+8",
-                          "e8dc4081b13434b45189a720b77b6818+8"], keep.requests[127:131])
-        # gets the 1st block 129 times from keep (cache),
-        # and the 2nd block twice to get 131 requests
-        self.assertEqual(131, len(keep.requests))
+                          "e8dc4081b13434b45189a720b77b6818+8"], keep.requests[0:2])
+        self.assertEqual(["2e9ec317e197819358fbc43afca7d837+8"] * 128, keep.requests[2:])
+
+    def _readahead_keep(self, nblocks, lookahead):
+        blocks = {}
+        for i in range(nblocks):
+            data = b"%08d" % i
+            blocks[tutil.str_keep_locator(data)] = data
+        keep = ArvadosFileWriterTestCase.MockKeep(blocks)
+        keep.num_prefetch_threads = lookahead
+        keep.prefetched = []
+        keep.block_prefetch = keep.prefetched.append
+        manifest = ". {} 0:{}:f\n".format(" ".join(blocks), 8 * nblocks)
+        return keep, list(blocks), manifest
+
+    def test_readahead_sequential_window_grows(self):
+        keep, locs, manifest = self._readahead_keep(16, 4)
+        with Collection(manifest, keep_client=keep) as c:
+            r = c.open("f", "rb")
+            # The first window covers one block past the next read.
+            self.assertEqual(b"00000000", r.read(8))
+            self.assertEqual(locs[1:3], keep.prefetched)
+            self.assertEqual(b"00000001", r.read(8))
+            self.assertEqual(locs[1:3], keep.prefetched)
+            # Catching up with the window doubles it.
+            self.assertEqual(b"00000002", r.read(8))
+            self.assertEqual(locs[1:6], keep.prefetched)
+            self.assertEqual(b"00000003", r.read(8))
+            self.assertEqual(locs[1:6], keep.prefetched)
+            self.assertEqual(b"00000004", r.read(8))
+            self.assertEqual(locs[1:10], keep.prefetched)
+            # The window stops growing at prefetch_lookahead.
+            while r.read(8):
+                pass
+            self.assertEqual(locs[1:], keep.prefetched)
+
+    def test_readahead_strided(self):
+        keep, locs, manifest = self._readahead_keep(24, 2)
+        with Collection(manifest, keep_client=keep) as c:
+            r = c.open("f", "rb")
+            for i in (1, 6):
+                self.assertEqual(b"%08d" % i, r.readfrom(i*8, 8))
+            self.assertEqual(locs[2:4], keep.prefetched)
+            del keep.prefetched[:]
+            # The third read confirms the stride and prefetches the
+            # next position along it, then the window grows.
+            self.assertEqual(b"00000011", r.readfrom(88, 8))
+            self.assertEqual([locs[16]], keep.prefetched)
+            self.assertEqual(b"00000016", r.readfrom(128, 8))
+            self.assertEqual([locs[16], locs[21]], keep.prefetched)
+
+    def test_readahead_sequential_out_of_order(self):
+        keep, locs, manifest = self._readahead_keep(16, 4)
+        with Collection(manifest, keep_client=keep) as c:
+            r = c.open("f", "rb")
+            # Reads arriving slightly out of order, as concurrent
+            # kernel readahead requests can, are still sequential.
+            for i in (0, 2, 1, 3, 5, 4, 6, 7):
+                self.assertEqual(b"%08d" % i, r.readfrom(i*8, 8))
+                self.assertEqual(_Readahead.SEQUENTIAL, r._readahead.pattern)
+            # Prefetching keeps going past the first window.
+            self.assertLessEqual(set(locs[1:9]), set(keep.prefetched))
+
+    def test_readahead_random(self):
+        keep, locs, manifest = self._readahead_keep(16, 4)
+        with Collection(manifest, keep_client=keep) as c:
+            r = c.open("f", "rb")
+            # Only the first read, which could be the start of a
+            # sequential scan, prefetches anything.
+            self.assertEqual(b"00000005", r.readfrom(40, 8))
+            self.assertEqual(locs[6:8], keep.prefetched)
+            for i in (2, 11, 3, 9, 14):
+                self.assertEqual(b"%08d" % i, r.readfrom(i*8, 8))
+            self.assertEqual(locs[6:8], keep.prefetched)
+
+    def test_readahead_per_reader(self):
+        keep, locs, manifest = self._readahead_keep(16, 1)
+        with Collection(manifest, keep_client=keep) as c:
+            r1 = c.open("f", "rb")
+            r2 = c.open("f", "rb")
+            r2.seek(64)
+            # Interleaved reads still look sequential to each reader.
+            for i in range(3):
+                self.assertEqual(b"%08d" % i, r1.read(8))
+                self.assertEqual(b"%08d" % (i+8), r2.read(8))
+        self.assertEqual(locs[1:5] + locs[9:13], sorted(keep.prefetched, key=locs.index))
+
+    def test_first_small_read_fetches_range(self):
+        keep, locs, manifest = self._readahead_keep(4, 1)
+        keep.max_range_read = 4
+        keep.ranges = []
+        def get_range(locator, offset, size, num_retries=None):
+            keep.ranges.append((locator, offset, size))
+            return keep.blocks[locator][offset:offset+size]
+        keep.get_range = get_range
+        with Collection(manifest, keep_client=keep) as c:
+            r = c.open("f", "rb")
+            self.assertEqual(b"0002", r.readfrom(20, 4))
+            self.assertEqual([(locs[2], 4, 4)], keep.ranges)
+            self.assertEqual([], keep.requests)
+            self.assertEqual([], keep.prefetched)
+            # A first read from the start of the file fetches the
+            # whole block, as a sequential reader's would.
+            r = c.open("f", "rb")
+            self.assertEqual(b"0000", r.readfrom(0, 4))
+            self.assertEqual([locs[0]], keep.requests)
+            self.assertEqual(1, len(keep.ranges))
 
     def test__eq__from_manifest(self):
         with Collection('. 781e5e245d69b566979b86e28d23f2c7+10 0:10:count1.txt') as c1:
@@ -867,6 +986,33 @@ class BlockManagerTest(unittest.TestCase):
             with self.assertRaises(arvados.errors.AssertionError):
                 bufferblock.append("bar")
 
+    def test_bufferblock_incremental_hash(self):
+        keep = ArvadosFileWriterTestCase.MockKeep({})
+        with arvados.arvfile._BlockManager(keep) as blockmanager:
+            bufferblock = blockmanager.alloc_bufferblock(starting_capacity=2)
+            for data in ("foo", memoryview(b"bar"), b"baz"):
+                bufferblock.append(data)
+            self.assertEqual(hashlib.md5(b"foobarbaz").hexdigest(), bufferblock.md5sum())
+            # Bytes written without append() are hashed on demand.
+            bufferblock.buffer_view[9:12] = b"qux"
+            bufferblock.write_pointer = 12
+            self.assertEqual(tutil.str_keep_locator(b"foobarbazqux"), bufferblock.locator())
+            bufferblock.append("!")
+            self.assertEqual(tutil.str_keep_locator(b"foobarbazqux!"), bufferblock.locator())
+
+    def test_bufferblock_commit_sends_view(self):
+        keep = ArvadosFileWriterTestCase.MockKeep({})
+        puts = []
+        def put(data, num_retries=None, copies=None, classes=[], data_hash=None):
+            puts.append((type(data), data_hash))
+            return tutil.str_keep_locator(bytes(data))
+        keep.put = put
+        with arvados.arvfile._BlockManager(keep) as blockmanager:
+            bufferblock = blockmanager.alloc_bufferblock()
+            bufferblock.append("foo")
+            blockmanager.commit_bufferblock(bufferblock, True)
+        self.assertEqual([(memoryview, "acbd18db4cc2f85cedef654fccc4a4d8")], puts)
+
     def test_bufferblock_dup(self):
         keep = ArvadosFileWriterTestCase.MockKeep({})
         with arvados.arvfile._BlockManager(keep) as blockmanager:
@@ -931,6 +1077,96 @@ class BlockManagerTest(unittest.TestCase):
             blockmanager.commit_bufferblock(bufferblock, True)
             self.assertEqual(bufferblock.state(), arvados.arvfile._BufferBlock.COMMITTED)
 
+    class GatedKeep(ArvadosFileWriterTestCase.MockKeep):
+        def __init__(self, services=0):
+            super().__init__({})
+            self.services = services
+            self.gate = threading.Event()
+            self.lock = threading.Lock()
+            self.active = 0
+            self.max_active = 0
+
+        def writable_services_count(self):
+            return self.services
+
+        def put(self, data, num_retries=None, copies=None, classes=[], data_hash=None):
+            with self.lock:
+                self.active += 1
+                self.max_active = max(self.max_active, self.active)
+            self.gate.wait()
+            with self.lock:
+                self.active -= 1
+            return super().put(data, num_retries=num_retries, copies=copies, classes=classes)
+
+    def commit_blocks(self, blockmanager, count, size, settle=True):
+        blocks = []
+        for i in range(count):
+            bufferblock = blockmanager.alloc_bufferblock()
+            bufferblock.append(b"%d" % i * size)
+            blockmanager.commit_bufferblock(bufferblock, False)
+            blocks.append(bufferblock)
+            # Wait for the upload threads to pick up what they can.
+            deadline = time.time() + 5
+            while (settle and blockmanager._put_threads is not None and
+                   blockmanager._put_busy < min(i+1, len(blockmanager._put_threads)) and
+                   time.time() < deadline):
+                time.sleep(0.01)
+        return blocks
+
+    def test_put_buffer_size_limits_pending_blocks(self):
+        keep = self.GatedKeep()
+        with arvados.arvfile._BlockManager(keep, put_threads=4, put_buffer_size=20) as blockmanager:
+            committer = threading.Thread(target=self.commit_blocks, args=(blockmanager, 3, 10, False))
+            committer.start()
+            committer.join(0.5)
+            # The third block doesn't fit in the buffer until one of
+            # the first two is uploaded.
+            self.assertTrue(committer.is_alive())
+            self.assertEqual(2, keep.max_active)
+            keep.gate.set()
+            committer.join()
+            blockmanager.commit_all()
+
+    def test_default_put_buffer_size_follows_put_threads(self):
+        bs = arvados.config.KEEP_BLOCK_SIZE
+        for services, copies, put_threads, expect in [
+                (0, None, None, 4 * bs),
+                (6, 2, None, 5 * bs),
+                (6, 2, 8, 10 * bs),
+                (40, None, None, arvados.arvfile._BlockManager.MAX_DEFAULT_PUT_BUFFER_SIZE),
+        ]:
+            keep = self.GatedKeep(services=services)
+            blockmanager = arvados.arvfile._BlockManager(keep, copies=copies, put_threads=put_threads)
+            self.assertEqual(expect, blockmanager._put_buffer_budget())
+
+    def test_put_threads_adapt_to_services(self):
+        keep = self.GatedKeep(services=6)
+        with arvados.arvfile._BlockManager(keep, copies=2) as blockmanager:
+            self.commit_blocks(blockmanager, 8, 10)
+            # Three parallel uploads make two copies each on six services.
+            self.assertEqual(3, len(blockmanager._put_threads))
+            keep.gate.set()
+            blockmanager.commit_all()
+        self.assertEqual(3, keep.max_active)
+
+    def test_put_threads_fixed(self):
+        keep = self.GatedKeep(services=6)
+        with arvados.arvfile._BlockManager(keep, copies=2, put_threads=2) as blockmanager:
+            self.commit_blocks(blockmanager, 8, 10)
+            self.assertEqual(2, len(blockmanager._put_threads))
+            keep.gate.set()
+            blockmanager.commit_all()
+
+    def test_put_threads_stop_growing_when_saturated(self):
+        keep = self.GatedKeep(services=20)
+        with arvados.arvfile._BlockManager(keep, copies=1) as blockmanager:
+            blockmanager._put_latency = 2.0
+            blockmanager._put_latency_at_grow = 1.0
+            self.commit_blocks(blockmanager, 8, 10)
+            self.assertEqual(2, len(blockmanager._put_threads))
+            keep.gate.set()
+            blockmanager.commit_all()
+
     def test_bufferblock_commit_with_error(self):
         mockkeep = mock.MagicMock()
         mockkeep.put.side_effect = arvados.errors.KeepWriteError("fail")
@@ -20,7 +20,7 @@ import arvados.keep
 import parameterized
 import pytest
 
-from arvados._internal.streams import Range, LocatorAndRange, locators_and_ranges
+from arvados._internal.streams import Range, LocatorAndRange, SegmentTable, locators_and_ranges, replace_range
 from arvados.collection import Collection, CollectionReader
 
 from . import arvados_testutil as tutil
@@ -256,12 +256,77 @@ class ArvadosCollectionsTest(run_test_server.TestCaseWithServers,
         self.assertEqual(locators_and_ranges(blocks, 11, 15), [LocatorAndRange('b', 15, 1, 14),
                                                                LocatorAndRange('c', 5, 0, 1)])
 
+    def test_segment_table_locators_and_ranges(self):
+        blocks = SegmentTable([Range('a', 0, 10),
+                               Range('b', 10, 15),
+                               Range('c', 25, 5)])
+        self.assertEqual(3, len(blocks))
+        self.assertEqual(locators_and_ranges(blocks, 1, 0), [])
+        self.assertEqual(locators_and_ranges(blocks, 3, 5), [LocatorAndRange('a', 10, 3, 5)])
+        self.assertEqual(locators_and_ranges(blocks, 1, 30), [LocatorAndRange('a', 10, 1, 9),
+                                                              LocatorAndRange('b', 15, 0, 15),
+                                                              LocatorAndRange('c', 5, 0, 5)])
+        self.assertEqual(locators_and_ranges(blocks, 1, 30, limit=2), [LocatorAndRange('a', 10, 1, 9),
+                                                                       LocatorAndRange('b', 15, 0, 15)])
+        self.assertEqual(locators_and_ranges(blocks, 26, 2), [LocatorAndRange('c', 5, 1, 2)])
+        self.assertEqual(locators_and_ranges(blocks, 30, 2), [])
+        self.assertEqual(locators_and_ranges(blocks, -2, 2), [])
+
+    def test_segment_table_replace_range(self):
+        rnd = random.Random(7225)
+        segs = SegmentTable()
+        content = []
+        for _ in range(500):
+            start = rnd.randint(0, len(content))
+            size = rnd.randint(1, 50)
+            loc = rnd.choice('abcdef')
+            offset = rnd.randint(0, 100)
+            replace_range(segs, start, size, loc, offset)
+            content[start:start+size] = [(loc, offset+i) for i in range(size)]
+        pos = 0
+        for seg in segs:
+            self.assertEqual(pos, seg.range_start)
+            pos += seg.range_size
+        self.assertEqual(content, [(lr.locator, lr.segment_offset+i)
+                                   for lr in locators_and_ranges(segs, 0, len(content))
+                                   for i in range(lr.segment_size)])
+
+    def test_segment_table_behaves_like_list(self):
+        segs = SegmentTable([Range('a', 0, 10), Range('b', 10, 10, 5)])
+        self.assertEqual([Range('a', 0, 10), Range('b', 10, 10, 5)], list(segs))
+        segs[-1].locator = 'c'
+        segs[0].segment_offset = 3
+        self.assertEqual(Range('c', 10, 10, 5), segs.get(1))
+        copied = copy.copy(segs)
+        copied.append(Range('a', 20, 1))
+        del copied[0]
+        self.assertEqual([Range('a', 0, 10, 3), Range('c', 10, 10, 5)], list(segs))
+        self.assertEqual([Range('c', 10, 10, 5), Range('a', 20, 1)], list(copied))
+        self.assertEqual([Range('c', 10, 10, 5)], list(segs[1:]))
+
+    def test_compact_segments(self):
+        manifest = ". {} {} 0:3:foo 3:3:bar\n".format(
+            tutil.str_keep_locator('foo'), tutil.str_keep_locator('bar'))
+        self.assertIsInstance(Collection(manifest).find('foo')._segments, list)
+        c = Collection(manifest, compact_segments=True)
+        self.assertIsInstance(c.find('foo')._segments, SegmentTable)
+        self.assertEqual(manifest, c.manifest_text())
+        c.find('bar').truncate(1)
+        self.assertIsInstance(c.find('bar')._segments, SegmentTable)
+        # A file moved to a collection without compact segments gets a list.
+        other = Collection()
+        other.rename('foo', 'foo', source_collection=c)
+        self.assertIsInstance(other.find('foo')._segments, list)
+        self.assertIsNone(c.find('foo'))
+        self.assertEqual(". {} 0:3:foo\n".format(tutil.str_keep_locator('foo')),
+                         other.manifest_text())
+
     class MockKeep(object):
         def __init__(self, content, num_retries=0):
             self.content = content
             self.num_prefetch_threads = 1
 
-        def get(self, locator, num_retries=0, prefetch=False):
+        def get(self, locator, num_retries=0, prefetch=False, return_memoryview=False):
             return self.content[locator]
 
     def test_extract_file(self):
@@ -586,6 +651,48 @@ class NewCollectionTestCase(unittest.TestCase, CollectionTestMixin):
         with self.assertRaises(arvados.errors.ArgumentError):
             self.assertEqual(m1, CollectionReader(m1))
 
+    LAZY_MANIFEST = """. 781e5e245d69b566979b86e28d23f2c7+10 0:10:count1.txt
+./a 5348b82a029fd9e971a811ce1f71360b+43 0:43:md5sum.txt
+./a/b 085c37f02916da1cad16f93c54d899b7+41 0:41:md5sum.txt
+./a/b 8b22da26f9f433dea0a10e5ec66d73ba+43 0:43:other.txt
+"""
+
+    def test_lazy_parses_streams_when_read(self):
+        c = Collection(self.LAZY_MANIFEST, lazy=True)
+        a = c.find('a')
+        b = c.find('a/b')
+        self.assertIsNotNone(c._pending)
+        self.assertIsNotNone(a._pending)
+        self.assertIsNotNone(b._pending)
+        self.assertEqual(['md5sum.txt', 'other.txt'], sorted(b.keys()))
+        self.assertIsNone(b._pending)
+        self.assertIsNotNone(a._pending)
+        self.assertEqual(84, b['other.txt'].size() + b['md5sum.txt'].size())
+        self.assertTrue(c.committed())
+        self.assertEqual(c.manifest_text(normalize=True),
+                         Collection(self.LAZY_MANIFEST).manifest_text(normalize=True))
+
+    def test_lazy_manifest_text_copies_untouched_streams(self):
+        c = Collection(self.LAZY_MANIFEST, lazy=True)
+        c.remove('count1.txt')
+        self.assertEqual("""./a 5348b82a029fd9e971a811ce1f71360b+43 0:43:md5sum.txt
+./a/b 085c37f02916da1cad16f93c54d899b7+41 0:41:md5sum.txt
+./a/b 8b22da26f9f433dea0a10e5ec66d73ba+43 0:43:other.txt
+""", c.manifest_text())
+        self.assertEqual("""./a 5348b82a029fd9e971a811ce1f71360b+43 0:43:md5sum.txt
+./a/b 085c37f02916da1cad16f93c54d899b7+41 8b22da26f9f433dea0a10e5ec66d73ba+43 0:41:md5sum.txt 41:43:other.txt
+""", c.manifest_text(normalize=True))
+
+    def test_lazy_loading_is_not_a_change(self):
+        c = Collection(self.LAZY_MANIFEST, lazy=True)
+        events = []
+        c.subscribe(lambda *args: events.append(args))
+        self.assertIsNotNone(c.find('a/b/other.txt'))
+        self.assertIn('count1.txt', c)
+        self.assertEqual([], events)
+        self.assertFalse(c.modified())
+        self.assertEqual(self.LAZY_MANIFEST, c.manifest_text())
+
     def test_remove(self):
         c = Collection('. 781e5e245d69b566979b86e28d23f2c7+10 0:10:count1.txt 0:10:count2.txt\n')
         self.assertEqual(". 781e5e245d69b566979b86e28d23f2c7+10 0:10:count1.txt 0:10:count2.txt\n", c.portable_manifest_text())
@@ -4,7 +4,9 @@
 
 import errno
 import hashlib
+import itertools
 import mmap
+import multiprocessing
 import os
 import random
 import re
@@ -13,6 +15,7 @@ import socket
 import stat
 import sys
 import tempfile
+import threading
 import time
 import unittest
 import urllib.parse
@@ -612,9 +615,348 @@ class KeepClientCacheTestCase(unittest.TestCase, tutil.ApiClientMock, DiskCacheB
         # First reponse was not cached because it was from a HEAD request.
         self.assertNotEqual(head_resp, get_resp)
 
+    def test_get_response_is_cached_without_copy(self):
+        locator = tutil.str_keep_locator(self.data)
+        with tutil.mock_keep_responses(self.data, 200):
+            blob = self.keep_client.get(locator, return_memoryview=True)
+        self.assertEqual(self.data, blob)
+        if not self.disk_cache:
+            slot = self.keep_client.block_cache.get(locator.split('+')[0])
+            self.assertIs(blob, slot.content)
+        # Readers share the cached block, so none of them can change it.
+        with self.assertRaises(TypeError):
+            memoryview(blob)[0] = 0
+
+    def test_get_returns_bytes(self):
+        locator = tutil.str_keep_locator(self.data)
+        with tutil.mock_keep_responses(self.data, 200):
+            self.keep_client.get(locator)
+            blob = self.keep_client.get(locator)
+            cached = self.keep_client.get_from_cache(locator)
+        if not self.disk_cache:
+            self.assertIsInstance(blob, bytes)
+            self.assertIsInstance(cached, bytes)
+        self.assertEqual(self.data, bytes(blob))
+        self.assertEqual(self.data, bytes(cached))
+
+    def test_error_body_larger_than_block(self):
+        locator = tutil.str_keep_locator(self.data)
+        with tutil.mock_keep_responses(b'block not found on this server', 404, 404):
+            with self.assertRaises(arvados.errors.NotFoundError):
+                self.keep_client.get(locator, num_retries=0)
+
+
+class ResponseBodyTestCase(unittest.TestCase):
+    def check_body(self, body, expected):
+        self.assertEqual(expected, body.getvalue())
+        self.assertEqual(hashlib.md5(expected).hexdigest(), body.hexdigest())
+
+    def test_exact_size(self):
+        body = arvados.keep._ResponseBody(6)
+        body.write(b'foo')
+        body.write(b'bar')
+        self.check_body(body, b'foobar')
+
+    def test_short_body(self):
+        body = arvados.keep._ResponseBody(6)
+        body.write(b'foo')
+        self.check_body(body, b'foo')
+
+    def test_overflow(self):
+        body = arvados.keep._ResponseBody(4)
+        body.write(b'foo')
+        body.write(b'bar')
+        body.write(b'baz')
+        self.check_body(body, b'foobarbaz')
+
+    def test_unknown_size(self):
+        body = arvados.keep._ResponseBody()
+        body.write(b'foo')
+        body.write(b'bar')
+        self.check_body(body, b'foobar')
+
+    def test_empty(self):
+        self.check_body(arvados.keep._ResponseBody(), b'')
+
 
 @tutil.skip_sleep
 @parameterized.parameterized_class([{"disk_cache": True}, {"disk_cache": False}])
+class KeepBlockCacheTestCase(unittest.TestCase):
+    def reserve_and_set(self, cache, data):
+        locator = hashlib.md5(data).hexdigest()
+        slot, first = cache.reserve_cache(locator)
+        self.assertTrue(first)
+        cache.set(slot, data)
+        return locator
+
+    def test_slots_spread_across_shards(self):
+        cache = arvados.keep.KeepBlockCache(max_slots=64, shards=4)
+        for i in range(32):
+            self.reserve_and_set(cache, str(i).encode())
+        self.assertEqual(32, cache._slot_count)
+        self.assertEqual(32, sum(len(shard.slots) for shard in cache._shards))
+        self.assertTrue(all(shard.slots for shard in cache._shards))
+
+    def test_evicts_least_recently_used_across_shards(self):
+        cache = arvados.keep.KeepBlockCache(max_slots=4, shards=4)
+        locators = [self.reserve_and_set(cache, str(i).encode()) for i in range(4)]
+        self.assertIsNotNone(cache.get(locators[0]))
+        self.reserve_and_set(cache, b'4')
+        self.assertEqual(4, cache._slot_count)
+        self.assertIsNotNone(cache.get(locators[0]))
+        self.assertIsNone(cache.get(locators[1]))
+        self.assertIsNotNone(cache.get(locators[2]))
+
+    def test_cache_total_tracks_evictions(self):
+        cache = arvados.keep.KeepBlockCache(max_slots=4, shards=2)
+        for i in range(10):
+            self.reserve_and_set(cache, b'x' * (i + 1))
+        self.assertEqual(4, cache._slot_count)
+        self.assertEqual(7 + 8 + 9 + 10, cache.cache_total)
+        cache.clear()
+        self.assertEqual(0, cache._slot_count)
+        self.assertEqual(0, cache.cache_total)
+
+    def test_reserve_waits_for_slot_to_become_ready(self):
+        cache = arvados.keep.KeepBlockCache(max_slots=2, shards=2)
+        pending = [cache.reserve_cache(loc)[0] for loc in ('a' * 32, 'b' * 32)]
+        reserved = threading.Event()
+        def reserve():
+            cache.reserve_cache('c' * 32)
+            reserved.set()
+        t = threading.Thread(target=reserve, daemon=True)
+        t.start()
+        self.assertFalse(reserved.wait(0.1))
+        cache.set(pending[0], b'a')
+        self.assertTrue(reserved.wait(5))
+        t.join()
+        self.assertIsNone(cache.get('a' * 32))
+        self.assertIsNotNone(cache.get('c' * 32))
+
+    def test_concurrent_reserve_returns_one_slot(self):
+        cache = arvados.keep.KeepBlockCache(max_slots=16, shards=4)
+        results = []
+        def reserve():
+            results.append(cache.reserve_cache('d' * 32))
+        threads = [threading.Thread(target=reserve) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(1, sum(1 for _, first in results if first))
+        self.assertEqual(1, len({id(slot) for slot, _ in results}))
+        self.assertEqual(1, cache._slot_count)
+
+
+@parameterized.parameterized_class([{"policy": "lru"}, {"policy": "s3fifo"}])
+class KeepBlockCachePolicyTestCase(unittest.TestCase):
+    policy = None
+
+    def make_cache(self, **kwargs):
+        return arvados.keep.KeepBlockCache(eviction_policy=self.policy, **kwargs)
+
+    def read(self, cache, data):
+        locator = hashlib.md5(data).hexdigest()
+        slot, first = cache.reserve_cache(locator)
+        if first:
+            cache.set(slot, data)
+        return first
+
+    def test_hit_and_miss_counters(self):
+        cache = self.make_cache(max_slots=8)
+        self.assertEqual(self.policy, cache.eviction_policy)
+        for data in [b'a', b'b', b'a', b'a']:
+            self.read(cache, data)
+        self.assertEqual(2, cache.hits_counter.get())
+        self.assertEqual(2, cache.misses_counter.get())
+
+    def test_respects_slot_limit(self):
+        cache = self.make_cache(max_slots=10, shards=3)
+        for i in range(100):
+            self.read(cache, str(i % 37).encode())
+            self.assertLessEqual(cache._slot_count, 10)
+        self.assertEqual(10, sum(len(shard.slots) for shard in cache._shards))
+        self.assertEqual(10, sum(len(shard.policy) for shard in cache._shards))
+
+    def test_hot_blocks_survive_scan(self):
+        cache = self.make_cache(max_slots=20, shards=2)
+        hot = [str(i).encode() for i in range(5)]
+        for _ in range(3):
+            for data in hot:
+                self.read(cache, data)
+        for i in range(100):
+            self.read(cache, 'scan{}'.format(i).encode())
+        misses = cache.misses_counter.get()
+        for data in hot:
+            self.read(cache, data)
+        reloaded = cache.misses_counter.get() - misses
+        if self.policy == 'lru':
+            self.assertEqual(len(hot), reloaded)
+        else:
+            self.assertEqual(0, reloaded)
+
+
+class KeepBlockCachePolicyOptionsTestCase(unittest.TestCase, tutil.ApiClientMock):
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            arvados.keep.KeepBlockCache(eviction_policy='random')
+
+    def test_keep_client_builds_cache_with_policy(self):
+        keep_client = arvados.KeepClient(api_client=self.mock_keep_services(count=1),
+                                         cache_eviction_policy='s3fifo')
+        self.assertEqual('s3fifo', keep_client.block_cache.eviction_policy)
+
+    def test_keep_client_policy_and_cache_conflict(self):
+        with self.assertRaises(ValueError):
+            arvados.KeepClient(api_client=self.mock_keep_services(count=1),
+                               block_cache=arvados.keep.KeepBlockCache(),
+                               cache_eviction_policy='s3fifo')
+
+
+class KeepBlockCacheTieredTestCase(unittest.TestCase):
+    def setUp(self):
+        self.disk_cache_dir = tempfile.mkdtemp()
+        self.cache = arvados.keep.KeepBlockCache(disk_cache=True,
+                                                 disk_cache_dir=self.disk_cache_dir,
+                                                 ram_cache_max=64 * 1024 * 1024)
+        self.cache._max_slots = 2
+
+    def tearDown(self):
+        self.cache._wait_for_demotions()
+        shutil.rmtree(self.disk_cache_dir)
+
+    def block_path(self, locator):
+        return os.path.join(self.disk_cache_dir, locator[0:3], locator + '.keepcacheblock')
+
+    def store(self, data):
+        locator = hashlib.md5(data).hexdigest()
+        slot, first = self.cache.reserve_cache(locator)
+        self.assertTrue(first)
+        self.cache.set(slot, data)
+        return locator
+
+    def test_new_blocks_stay_in_ram(self):
+        locator = self.store(b'foo')
+        self.assertIsInstance(self.cache.get(locator), arvados.keep.KeepBlockCache._CacheSlot)
+        self.assertFalse(os.path.exists(self.block_path(locator)))
+
+    def test_evicted_blocks_are_demoted_and_promoted(self):
+        locators = [self.store(data) for data in [b'foo', b'bar', b'baz']]
+        self.assertEqual(2, self.cache._slot_count)
+        self.cache._wait_for_demotions()
+        self.assertTrue(os.path.exists(self.block_path(locators[0])))
+        self.assertFalse(os.path.exists(self.block_path(locators[2])))
+
+        slot, first = self.cache.reserve_cache(locators[0])
+        self.assertFalse(first)
+        self.assertIsInstance(slot, arvados.keep.KeepBlockCache._CacheSlot)
+        self.assertEqual(b'foo', slot.get())
+        self.assertEqual(2, self.cache._slot_count)
+        # Promoting foo pushed bar out of RAM, and foo stays on disk.
+        self.cache._wait_for_demotions()
+        self.assertTrue(os.path.exists(self.block_path(locators[0])))
+        self.assertTrue(os.path.exists(self.block_path(locators[1])))
+        self.assertEqual(b'bar', bytes(self.cache.get(locators[1]).get()))
+
+    def test_blocks_waiting_for_demotion_are_promoted(self):
+        written = threading.Event()
+        lower_set = self.cache._lower.set
+        def slow_set(slot, blob):
+            written.wait()
+            lower_set(slot, blob)
+        with mock.patch.object(self.cache._lower, 'set', side_effect=slow_set):
+            locators = [self.store(data) for data in [b'foo', b'bar', b'baz']]
+            # foo was evicted from RAM but isn't on disk yet.
+            self.assertFalse(os.path.exists(self.block_path(locators[0])))
+            self.assertEqual(b'foo', bytes(self.cache.get(locators[0]).get()))
+            written.set()
+            self.cache._wait_for_demotions()
+        self.assertTrue(os.path.exists(self.block_path(locators[0])))
+
+    def test_clear_both_tiers(self):
+        locators = [self.store(data) for data in [b'foo', b'bar', b'baz']]
+        self.cache.clear()
+        self.assertEqual(0, self.cache._slot_count)
+        self.assertEqual(0, self.cache._lower._slot_count)
+
+
+class KeepBlockCacheSharedTestCase(unittest.TestCase):
+    data = b'shared block'
+
+    def setUp(self):
+        self.disk_cache_dir = tempfile.mkdtemp()
+        self.locator = hashlib.md5(self.data).hexdigest()
+
+    def tearDown(self):
+        shutil.rmtree(self.disk_cache_dir)
+
+    def test_default_dir_in_shared_memory(self):
+        with mock.patch.object(arvados.keep.KeepBlockCache, 'SHARED_CACHE_ROOT', self.disk_cache_dir):
+            cache = arvados.keep.KeepBlockCache(shared_cache=True)
+        self.assertEqual(os.path.join(self.disk_cache_dir, 'arvados-keep-{}'.format(os.getuid())),
+                         cache._disk_cache_dir)
+        self.assertTrue(cache._disk_cache)
+
+    def test_uses_block_from_other_cache(self):
+        cache1 = arvados.keep.KeepBlockCache(shared_cache=True, disk_cache_dir=self.disk_cache_dir)
+        cache2 = arvados.keep.KeepBlockCache(shared_cache=True, disk_cache_dir=self.disk_cache_dir)
+        slot, first = cache1.reserve_cache(self.locator)
+        self.assertTrue(first)
+        cache1.set(slot, self.data)
+        slot, first = cache2.reserve_cache(self.locator)
+        self.assertFalse(first)
+        self.assertEqual(self.data, bytes(slot.get()))
+
+    def test_waits_for_fetch_in_other_process(self):
+        ctx = multiprocessing.get_context('fork')
+        locked = ctx.Event()
+        def fetch():
+            cache = arvados.keep.KeepBlockCache(shared_cache=True, disk_cache_dir=self.disk_cache_dir)
+            slot, first = cache.reserve_cache(self.locator)
+            locked.set()
+            time.sleep(0.5)
+            cache.set(slot, self.data)
+        child = ctx.Process(target=fetch)
+        child.start()
+        try:
+            self.assertTrue(locked.wait(10))
+            cache = arvados.keep.KeepBlockCache(shared_cache=True, disk_cache_dir=self.disk_cache_dir)
+            slot, first = cache.reserve_cache(self.locator)
+            self.assertFalse(first)
+            self.assertEqual(self.data, bytes(slot.get()))
+            self.assertEqual(1, cache.hits_counter.get())
+        finally:
+            child.join()
+        self.assertEqual(0, child.exitcode)
+
+    def test_fetch_locks_are_not_shared_by_threads(self):
+        locks1 = arvados._internal.diskcache.FetchLocks(self.disk_cache_dir)
+        locks2 = arvados._internal.diskcache.FetchLocks(self.disk_cache_dir)
+        locks1.acquire(self.locator)
+        waiter = threading.Thread(target=locks2.acquire, args=(self.locator,))
+        waiter.start()
+        waiter.join(0.2)
+        self.assertTrue(waiter.is_alive())
+        locks1.release(self.locator)
+        waiter.join(10)
+        self.assertFalse(waiter.is_alive())
+        locks2.release(self.locator)
+        self.assertEqual([], [name for _, _, files in os.walk(self.disk_cache_dir)
+                              for name in files if name.endswith('.fetchlock')])
+
+    def test_fetch_lock_error_frees_slot(self):
+        cache = arvados.keep.KeepBlockCache(shared_cache=True, disk_cache_dir=self.disk_cache_dir)
+        with mock.patch.object(cache._fetch_locks, 'acquire', side_effect=OSError(errno.ENOLCK, 'no locks')):
+            with self.assertRaises(OSError):
+                cache.reserve_cache(self.locator)
+        # Nobody is left waiting on the slot, and the next reader
+        # fetches the block.
+        slot, first = cache.reserve_cache(self.locator)
+        self.assertTrue(first)
+        cache.set(slot, self.data)
+        self.assertEqual(self.data, bytes(slot.get()))
+
+
 class KeepXRequestIdTestCase(unittest.TestCase, tutil.ApiClientMock, DiskCacheBase):
     disk_cache = False
 
@@ -1015,6 +1357,357 @@ class KeepClientTimeout(keepstub.StubKeepServers, unittest.TestCase, DiskCacheBa
                 kc.put(self.DATA, copies=1, num_retries=0)
 
 
+@parameterized.parameterized_class([{"disk_cache": True}, {"disk_cache": False}])
+class KeepClientHedgedGetTestCase(unittest.TestCase, tutil.ApiClientMock, DiskCacheBase):
+    disk_cache = False
+    DATA = b'hedged read'
+
+    def setUp(self):
+        self.api_client = self.mock_keep_services(count=4)
+        self.keep_client = arvados.KeepClient(
+            api_client=self.api_client,
+            block_cache=self.make_block_cache(self.disk_cache),
+            hedge_delay=0.05)
+        self.locator = tutil.str_keep_locator(self.DATA)
+        self.roots = self.keep_client.weighted_service_roots(
+            arvados.KeepLocator(self.locator))
+
+    def tearDown(self):
+        DiskCacheBase.tearDown(self)
+
+    def mock_service_get(self, slow=(), failing=()):
+        # Slow services give up after a while, or as soon as their
+        # request is cancelled.
+        self.calls = []
+        self.threads = []
+        self.cancelled = []
+        self.max_in_flight = 0
+        in_flight = []
+        lock = threading.Lock()
+        def get(keep_service, locator, method="GET", timeout=None, byte_range=None):
+            with lock:
+                self.calls.append(keep_service.root)
+                self.threads.append(threading.current_thread())
+                in_flight.append(keep_service.root)
+                self.max_in_flight = max(self.max_in_flight, len(in_flight))
+            try:
+                if keep_service.root in slow:
+                    if keep_service._cancelled.wait(0.5):
+                        self.cancelled.append(keep_service.root)
+                    return None
+                if keep_service.root in failing:
+                    return None
+                return self.DATA
+            finally:
+                with lock:
+                    in_flight.remove(keep_service.root)
+        return mock.patch.object(
+            arvados.KeepClient._KeepService, 'get',
+            autospec=True, side_effect=get)
+
+    def test_no_hedge_when_first_service_answers(self):
+        with self.mock_service_get():
+            self.assertEqual(self.DATA, self.keep_client.get(self.locator))
+        self.assertEqual(self.roots[:1], self.calls)
+        self.assertEqual([threading.current_thread()], self.threads)
+
+    def test_hedge_to_next_service_when_first_is_slow(self):
+        with self.mock_service_get(slow=self.roots[:1]):
+            self.assertEqual(self.DATA, self.keep_client.get(self.locator))
+        self.assertEqual(self.roots[:2], self.calls)
+        self.assertIs(threading.current_thread(), self.threads[0])
+        self.assertIsNot(threading.current_thread(), self.threads[1])
+        for _ in range(100):
+            if self.cancelled:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.roots[:1], self.cancelled)
+
+    def test_next_service_after_failure(self):
+        with self.mock_service_get(failing=self.roots[:2]):
+            self.assertEqual(self.DATA, self.keep_client.get(self.locator))
+        self.assertEqual(self.roots[:3], self.calls)
+
+    def test_at_most_two_requests_in_flight(self):
+        with self.mock_service_get(slow=self.roots[:2]):
+            self.assertEqual(self.DATA, self.keep_client.get(self.locator))
+        self.assertEqual(self.roots[:3], self.calls)
+        self.assertEqual(2, self.max_in_flight)
+
+    def test_error_when_all_services_fail(self):
+        with self.mock_service_get(failing=self.roots), \
+             self.assertRaises(arvados.errors.KeepReadError):
+            self.keep_client.get(self.locator, num_retries=0)
+        self.assertEqual(sorted(self.roots), sorted(self.calls))
+
+
+class KeepServiceHealthTestCase(unittest.TestCase):
+    ROOTS = ['http://keep{}.zzzzz.example:25107/'.format(i) for i in range(4)]
+
+    def setUp(self):
+        self.health = arvados.keep._KeepServiceHealth()
+
+    def test_unknown_services_keep_order(self):
+        self.assertEqual(self.ROOTS, self.health.prioritize(self.ROOTS))
+
+    def test_failing_service_demoted(self):
+        self.health.record(self.ROOTS[0], 0.1, 503)
+        self.health.record(self.ROOTS[2], 2.0, None)
+        self.assertEqual(
+            [self.ROOTS[1], self.ROOTS[3], self.ROOTS[0], self.ROOTS[2]],
+            self.health.prioritize(self.ROOTS))
+        stats = self.health.stats(self.ROOTS[2])
+        self.assertEqual(1, stats['recent_transport_errors'])
+        self.assertEqual(0, stats['recent_server_errors'])
+
+    def test_client_errors_are_healthy(self):
+        self.health.record(self.ROOTS[0], 0.1, 404)
+        self.health.record(self.ROOTS[1], 0.1, 403)
+        self.assertEqual(self.ROOTS, self.health.prioritize(self.ROOTS))
+
+    def test_success_restores_failed_service(self):
+        self.health.record(self.ROOTS[0], 0.1, 500)
+        self.health.record(self.ROOTS[0], 0.1, 200)
+        self.assertEqual(self.ROOTS, self.health.prioritize(self.ROOTS))
+
+    def test_failure_demotion_expires(self):
+        self.health.record(self.ROOTS[0], 0.1, 500)
+        later = time.monotonic() + self.health.FAILURE_TTL + 1
+        with mock.patch('time.monotonic', return_value=later):
+            self.assertEqual(self.ROOTS, self.health.prioritize(self.ROOTS))
+
+    def test_slow_service_demoted_before_failing_service(self):
+        for root in self.ROOTS:
+            self.health.record(root, 0.5, 200)
+        for _ in range(10):
+            self.health.record(self.ROOTS[1], 20, 200)
+        self.health.record(self.ROOTS[0], 0.1, 502)
+        self.assertEqual(
+            [self.ROOTS[2], self.ROOTS[3], self.ROOTS[1], self.ROOTS[0]],
+            self.health.prioritize(self.ROOTS))
+
+
+    def test_latency_compared_by_method_and_size(self):
+        for root in self.ROOTS:
+            self.health.record(root, 0.01, 200, method='HEAD')
+        # Slow large GETs are only compared with other large GETs.
+        self.health.record(self.ROOTS[0], 5.0, 200, size=64 << 20)
+        self.assertEqual(self.ROOTS, self.health.prioritize(self.ROOTS))
+        self.health.record(self.ROOTS[1], 4.0, 200, size=60 << 20)
+        self.health.record(self.ROOTS[2], 30.0, 200, size=64 << 20)
+        self.assertEqual(
+            [self.ROOTS[0], self.ROOTS[1], self.ROOTS[3], self.ROOTS[2]],
+            self.health.prioritize(self.ROOTS))
+        self.assertEqual({('HEAD', 0): 0.01, ('GET', 3): 5.0},
+                         self.health.stats(self.ROOTS[0])['latency'])
+
+@tutil.skip_sleep
+class KeepClientServiceHealthTestCase(unittest.TestCase, tutil.ApiClientMock, DiskCacheBase):
+    disk_cache = False
+
+    def setUp(self):
+        self.api_client = self.mock_keep_services(count=4)
+        self.keep_client = arvados.KeepClient(
+            api_client=self.api_client,
+            block_cache=self.make_block_cache(self.disk_cache))
+
+    def tearDown(self):
+        DiskCacheBase.tearDown(self)
+
+    def test_failed_service_probed_last_by_later_requests(self):
+        data = b'health'
+        locator = arvados.KeepLocator(tutil.str_keep_locator(data))
+        roots = self.keep_client.weighted_service_roots(locator)
+        with tutil.mock_keep_responses((b'', 500), (data, 200)):
+            self.assertEqual(data, self.keep_client.get(str(locator)))
+        self.assertEqual(
+            roots[1:] + roots[:1],
+            self.keep_client.weighted_service_roots(locator))
+        other_client = arvados.KeepClient(
+            api_client=self.api_client,
+            block_cache=self.make_block_cache(self.disk_cache))
+        self.assertEqual(
+            roots[1:] + roots[:1],
+            other_client.weighted_service_roots(locator))
+
+
+@parameterized.parameterized_class([{"disk_cache": True}, {"disk_cache": False}])
+class KeepClientGetManyTestCase(unittest.TestCase, tutil.ApiClientMock, DiskCacheBase):
+    disk_cache = False
+
+    def setUp(self):
+        self.api_client = self.mock_keep_services(count=2)
+        self.keep_client = arvados.KeepClient(
+            api_client=self.api_client,
+            block_cache=self.make_block_cache(self.disk_cache))
+        self.blocks = {}
+        for i in range(10):
+            data = 'block {}'.format(i).encode()
+            self.blocks[tutil.str_keep_locator(data)] = data
+        self.locators = list(self.blocks)
+
+    def tearDown(self):
+        DiskCacheBase.tearDown(self)
+
+    def mock_service_get(self, delays={}):
+        self.fetched = []
+        lock = threading.Lock()
+        def get(keep_service, locator, method="GET", timeout=None, byte_range=None):
+            loc_s = locator.stripped()
+            with lock:
+                self.fetched.append(loc_s)
+            time.sleep(delays.get(loc_s, 0))
+            return self.blocks.get(loc_s)
+        return mock.patch.object(
+            arvados.KeepClient._KeepService, 'get',
+            autospec=True, side_effect=get)
+
+    def test_ordered_results(self):
+        # The first block is the slowest, but still comes out first.
+        with self.mock_service_get({self.locators[0]: 0.1}):
+            got = [(loc, bytes(blob)) for loc, blob in self.keep_client.get_many(self.locators, threads=4)]
+        self.assertEqual([(loc, self.blocks[loc]) for loc in self.locators], got)
+
+    def test_unordered_results(self):
+        with self.mock_service_get({self.locators[0]: 0.1}):
+            got = [(loc, bytes(blob)) for loc, blob in self.keep_client.get_many(
+                self.locators, ordered=False, threads=4)]
+        self.assertEqual(
+            sorted((loc, self.blocks[loc]) for loc in self.locators),
+            sorted(got))
+        self.assertNotEqual(self.locators[0], got[0][0])
+
+    def test_duplicates_fetched_once(self):
+        locators = self.locators[:3] * 3
+        with self.mock_service_get():
+            got = [(loc, bytes(blob)) for loc, blob in self.keep_client.get_many(locators, threads=2)]
+        self.assertEqual([(loc, self.blocks[loc]) for loc in locators], got)
+        self.assertEqual(sorted(self.locators[:3]), sorted(self.fetched))
+
+    def test_cached_blocks_not_refetched(self):
+        with self.mock_service_get():
+            self.keep_client.get(self.locators[0])
+            self.fetched.clear()
+            got = {loc: bytes(blob) for loc, blob in self.keep_client.get_many(self.locators)}
+        self.assertEqual(self.blocks, got)
+        self.assertNotIn(self.locators[0], self.fetched)
+
+    def test_error_raised_in_order(self):
+        missing = tutil.str_keep_locator(b'missing')
+        locators = self.locators[:2] + [missing] + self.locators[2:]
+        with self.mock_service_get():
+            results = self.keep_client.get_many(locators, num_retries=0)
+            self.assertEqual(self.locators[:2], [loc for loc, _ in itertools.islice(results, 2)])
+            with self.assertRaises(arvados.errors.KeepReadError):
+                next(results)
+            results.close()
+
+    def test_comma_separated_get(self):
+        with self.mock_service_get():
+            got = self.keep_client.get(','.join(self.locators[:3]))
+        self.assertEqual(b''.join(self.blocks[loc] for loc in self.locators[:3]), got)
+
+
+@parameterized.parameterized_class([{"disk_cache": True}, {"disk_cache": False}])
+class KeepClientRangeReadTestCase(unittest.TestCase, tutil.ApiClientMock, DiskCacheBase):
+    disk_cache = False
+
+    def setUp(self):
+        self.api_client = self.mock_keep_services(count=2)
+        self.keep_client = arvados.KeepClient(
+            api_client=self.api_client,
+            block_cache=self.make_block_cache(self.disk_cache))
+        self.data = bytes(random.getrandbits(8) for _ in range(300000))
+        self.locator = tutil.str_keep_locator(self.data)
+
+    def tearDown(self):
+        DiskCacheBase.tearDown(self)
+
+    def test_range_request(self):
+        with tutil.mock_keep_responses(self.data[65536:131072], 206,
+                                       **{'Content-Range': 'bytes 65536-131071/300000'}) as mock:
+            self.assertEqual(self.data[70000:70100],
+                             self.keep_client.get_range(self.locator, 70000, 100))
+            # Served from the cached extent without another request
+            self.assertEqual(self.data[70200:70250],
+                             self.keep_client.get_range(self.locator, 70200, 50))
+        self.assertEqual(1, len(mock.responses))
+        self.assertIn('Range: bytes=65536-131071',
+                      mock.responses[0].getopt(pycurl.HTTPHEADER))
+        self.assertIsNone(self.keep_client.get_from_cache(self.locator))
+
+    def test_range_request_at_end_of_block(self):
+        with tutil.mock_keep_responses(self.data[262144:], 206,
+                                       **{'Content-Range': 'bytes 262144-299999/300000'}) as mock:
+            self.assertEqual(self.data[-10:],
+                             self.keep_client.get_range(self.locator, len(self.data) - 10, 100))
+        self.assertIn('Range: bytes=262144-299999',
+                      mock.responses[0].getopt(pycurl.HTTPHEADER))
+
+    def test_range_not_supported(self):
+        with tutil.mock_keep_responses(self.data, 200):
+            self.assertEqual(self.data[70000:70100],
+                             self.keep_client.get_range(self.locator, 70000, 100))
+        # The whole block was checked and cached.
+        self.assertEqual(self.data, bytes(self.keep_client.get_from_cache(self.locator)))
+        # Other blocks are fetched whole without asking for a range.
+        data = self.data[::-1]
+        with tutil.mock_keep_responses(data, 200) as mock:
+            self.assertEqual(data[70000:70100],
+                             self.keep_client.get_range(tutil.str_keep_locator(data), 70000, 100))
+        self.assertNotIn('Range', ' '.join(mock.responses[0].getopt(pycurl.HTTPHEADER)))
+
+    def test_range_from_cached_block(self):
+        with tutil.mock_keep_responses(self.data, 200):
+            self.keep_client.get(self.locator)
+        self.assertEqual(self.data[70000:70100],
+                         self.keep_client.get_range(self.locator, 70000, 100))
+
+    def test_range_wrong_size(self):
+        with tutil.mock_keep_responses(self.data[65536:65600], 206, 206,
+                                       **{'Content-Range': 'bytes 65536-131071/300000'}):
+            with self.assertRaises(arvados.errors.KeepReadError):
+                self.keep_client.get_range(self.locator, 70000, 100, num_retries=0)
+
+    def test_range_wrong_content_range(self):
+        with tutil.mock_keep_responses(self.data[0:65536], 206, 206,
+                                       **{'Content-Range': 'bytes 0-65535/300000'}):
+            with self.assertRaises(arvados.errors.KeepReadError):
+                self.keep_client.get_range(self.locator, 70000, 100, num_retries=0)
+
+    def test_concurrent_range_requests_share_fetch(self):
+        fetching = threading.Event()
+        release = threading.Event()
+        real_get = arvados.KeepClient._get_or_head
+        def slow_get(*args, **kwargs):
+            fetching.set()
+            release.wait()
+            return real_get(*args, **kwargs)
+        results = []
+        with tutil.mock_keep_responses(self.data[65536:131072], 206,
+                                       **{'Content-Range': 'bytes 65536-131071/300000'}) as keep_mock, \
+             mock.patch.object(arvados.KeepClient, '_get_or_head', autospec=True, side_effect=slow_get):
+            first = threading.Thread(target=lambda: results.append(
+                self.keep_client.get_range(self.locator, 70000, 100)))
+            first.start()
+            fetching.wait()
+            second = threading.Thread(target=lambda: results.append(
+                self.keep_client.get_range(self.locator, 80000, 100)))
+            second.start()
+            release.set()
+            first.join()
+            second.join()
+        self.assertEqual(1, len(keep_mock.responses))
+        self.assertCountEqual([self.data[70000:70100], self.data[80000:80100]], results)
+
+    def test_small_block_fetched_whole(self):
+        data = b'small block'
+        with tutil.mock_keep_responses(data, 200) as mock:
+            self.assertEqual(b'block',
+                             self.keep_client.get_range(tutil.str_keep_locator(data), 6, 100))
+        self.assertNotIn('Range', ' '.join(mock.responses[0].getopt(pycurl.HTTPHEADER)))
+
+
 @parameterized.parameterized_class([{"disk_cache": True}, {"disk_cache": False}])
 class KeepClientGatewayTestCase(unittest.TestCase, tutil.ApiClientMock, DiskCacheBase):
     disk_cache = False
@@ -1373,6 +2066,93 @@ class AvoidOverreplication(unittest.TestCase, tutil.ApiClientMock):
         self.pool.join()
         self.assertEqual(self.pool.done(), (self.copies-1, []))
 
+    def test_shared_executor(self):
+        executor = arvados.KeepClient._KeepWriterExecutor(max_threads=2)
+        self.addCleanup(executor.shutdown)
+        for _ in range(3):
+            pool = arvados.KeepClient._KeepWriterThreadPool(
+                data='foo',
+                data_hash='acbd18db4cc2f85cedef654fccc4a4d8+3',
+                max_service_replicas=1,
+                copies=self.copies,
+                executor=executor,
+            )
+            for i in range(5):
+                pool.add_task(self.FakeKeepService(delay=0, will_succeed=True), None)
+            pool.join()
+            self.assertGreaterEqual(pool.done()[0], self.copies)
+        self.assertEqual(2, len(executor._threads))
+
+
+    def test_executor_grows_for_concurrent_callers(self):
+        executor = arvados.KeepClient._KeepWriterExecutor(max_threads=1)
+        self.addCleanup(executor.shutdown)
+        # Each job waits for all the others to be running, which
+        # only works if every caller gets its own thread.
+        barrier = threading.Barrier(3, timeout=10)
+        finished = []
+        for _ in range(3):
+            executor.add_caller()
+        for _ in range(3):
+            executor.submit(lambda: finished.append(barrier.wait()))
+        deadline = time.time() + 10
+        while len(finished) < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(3, len(finished))
+        self.assertEqual(3, len(executor._threads))
+        for _ in range(3):
+            executor.remove_caller()
+
+
+class KeepClientWriterThreadsTestCase(unittest.TestCase, tutil.ApiClientMock):
+    def test_puts_share_writer_threads(self):
+        api_client = self.mock_keep_services(count=4)
+        keep_client = arvados.KeepClient(api_client=api_client, num_writer_threads=3)
+        self.addCleanup(keep_client.stop_writer_threads)
+        for i in range(5):
+            data = 'block {}'.format(i).encode()
+            locator = tutil.str_keep_locator(data)
+            with tutil.mock_keep_responses(locator, 200, 200):
+                self.assertEqual(locator, keep_client.put(data, copies=2))
+        executor = keep_client._writer_executor
+        self.assertLessEqual(len(executor._threads), 3)
+        self.assertGreater(len(executor._threads), 0)
+        self.assertTrue(all(t.is_alive() for t in executor._threads))
+        keep_client.stop_writer_threads()
+        self.assertIsNone(keep_client._writer_executor)
+
+
+class KeepClientPutBufferTestCase(unittest.TestCase, tutil.ApiClientMock):
+    def setUp(self):
+        self.api_client = self.mock_keep_services(count=1)
+        self.keep_client = arvados.KeepClient(api_client=self.api_client)
+        self.addCleanup(self.keep_client.stop_writer_threads)
+
+    def read_body(self, curl):
+        read = curl.getopt(pycurl.READFUNCTION)
+        chunks = []
+        chunk = read(4)
+        while chunk:
+            chunks.append(chunk)
+            chunk = read(4)
+        return b''.join(chunks)
+
+    def test_put_memoryview(self):
+        data = bytearray(b'foobarbaz')
+        locator = tutil.str_keep_locator(b'foobar')
+        with tutil.mock_keep_responses(locator, 200) as mock:
+            self.keep_client.put(memoryview(data)[:6], copies=1)
+        curl = mock.responses[0]
+        self.assertIn(locator.split('+')[0], curl.getopt(pycurl.URL).decode())
+        self.assertEqual(6, curl.getopt(pycurl.INFILESIZE))
+        self.assertEqual(b'foobar', self.read_body(curl))
+
+    def test_put_trusts_data_hash(self):
+        data_hash = 'f' * 32
+        with tutil.mock_keep_responses(data_hash + '+3', 200) as mock:
+            self.keep_client.put(b'foo', copies=1, data_hash=data_hash)
+        self.assertIn(data_hash, mock.responses[0].getopt(pycurl.URL).decode())
+
 
 @tutil.skip_sleep
 @parameterized.parameterized_class([{"disk_cache": True}, {"disk_cache": False}])
@@ -1550,6 +2330,9 @@ class KeepDiskCacheTestCase(unittest.TestCase, tutil.ApiClientMock):
         os.utime(os.path.join(self.disk_cache_dir, self.locator[0:3], "tmpXYZABC"), times=(time.time()-61, time.time()-61))
         os.utime(os.path.join(self.disk_cache_dir, self.locator[0:3], "XYZABC"), times=(time.time()-61, time.time()-61))
 
+        # Tmp files are cleaned up when the cache index is rebuilt by
+        # walking the cache directory.
+        os.remove(os.path.join(self.disk_cache_dir, "index"))
         block_cache2 = arvados.keep.KeepBlockCache(disk_cache=True,
                                                    disk_cache_dir=self.disk_cache_dir)
 
@@ -1603,6 +2386,10 @@ class KeepDiskCacheTestCase(unittest.TestCase, tutil.ApiClientMock):
         block_cache = arvados.keep.KeepBlockCache(disk_cache=True,
                                                    disk_cache_dir=self.disk_cache_dir,
                                                    max_slots=2)
+        # Blocks are mapped, and so held by the first cache, when they
+        # are first read.
+        self.assertIsNotNone(block_cache.get(self.locator))
+        self.assertIsNotNone(block_cache.get("acbd18db4cc2f85cedef654fccc4a4d8"))
 
         self.assertTrue(os.path.exists(os.path.join(self.disk_cache_dir, self.locator[0:3], self.locator+".keepcacheblock")))
         self.assertTrue(os.path.exists(os.path.join(self.disk_cache_dir, "acb", "acbd18db4cc2f85cedef654fccc4a4d8.keepcacheblock")))
@@ -1614,6 +2401,132 @@ class KeepDiskCacheTestCase(unittest.TestCase, tutil.ApiClientMock):
         self.assertTrue(os.path.exists(os.path.join(self.disk_cache_dir, self.locator[0:3], self.locator+".keepcacheblock")))
         self.assertTrue(os.path.exists(os.path.join(self.disk_cache_dir, "acb", "acbd18db4cc2f85cedef654fccc4a4d8.keepcacheblock")))
 
+    def test_disk_cache_index(self):
+        block_cache = arvados.keep.KeepBlockCache(disk_cache=True,
+                                                  disk_cache_dir=self.disk_cache_dir)
+        slot, first = block_cache.reserve_cache(self.locator)
+        block_cache.set(slot, self.data)
+
+        index = arvados._internal.diskcache.DiskCacheIndex(self.disk_cache_dir)
+        self.assertEqual([self.locator], list(index.load()))
+
+        # A new cache starts from the index, without walking the
+        # cache directory or mapping any blocks.
+        with mock.patch('os.walk', side_effect=AssertionError("walked cache dir")), \
+             mock.patch.object(arvados._internal.diskcache.DiskCacheSlot, 'get_from_disk',
+                               wraps=arvados._internal.diskcache.DiskCacheSlot.get_from_disk) as get_from_disk:
+            block_cache2 = arvados.keep.KeepBlockCache(disk_cache=True,
+                                                       disk_cache_dir=self.disk_cache_dir)
+            # Only the cache check block was looked up.
+            self.assertEqual(1, get_from_disk.call_count)
+            self.assertEqual(len(self.data), block_cache2.cache_total)
+            self.assertEqual(1, block_cache2._slot_count)
+            self.assertEqual(self.data, bytes(block_cache2.get(self.locator).get()))
+        self.assertEqual(len(self.data), block_cache2.cache_total)
+        self.assertEqual(1, block_cache2._slot_count)
+
+    def test_disk_cache_index_batches_accesses(self):
+        index = arvados._internal.diskcache.DiskCacheIndex(self.disk_cache_dir)
+        index.record_add(self.locator, len(self.data))
+        with mock.patch('builtins.open', wraps=open) as mock_open:
+            for _ in range(index.ACCESS_BATCH - 1):
+                index.record_access(self.locator, len(self.data))
+            self.assertEqual(0, mock_open.call_count)
+            index.record_access(self.locator, len(self.data))
+            self.assertEqual(1, mock_open.call_count)
+        index.record_access("acbd18db4cc2f85cedef654fccc4a4d8", 3)
+        index.flush()
+        self.assertEqual([self.locator, "acbd18db4cc2f85cedef654fccc4a4d8"],
+                         list(index.load()))
+
+    def test_disk_cache_index_flushed_at_exit(self):
+        block_cache = arvados.keep.KeepBlockCache(disk_cache=True,
+                                                  disk_cache_dir=self.disk_cache_dir)
+        index = block_cache._index
+        index.record_add(self.locator, len(self.data))
+        index.record_access("acbd18db4cc2f85cedef654fccc4a4d8", 3)
+        arvados._internal.diskcache._flush_indexes()
+        self.assertEqual([self.locator, "acbd18db4cc2f85cedef654fccc4a4d8"],
+                         list(arvados._internal.diskcache.DiskCacheIndex(self.disk_cache_dir).load()))
+
+        index.record_access(self.locator, len(self.data))
+        block_cache.clear()
+        self.assertEqual(["acbd18db4cc2f85cedef654fccc4a4d8", self.locator],
+                         list(arvados._internal.diskcache.DiskCacheIndex(self.disk_cache_dir).load()))
+
+    def test_disk_cache_index_compacts_while_appending(self):
+        index = arvados._internal.diskcache.DiskCacheIndex(self.disk_cache_dir)
+        index.COMPACT_SLACK = 10
+        index.load()
+        index.record_add("acbd18db4cc2f85cedef654fccc4a4d8", 3)
+        for i in range(100):
+            index.record_add(self.locator, len(self.data))
+            index.record_remove(self.locator)
+        with open(index.path) as f:
+            self.assertLessEqual(len(f.readlines()), index.COMPACT_RATIO + index.COMPACT_SLACK + 1)
+        self.assertEqual(["acbd18db4cc2f85cedef654fccc4a4d8"], list(index.load()))
+
+    def test_disk_cache_index_write_error(self):
+        index = arvados._internal.diskcache.DiskCacheIndex(self.disk_cache_dir)
+        with mock.patch('os.rename', side_effect=OSError(errno.EXDEV, 'rename failed')):
+            index._write({self.locator: (len(self.data), time.time())})
+        self.assertEqual([], [name for name in os.listdir(self.disk_cache_dir)
+                              if name.startswith('tmpindex')])
+
+    def test_disk_cache_index_evict(self):
+        block_cache = arvados.keep.KeepBlockCache(disk_cache=True,
+                                                  disk_cache_dir=self.disk_cache_dir)
+        slot, first = block_cache.reserve_cache(self.locator)
+        block_cache.set(slot, self.data)
+        del slot
+
+        block_cache2 = arvados.keep.KeepBlockCache(disk_cache=True,
+                                                   disk_cache_dir=self.disk_cache_dir,
+                                                   max_slots=4)
+        block_cache.clear()
+        block_cache2._max_slots = 0
+        block_cache2.cap_cache()
+        self.assertEqual(0, block_cache2.cache_total)
+        self.assertFalse(os.path.exists(os.path.join(self.disk_cache_dir, self.locator[0:3], self.locator+".keepcacheblock")))
+        index = arvados._internal.diskcache.DiskCacheIndex(self.disk_cache_dir)
+        self.assertEqual([], list(index.load()))
+
+    def test_disk_cache_max_open_blocks(self):
+        block_cache = arvados.keep.KeepBlockCache(disk_cache=True,
+                                                  disk_cache_dir=self.disk_cache_dir,
+                                                  max_open_blocks=2)
+        self.assertEqual(sys.maxsize, block_cache._max_slots)
+        blocks = {}
+        for i in range(5):
+            data = 'block {}'.format(i).encode()
+            locator = hashlib.md5(data).hexdigest()
+            slot, first = block_cache.reserve_cache(locator)
+            block_cache.set(slot, data)
+            blocks[locator] = data
+        del slot
+        self.assertEqual(5, block_cache._slot_count)
+        self.assertEqual(sum(len(data) for data in blocks.values()), block_cache.cache_total)
+        slots = [block_cache.get(locator) for locator in blocks]
+        self.assertEqual(2, sum(1 for slot in slots if slot.content is not None))
+        for slot, data in zip(slots, blocks.values()):
+            # Closed blocks are opened again when read.
+            self.assertEqual(data, bytes(slot.get()))
+        self.assertEqual(5, block_cache._slot_count)
+
+    def test_disk_cache_evict_closed_block(self):
+        block_cache = arvados.keep.KeepBlockCache(disk_cache=True,
+                                                  disk_cache_dir=self.disk_cache_dir,
+                                                  max_open_blocks=1)
+        slot, first = block_cache.reserve_cache(self.locator)
+        block_cache.set(slot, self.data)
+        slot2, first = block_cache.reserve_cache('acbd18db4cc2f85cedef654fccc4a4d8')
+        block_cache.set(slot2, b'foo')
+        self.assertIsNone(slot.content)
+        block_cache._max_slots = 1
+        block_cache.cap_cache()
+        self.assertFalse(os.path.exists(os.path.join(self.disk_cache_dir, self.locator[0:3], self.locator+".keepcacheblock")))
+        self.assertEqual(3, block_cache.cache_total)
+
     def test_disk_cache_error(self):
         os.chmod(self.disk_cache_dir, stat.S_IRUSR)
 
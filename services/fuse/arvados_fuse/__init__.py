@@ -110,6 +110,8 @@ class FileHandle(Handle):
         if self.parent_obj is not None:
             self.parent_obj.inc_use()
         self.open_for_writing = open_for_writing
+        # Access pattern of reads through this handle
+        self.readahead = obj.new_readahead()
 
     def release(self):
         super(FileHandle, self).release()
@@ -897,7 +899,7 @@ class Operations(llfuse.Operations):
 
         self.inodes.touch(handle.obj)
 
-        r = handle.obj.readfrom(off, size, self.num_retries)
+        r = handle.obj.readfrom(off, size, self.num_retries, readahead=handle.readahead)
         if r:
             self.read_counter.add(len(r))
         return r
@@ -16,6 +16,7 @@ import time
 import resource
 
 import arvados.commands._util as arv_cmd
+from arvados._internal import cachepolicy
 from arvados_fuse import crunchstat
 from arvados_fuse import *
 from arvados_fuse.unmount import unmount
@@ -306,6 +307,16 @@ After this time, the mount will be forcefully unmounted.
             dest='disk_cache',
             help="Cache data in memory",
         )
+        cachetype.add_argument(
+            '--shared-cache',
+            action='store_true',
+            default=False,
+            dest='shared_cache',
+            help="""
+Cache data in shared memory, and share cached blocks with other
+processes on this host using the shared cache
+""",
+        )
         cache.add_argument(
             '--disk-cache-dir',
             metavar="DIRECTORY",
@@ -326,6 +337,49 @@ After this time, the mount will be forcefully unmounted.
             help="""
 Size of file data cache in bytes
 (default 8 GiB for filesystem cache, 256 MiB for memory cache)
+""",
+        )
+        cache.add_argument(
+            '--max-open-cache-blocks',
+            type=int,
+            default=0,
+            metavar='N',
+            help="""
+With the filesystem cache, keep at most N cached blocks open at a time,
+so the cache size is only limited by --file-cache and not by the open
+file limit (default 0, keep every cached block open)
+""",
+        )
+        cache.add_argument(
+            '--ram-file-cache',
+            type=int,
+            default=0,
+            metavar='BYTES',
+            help="""
+With the filesystem cache, also keep up to this many bytes of recently
+used file data in memory.  Blocks evicted from memory stay in the
+filesystem cache.  Not valid with --ram-cache (default 0, disabled)
+""",
+        )
+        cache.add_argument(
+            '--cache-eviction-policy',
+            choices=sorted(cachepolicy.POLICIES),
+            default=cachepolicy.DEFAULT_POLICY,
+            help="""
+Policy for choosing which blocks to evict from the file data cache.
+`s3fifo` keeps frequently read blocks cached through large sequential
+reads (default %(default)s)
+""",
+        )
+        cache.add_argument(
+            '--max-range-read',
+            type=int,
+            default=0,
+            metavar='BYTES',
+            help="""
+Serve small random reads of up to this many bytes from uncached blocks
+with HTTP range requests instead of fetching the whole block.  Ranges
+are not cached as blocks (default 0, always fetch whole blocks)
 """,
         )
 
@@ -384,11 +438,15 @@ class Mount(object):
             self.logger.exception("exception during setup: %s", e)
             exit(1)
 
+        if self.args.ram_file_cache and not self.args.disk_cache:
+            self.logger.error("--ram-file-cache can't be used with --ram-cache")
+            exit(1)
+
         try:
             nofile_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
 
             minlimit = 10240
-            if self.args.file_cache:
+            if self.args.file_cache and not self.args.max_open_cache_blocks:
                 # Adjust the file handle limit so it can meet
                 # the desired cache size. Multiply by 8 because the
                 # number of 64 MiB cache slots that keepclient
@@ -497,7 +555,11 @@ class Mount(object):
 
             block_cache = arvados.keep.KeepBlockCache(cache_max=self.args.file_cache,
                                                       disk_cache=self.args.disk_cache,
-                                                      disk_cache_dir=self.args.disk_cache_dir)
+                                                      disk_cache_dir=self.args.disk_cache_dir,
+                                                      eviction_policy=self.args.cache_eviction_policy,
+                                                      ram_cache_max=self.args.ram_file_cache,
+                                                      shared_cache=self.args.shared_cache,
+                                                      max_open_blocks=self.args.max_open_cache_blocks)
 
             self.api = arvados.safeapi.ThreadSafeApiCache(
                 apiconfig=arvados.config.settings(),
@@ -507,6 +569,7 @@ class Mount(object):
                 keep_params={
                     'block_cache': block_cache,
                     'num_retries': self.args.retries,
+                    'max_range_read': self.args.max_range_read,
                 },
                 version='v1',
             )
@@ -52,6 +52,10 @@ def statlogger(interval, keep, ops):
         Stat("hit", keep.hits_counter.get),
         Stat("miss", keep.misses_counter.get)
     ])
+    block_cache = StatWriter("keepcache:{}".format(keep.block_cache.eviction_policy), interval, [
+        Stat("hit", keep.block_cache.hits_counter.get),
+        Stat("miss", keep.block_cache.misses_counter.get)
+    ])
     fuseops = StatWriter("fuseops", interval, [
         Stat("write", ops.write_ops_counter.get),
         Stat("read", ops.read_ops_counter.get)
@@ -73,6 +77,7 @@ def statlogger(interval, keep, ops):
         calls.update()
         net.update()
         cache.update()
+        block_cache.update()
         blk.update()
         fuseops.update()
         for ftime in fusetimes:
@@ -2,6 +2,7 @@
 #
 # SPDX-License-Identifier: AGPL-3.0
 
+import arvados.arvfile
 import json
 import llfuse
 import logging
@@ -28,9 +29,13 @@ class File(FreshBase):
     def size(self):
         return 0
 
-    def readfrom(self, off, size, num_retries=0):
+    def readfrom(self, off, size, num_retries=0, readahead=None):
         return ''
 
+    def new_readahead(self):
+        """Return an access pattern detector for a new file handle, or None."""
+        return None
+
     def writeto(self, off, size, num_retries=0):
         raise Exception("Not writable")
 
@@ -61,9 +66,15 @@ class FuseArvadosFile(File):
         with llfuse.lock_released:
             return self.arvfile.size()
 
-    def readfrom(self, off, size, num_retries=0):
+    def readfrom(self, off, size, num_retries=0, readahead=None):
         with llfuse.lock_released:
-            return self.arvfile.readfrom(off, size, num_retries, exact=True, return_memoryview=True)
+            return self.arvfile.readfrom(off, size, num_retries, exact=True, return_memoryview=True,
+                                         readahead=readahead)
+
+    def new_readahead(self):
+        # Each handle gets its own detector, so readers of the same
+        # file don't make each other look random.
+        return arvados.arvfile._Readahead()
 
     def writeto(self, off, buf, num_retries=0):
         with llfuse.lock_released:
@@ -95,7 +106,7 @@ class StringFile(File):
     def size(self):
         return len(self.contents)
 
-    def readfrom(self, off, size, num_retries=0):
+    def readfrom(self, off, size, num_retries=0, readahead=None):
         return bytes(self.contents[off:(off+size)], encoding='utf-8')
 
 
@@ -273,6 +273,22 @@ class MountArgsTest(unittest.TestCase):
                         '--foreground', self.mntdir])
                     arvados_fuse.command.Mount(args)
 
+    def test_ram_file_cache_needs_disk_cache(self):
+        args = arvados_fuse.command.ArgumentParser().parse_args([
+            '--ram-cache', '--ram-file-cache=1000000',
+            '--foreground', self.mntdir])
+        with nostderr():
+            with self.assertRaises(SystemExit):
+                arvados_fuse.command.Mount(args)
+
+    @noexit
+    def test_max_range_read(self):
+        args = arvados_fuse.command.ArgumentParser().parse_args([
+            '--max-range-read=65536',
+            '--foreground', self.mntdir])
+        self.mnt = arvados_fuse.command.Mount(args)
+        self.assertEqual(65536, self.mnt.api.keep.max_range_read)
+
     @noexit
     @mock.patch('resource.setrlimit')
     @mock.patch('resource.getrlimit')